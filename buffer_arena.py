@@ -0,0 +1,27 @@
+import numpy as np
+
+class BufferArena:
+    def __init__(self, number_of_pixels: int = 0):
+        """
+        Hands out preallocated arrays to be used as the dst of OpenCV calls, so that
+        processing a frame does not allocate new images every time.
+        number_of_pixels: number of pixels (per channel) to allocate each buffer for up front,
+        e.g. the number of pixels of the inference resolution. Buffers grow if a larger
+        image comes along.
+        """
+        self.number_of_pixels = number_of_pixels
+        self.buffers = {}
+
+    def get(self, name: str, shape: tuple, dtype=np.uint8) -> np.ndarray:
+        """
+        Returns a contiguous array of shape and dtype that uses the memory of the buffer called name.
+        The contents of the array are left over from the last use of the buffer. The array is
+        only valid until the buffer is used again, e.g. by the next frame.
+        """
+        size = int(np.prod(shape))
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.size < size or buffer.dtype != dtype:
+            channels = int(np.prod(shape[2:]))
+            buffer = np.empty(max(size, self.number_of_pixels * channels), dtype)
+            self.buffers[name] = buffer
+        return buffer[:size].reshape(shape)
@@ -9,7 +9,11 @@ class Settings:
         if not os.path.exists(self.path):
             self.write()
 
-    def read(self):
+    def read(self) -> list:
+        """
+        Reads the settings from the file. Returns the keys of the settings that were
+        missing from the file, and were filled in with their defaults.
+        """
         with open(self.path, 'r') as f:
             lines = f.readlines()
 
@@ -37,16 +41,19 @@ class Settings:
             # add to the dict
             temp_dict[key] = value
 
-        # check if the number of read settings equals the number of settings 
-        # that should be in the dict
-        if len(temp_dict.keys()) == len(self.settings_dict.keys()):
-            ret = True
-            self.settings_dict = temp_dict
-            self.print_values()
-        else:
-            ret = False
+        # Settings that are missing from the file (e.g. ones that were added in an update)
+        # keep their default values, and are added to the file.
+        missing_keys = [key for key in self.settings_dict.keys() if key not in temp_dict]
+        for key in missing_keys:
+            temp_dict[key] = self.settings_dict[key]
+        # keep the order of the defaults
+        self.settings_dict = {key: temp_dict[key] for key in self.settings_dict.keys()}
+        if missing_keys:
+            print(f'Settings missing from {self.path}, using the defaults: {missing_keys}')
+            self.write()
+        self.print_values()
 
-        return ret
+        return missing_keys
 
     def get_value(self, key):
         return self.settings_dict[key]
@@ -105,25 +112,24 @@ if __name__ == '__main__':
     }
 
     settings = Settings(path, settings_dict, dtype_dict)
-    ret = settings.read()
-    print(f'ret: {ret}')
-    if ret: 
-        settings.print_values()
-
-        print('----------')
-        print('Getting a value...')
-        ail_trim = settings.get_value('ail_trim')
-        print(f'ail_trim: {ail_trim}')
-
-        print('----------')
-        print('Updating a value...')
-        settings.update_value('ail_trim', .09999)
-
-        print('----------')
-        print('Getting value again...')
-        ail_trim = settings.get_value('ail_trim')
-        print(f'ail_trim: {ail_trim}')
-
-        print('----------')
-        print('Writing values...')
-        settings.write()
\ No newline at end of file
+    missing_keys = settings.read()
+    print(f'missing_keys: {missing_keys}')
+    settings.print_values()
+
+    print('----------')
+    print('Getting a value...')
+    ail_trim = settings.get_value('ail_trim')
+    print(f'ail_trim: {ail_trim}')
+
+    print('----------')
+    print('Updating a value...')
+    settings.update_value('ail_trim', .09999)
+
+    print('----------')
+    print('Getting value again...')
+    ail_trim = settings.get_value('ail_trim')
+    print(f'ail_trim: {ail_trim}')
+
+    print('----------')
+    print('Writing values...')
+    settings.write()
\ No newline at end of file
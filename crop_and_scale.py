@@ -1,6 +1,12 @@
 import cv2
 import numpy as np
 
+# converts Y, U, V (limited range BT.601, as captured by webcams) to B, G, R, 
+# with the same coefficients as cv2.COLOR_YUV2BGR_YUYV and cv2.COLOR_YUV2BGR_NV12
+YUV_TO_BGR = np.array([[1.164,  2.018,  0.   , -1.164 * 16 - 2.018 * 128],
+                       [1.164, -0.391, -0.813, -1.164 * 16 + (0.391 + 0.813) * 128],
+                       [1.164,  0.   ,  1.596, -1.164 * 16 - 1.596 * 128]])
+
 def get_cropping_and_scaling_parameters(original_resolution: tuple, new_resolution: int) -> dict:
     """
     original_resolution: resolution of the original, unscaled frame
@@ -33,13 +39,46 @@ def get_cropping_and_scaling_parameters(original_resolution: tuple, new_resoluti
 
     return crop_and_scale_parameters
 
-def crop_and_scale(frame, cropping_start, cropping_end, scale_factor):
+def get_jpeg_decoding_parameters(original_resolution: tuple, new_resolution: tuple) -> tuple:
+    """
+    For frames captured as JPEG, which can be scaled down by 2, 4 or 8 while they are decoded.
+    Returns the largest such reduction that still leaves at least the height of new_resolution
+    (1 if there is none), along with the cropping and scaling parameters for the reduced frame.
+    """
+    reduction = 1
+    while reduction < 8 and original_resolution[1] / (reduction * 2) >= new_resolution[1]:
+        reduction *= 2
+    # JPEG decoders round the reduced size up
+    reduced_resolution = tuple(-(-size // reduction) for size in original_resolution)
+    return reduction, get_cropping_and_scaling_parameters(reduced_resolution, new_resolution)
+
+def crop_and_scale(frame, cropping_start, cropping_end, scale_factor, dst=None):
+    """
+    dst: optional array to write the cropped and scaled frame to, e.g. the frame returned
+         by the previous call, so that no new frame has to be allocated
+    """
     # crop the image
     frame = frame[:,cropping_start:cropping_end]
     # resize the image
-    frame = cv2.resize(frame, (0, 0), fx=scale_factor, fy=scale_factor)
+    frame = cv2.resize(frame, (0, 0), dst=dst, fx=scale_factor, fy=scale_factor)
     return frame
 
+def crop_and_scale_yuv(luma, u, v, cropping_start, cropping_end, scale_factor, dst=None):
+    """
+    Same as crop_and_scale, for a frame that was captured as YUV (e.g. YUYV or NV12) instead of BGR.
+    Only the cropped and scaled frame is converted to BGR, so the full frame never has to be.
+    luma: the Y plane of the frame
+    u, v: the chroma planes of the frame, which may have fewer columns and rows than the Y plane
+    """
+    # the chroma planes are cropped at the same place as the Y plane, relative to their size
+    chroma_cropping_start = cropping_start * u.shape[1] // luma.shape[1]
+    chroma_cropping_end = cropping_end * u.shape[1] // luma.shape[1]
+    luma = cv2.resize(luma[:,cropping_start:cropping_end], (0, 0), fx=scale_factor, fy=scale_factor)
+    size = luma.shape[::-1]
+    u = cv2.resize(u[:,chroma_cropping_start:chroma_cropping_end], size)
+    v = cv2.resize(v[:,chroma_cropping_start:chroma_cropping_end], size)
+    return cv2.transform(cv2.merge((luma, u, v)), YUV_TO_BGR, dst=dst)
+
 if __name__ == "__main__":
     path = 'training_data/sample_images/sample_horizon_corrected.png'
     input_frame = cv2.imread(path)
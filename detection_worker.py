@@ -0,0 +1,197 @@
+import numpy as np
+from multiprocessing import get_all_start_methods, get_context, shared_memory
+from timeit import default_timer as timer
+from find_horizon import HorizonDetector
+
+# number of frames in the shared memory ring. While the worker reads a frame from one slot,
+# the next frame is written to another one.
+NUMBER_OF_SLOTS = 3
+# frame periods to wait for the worker to find the horizon in a frame. If it takes longer,
+# the frame gets no horizon, so that the main loop is not held up.
+FRAME_PERIODS_TO_WAIT = 2
+# seconds that the worker can take to answer, before it is considered stuck and restarted
+WORKER_TIMEOUT = 1
+# values returned by find_horizon when no horizon could be found, e.g. while the worker restarts
+NO_HORIZON = (None, None, None, None, None)
+# The worker is started from a clean server process instead of being forked from the main process,
+# whose threads (capture, recording, sync) may hold locks at that moment that the fork would inherit.
+START_METHOD = 'forkserver' if 'forkserver' in get_all_start_methods() else 'spawn'
+
+def _run_worker(connection, shared_memory_name: str, slot_size: int, number_of_slots: int, args: tuple, kwargs: dict):
+    """
+    Runs a HorizonDetector in the worker process, on the frames in the shared memory ring.
+    Takes messages from connection:
+    ('find_horizon', slot_index, shape): finds the horizon in the frame of shape in the slot
+    ('set_frame_shape', frame_shape, bilateral_diameter): see HorizonDetector.set_frame_shape
+    None: stops the worker
+    """
+    ring = shared_memory.SharedMemory(name=shared_memory_name)
+    slots = np.ndarray((number_of_slots, slot_size), dtype=np.uint8, buffer=ring.buf)
+    horizon_detector = HorizonDetector(*args, **kwargs)
+    connection.send('ready')
+    frame = None
+    try:
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+            if message[0] == 'set_frame_shape':
+                horizon_detector.set_frame_shape(*message[1:])
+                continue
+            _, slot_index, shape = message
+            frame = slots[slot_index, :int(np.prod(shape))].reshape(shape)
+            roll, pitch, variance, is_good_horizon, _ = horizon_detector.find_horizon(frame)
+            connection.send((roll, pitch, variance, is_good_horizon,
+                                horizon_detector.frame_skipped, horizon_detector.frame_tracked))
+    finally:
+        del slots, frame
+        ring.close()
+
+class DetectionWorker:
+    def __init__(self, *args, fps: float = 30, **kwargs):
+        """
+        Runs a HorizonDetector in a separate process, so that detection does not compete for the GIL
+        with the capture, the recording and the flight controller, and so that a crash in the
+        detection does not take down the main loop. Frames are passed through a ring of slots
+        in shared memory, so that they do not have to be pickled.
+        Takes the same arguments as HorizonDetector, and can be used in its place in the main loop.
+        fps: frame rate of the main loop. find_horizon waits up to FRAME_PERIODS_TO_WAIT frame periods
+        for the worker, and returns no horizon for the frame if the worker takes longer.
+        If the worker crashes or gets stuck, it is restarted, and find_horizon returns no horizon
+        until it is ready again.
+        """
+        self.args = list(args)
+        self.kwargs = kwargs
+        self.timeout = FRAME_PERIODS_TO_WAIT / fps # in seconds
+        self.busy_since = None # time the worker was sent the frame that it has not answered yet
+        self.bilateral_diameter = None # None keeps the default of the backend
+        self.context = get_context(START_METHOD)
+
+        # each slot holds a frame of the largest inference resolution (frame_shape)
+        frame_shape = args[3]
+        self.slot_size = frame_shape[0] * frame_shape[1] * 3
+        self.ring = shared_memory.SharedMemory(create=True, size=NUMBER_OF_SLOTS * self.slot_size)
+        self.slots = np.ndarray((NUMBER_OF_SLOTS, self.slot_size), dtype=np.uint8, buffer=self.ring.buf)
+        self.slot_index = 0
+        self.frame_buffer = None # the slot last handed out by get_frame_buffer
+
+        # the same statistics as HorizonDetector
+        self.frame_skipped = False
+        self.frame_tracked = False
+        self.number_of_frames = 0
+        self.number_of_skipped_frames = 0
+        self.number_of_restarts = 0
+
+        self._start()
+        # wait for the first detector to be set up, e.g. for the sky filter lookup table to be loaded
+        self.connection.poll(None)
+        try:
+            self.ready = self.connection.recv() == 'ready'
+        except EOFError:
+            # e.g. the arguments were invalid. The worker prints the error before it stops.
+            self.process.join()
+            del self.slots
+            self.ring.close()
+            self.ring.unlink()
+            raise RuntimeError('The detection worker could not be started.') from None
+
+    def _start(self):
+        self.connection, worker_connection = self.context.Pipe()
+        self.process = self.context.Process(target=_run_worker, args=(worker_connection, self.ring.name, self.slot_size,
+                                                            NUMBER_OF_SLOTS, tuple(self.args), self.kwargs), daemon=True)
+        self.process.start()
+        worker_connection.close()
+        self.ready = False
+        self.busy_since = None
+        if self.bilateral_diameter is not None:
+            self.connection.send(('set_frame_shape', self.args[3], self.bilateral_diameter))
+
+    def _restart(self, reason: str):
+        print(f'Detection worker {reason}. Restarting it.')
+        # kill rather than terminate, which a stuck worker may not get to handle
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+        self.number_of_restarts += 1
+        self._start()
+
+    @property
+    def skip_rate(self) -> float:
+        if self.number_of_frames == 0:
+            return 0
+        return self.number_of_skipped_frames / self.number_of_frames
+
+    def get_frame_buffer(self, shape: tuple) -> np.ndarray:
+        """
+        Returns the next slot of the ring as an array of shape, to write the next frame to
+        (e.g. as the dst of crop_and_scale), so that find_horizon does not have to copy it.
+        """
+        self.slot_index = (self.slot_index + 1) % NUMBER_OF_SLOTS
+        self.frame_buffer = self.slots[self.slot_index, :int(np.prod(shape))].reshape(shape)
+        return self.frame_buffer
+
+    def set_frame_shape(self, frame_shape: tuple, bilateral_diameter: int = None):
+        self.args[3] = frame_shape
+        if bilateral_diameter is not None:
+            self.bilateral_diameter = bilateral_diameter
+        try:
+            self.connection.send(('set_frame_shape', frame_shape, bilateral_diameter))
+        except OSError:
+            self._restart('has stopped')
+
+    def find_horizon(self, frame: np.ndarray, diagnostic_mode: bool = False) -> tuple:
+        """
+        Same as HorizonDetector.find_horizon, except that the mask is not returned (None),
+        and that diagnostic_mode is not supported.
+        """
+        self.number_of_frames += 1
+        self.frame_skipped = False
+        self.frame_tracked = False
+
+        try:
+            # after a restart, skip frames until the new worker is ready, instead of holding up the main loop
+            if not self.ready:
+                if not self.connection.poll():
+                    return NO_HORIZON
+                self.ready = self.connection.recv() == 'ready'
+
+            # If the worker is still busy with an earlier frame, this frame gets no horizon.
+            # The late answer is thrown away, and the worker is restarted if it takes too long.
+            if self.busy_since is not None:
+                if not self.connection.poll():
+                    if timer() - self.busy_since > WORKER_TIMEOUT:
+                        self._restart('is not responding')
+                    return NO_HORIZON
+                self.connection.recv()
+                self.busy_since = None
+
+            # write the frame to the ring, unless it was already written there
+            if frame is not self.frame_buffer:
+                np.copyto(self.get_frame_buffer(frame.shape), frame)
+            self.frame_buffer = None
+
+            self.connection.send(('find_horizon', self.slot_index, frame.shape))
+            if not self.connection.poll(self.timeout):
+                self.busy_since = timer() - self.timeout
+                return NO_HORIZON
+            roll, pitch, variance, is_good_horizon, self.frame_skipped, self.frame_tracked = self.connection.recv()
+        except (EOFError, OSError):
+            self._restart('has stopped')
+            return NO_HORIZON
+        self.number_of_skipped_frames += self.frame_skipped
+        return roll, pitch, variance, is_good_horizon, None
+
+    def close(self):
+        """
+        Stops the worker and frees the shared memory.
+        """
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(WORKER_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+        del self.slots, self.frame_buffer
+        self.ring.close()
+        self.ring.unlink()
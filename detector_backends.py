@@ -0,0 +1,481 @@
+######## Backends for HorizonDetector #########
+# Each backend is a different way of finding the horizon in an image.
+# HorizonDetector runs the stages of the selected backend in order:
+# preprocess -> extract_boundary -> fit -> score
+
+import cv2
+import os
+import platform
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from math import pi
+from concurrent.futures import ThreadPoolExecutor
+from line_fitting import distances_to_line, fit_line
+from buffer_arena import BufferArena
+
+# constants
+OPERATING_SYSTEM = platform.system()
+# Horizon points are checked for an edge within EDGE_RADIUS pixels of the point. An edge is 
+# a gradient magnitude (as computed by cv2.Canny) above EDGE_THRESH, Canny's upper threshold.
+EDGE_RADIUS = 2
+EDGE_THRESH = 250
+# HSV bounds of the blue that is filtered out of the sky
+SKY_LOWER_HSV = np.array([109, 0, 116])
+SKY_UPPER_HSV = np.array([153, 255, 255])
+# where the sky filter lookup tables are cached, by number of bits per color channel.
+# Next to this file, so that the cache is found whatever directory the program is started from.
+SKY_LUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sky_lut_{}bit.npy')
+# diameter of the bilateral filter that smooths the blue filtered greyscale image
+BILATERAL_DIAMETER = 9
+# when preprocessing in parallel, images are not split into strips of fewer rows than this
+MIN_ROWS_PER_STRIP = 16
+# maximum number of horizon points handed on to the fitting stage
+MAXIMUM_NUMBER_OF_POINTS = 100
+# number of columns (or rows) searched for the horizon by ColumnScanBackend
+NUMBER_OF_SCAN_LINES = 100
+# resolution of the Hough transform
+HOUGH_THETA_STEP = pi / 180 # radians
+HOUGH_RHO_STEP = 1 # pixels
+
+def _is_near_edge(greyscale: np.ndarray, x: np.ndarray, y: np.ndarray, padded: np.ndarray = None) -> np.ndarray:
+    """
+    Checks for each point (x, y) if there is an edge in the greyscale image within EDGE_RADIUS
+    pixels of the point. Instead of running Canny over the whole image, the gradient is only 
+    found in the neighbourhoods of the points. A neighbourhood contains an edge if the gradient
+    magnitude anywhere within it is above Canny's upper threshold, since such a pixel always starts
+    a Canny edge (unless a stronger pixel right next to it takes its place).
+    padded: optional buffer for the greyscale image with EDGE_RADIUS + 1 pixels of border on each side
+    """
+    # Cut the square of pixels around each point out of the image. The squares include one extra
+    # pixel on each side for the gradient. The border is repeated, like cv2.Canny does.
+    if x.shape[0] == 0:
+        return np.zeros(0, dtype=bool)
+    border = EDGE_RADIUS + 1
+    padded = cv2.copyMakeBorder(greyscale, border, border, border, border, cv2.BORDER_REPLICATE, dst=padded)
+    squares = sliding_window_view(padded, (2 * border + 1, 2 * border + 1))[y, x].astype(np.int16)
+
+    # 3x3 Sobel gradients and their L1 magnitude, as in cv2.Canny
+    dx = squares[:, :, 2:] - squares[:, :, :-2]
+    gradient_x = dx[:, :-2] + 2 * dx[:, 1:-1] + dx[:, 2:]
+    dy = squares[:, 2:] - squares[:, :-2]
+    gradient_y = dy[:, :, :-2] + 2 * dy[:, :, 1:-1] + dy[:, :, 2:]
+    magnitude = np.abs(gradient_x) + np.abs(gradient_y)
+    return magnitude.reshape(x.shape[0], -1).max(axis=1) > EDGE_THRESH
+
+def _filter_sky(image: np.ndarray, bgr2gray: np.ndarray, hsv: np.ndarray = None, 
+                hsv_mask: np.ndarray = None, dst: np.ndarray = None) -> np.ndarray:
+    """
+    Brightens the blue of the sky in the greyscale image, so that the sky
+    stands out from the ground.
+    hsv, hsv_mask, dst: optional buffers for the intermediate images and the result
+    """
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=hsv)
+    hsv_mask = cv2.inRange(hsv, SKY_LOWER_HSV, SKY_UPPER_HSV, dst=hsv_mask)
+    return cv2.add(bgr2gray, hsv_mask, dst=dst)
+
+def _load_sky_lut(bits: int) -> np.ndarray:
+    """
+    Loads the lookup table that converts a BGR pixel straight into its blue filtered
+    greyscale value. The table is built on first use and cached to disk, since building
+    it takes a few seconds on the Raspberry Pi.
+    bits: number of bits per color channel used to index the table. 8 bits gives exactly
+    the same result as _filter_sky. Fewer bits give a smaller table that fits in the
+    CPU cache better, at the cost of some accuracy near the edges of the sky filter.
+    """
+    path = SKY_LUT_PATH.format(bits)
+    number_of_colors = 1 << (3 * bits)
+    if os.path.exists(path):
+        # A table that cannot be read or has the wrong shape (e.g. it was cut off by a power cut
+        # while it was saved) is built again.
+        try:
+            sky_lut = np.load(path)
+            if sky_lut.shape == (number_of_colors,) and sky_lut.dtype == np.uint8:
+                return sky_lut
+        except (OSError, ValueError, EOFError):
+            pass
+        print(f'The sky filter lookup table {path} is damaged. Building it again.')
+
+    # Generate an image that contains every color once. If the colors are quantized,
+    # use the color in the middle of each quantization step.
+    number_of_levels = 1 << bits
+    shift = 8 - bits
+    levels = (np.arange(number_of_levels) << shift) + ((1 << shift) >> 1)
+    blue, green, red = np.meshgrid(levels, levels, levels, indexing='ij')
+    colors = np.stack((blue, green, red), axis=-1).astype(np.uint8)
+    colors = colors.reshape(number_of_levels * number_of_levels, number_of_levels, 3)
+
+    # filter the sky in the image of all colors
+    bgr2gray = cv2.cvtColor(colors, cv2.COLOR_BGR2GRAY)
+    sky_lut = _filter_sky(colors, bgr2gray).reshape(-1)
+
+    # save to a temporary file first, so that the table on disk is never left half-written
+    with open(path + '.tmp', 'wb') as lut_file:
+        np.save(lut_file, sky_lut)
+        lut_file.flush()
+        os.fsync(lut_file.fileno())
+    os.replace(path + '.tmp', path)
+    return sky_lut
+
+def _sky_centroid(mask: np.ndarray) -> tuple:
+    """
+    Returns the centroid of the sky (the white pixels of the mask), or (None, None) if
+    there is no sky. Since the sky is the part of the image on one side of a straight
+    horizon, its centroid always lies on the sky side of the horizon.
+    """
+    # The centroid does not need to be exact, so only every step_size-th pixel is used.
+    step_size = max(1, max(mask.shape)//NUMBER_OF_SCAN_LINES)
+    moments = cv2.moments(mask[::step_size, ::step_size])
+    if moments['m00'] == 0:
+        return None, None
+    return moments['m10'] / moments['m00'] * step_size, moments['m01'] / moments['m00'] * step_size
+
+class DetectorBackend:
+    def __init__(self, sky_lut_bits: int = None, fitter: str = 'polyfit', rng=None, buffers: BufferArena = None,
+                    number_of_threads: int = 1):
+        """
+        Base class for the backends of HorizonDetector. Subclasses implement extract_boundary
+        and override any of the other stages that work differently for them.
+        sky_lut_bits: if provided, the sky is filtered with a lookup table indexed by this number
+        of bits per color channel (1-8), instead of converting each image to HSV.
+        fitter: method used to fit the horizon to the points, see line_fitting.FITTERS.
+        rng: numpy random Generator used by the 'ransac' fitter
+        buffers: arena of the buffers that the images are written to. The images returned by
+        preprocess are only valid until the next image is preprocessed.
+        number_of_threads: if more than 1, preprocessing is split into horizontal strips
+        of the image, which are processed in parallel by this many threads.
+        """
+        self.sky_lut_bits = sky_lut_bits
+        self.sky_lut = None
+        if sky_lut_bits:
+            self.sky_lut = _load_sky_lut(sky_lut_bits)
+        self.fitter = fitter
+        self.rng = rng
+        self.buffers = buffers if buffers is not None else BufferArena()
+        # may be reduced to save time, e.g. by the ResolutionGovernor
+        self.bilateral_diameter = BILATERAL_DIAMETER
+        # OpenCV releases the GIL, so the strips are processed in parallel by threads
+        self.number_of_threads = number_of_threads
+        self.thread_pool = None
+        if number_of_threads > 1:
+            self.thread_pool = ThreadPoolExecutor(number_of_threads)
+
+    def preprocess(self, image: np.ndarray, otsu_thresh: float = None) -> dict:
+        """
+        Generates the sky/ground mask of the image.
+        image: the image to search, either the whole frame or a band cut out of it
+        otsu_thresh: threshold for generating the mask. If None, the threshold is found with Otsu's method.
+
+        Returns a dictionary with the greyscale image ('bgr2gray'), the blue filtered greyscale image,
+        the mask, the edges (None if the backend does not use them) and the threshold that was used.
+        """
+        shape = image.shape[:2]
+        bgr2gray = self.buffers.get('bgr2gray', shape)
+        blue_filtered_greyscale = self.buffers.get('blue_filtered_greyscale', shape)
+        blur = self.buffers.get('blur', shape)
+        if self.sky_lut is None:
+            sky_filter_buffers = (self.buffers.get('hsv', image.shape), self.buffers.get('hsv_mask', shape))
+        else:
+            sky_filter_buffers = (self.buffers.get('quantized', image.shape), self.buffers.get('index', shape, np.uint32),
+                                    self.buffers.get('channel', shape, np.uint32))
+
+        number_of_strips = min(self.number_of_threads, shape[0] // MIN_ROWS_PER_STRIP)
+        if number_of_strips <= 1:
+            # get greyscale and filter our blue from the sky
+            self._filter_sky_rows(image, slice(0, shape[0]), bgr2gray, blue_filtered_greyscale, sky_filter_buffers)
+            cv2.bilateralFilter(blue_filtered_greyscale,self.bilateral_diameter,50,50, dst=blur)
+        else:
+            boundaries = np.linspace(0, shape[0], number_of_strips + 1).astype(int)
+            strips = [slice(start, end) for start, end in zip(boundaries[:-1], boundaries[1:])]
+            # The colors are converted pixel by pixel, so each thread converts the rows of its strip.
+            list(self.thread_pool.map(lambda rows: self._filter_sky_rows(image, rows, bgr2gray, blue_filtered_greyscale, 
+                                                                            sky_filter_buffers), strips))
+            # The bilateral filter looks at the neighbours of each pixel, so once all strips are converted,
+            # each strip is blurred together with a halo of the rows around it.
+            halo = self.bilateral_diameter // 2
+            strip_buffers = [self.buffers.get(f'blur_strip_{n}', (rows.stop - rows.start + 2 * halo, shape[1])) 
+                                for n, rows in enumerate(strips)]
+            list(self.thread_pool.map(lambda rows, strip_buffer: self._blur_rows(blue_filtered_greyscale, rows, blur, strip_buffer), 
+                                        strips, strip_buffers))
+
+        # generate mask
+        # Otsu's method needs the histogram of the whole image, so the threshold is found after the strips are stitched.
+        mask = self.buffers.get('mask', shape)
+        if otsu_thresh is None:
+            otsu_thresh, _ = cv2.threshold(blur,250,255,cv2.THRESH_OTSU, dst=mask)
+        else:
+            cv2.threshold(blur,otsu_thresh,255,cv2.THRESH_BINARY, dst=mask)
+
+        preprocessed = {}
+        preprocessed['bgr2gray'] = bgr2gray
+        preprocessed['blue_filtered_greyscale'] = blue_filtered_greyscale
+        preprocessed['mask'] = mask
+        preprocessed['edges'] = None
+        preprocessed['otsu_thresh'] = otsu_thresh
+        return preprocessed
+
+    def extract_boundary(self, preprocessed: dict) -> tuple:
+        """
+        Finds the candidate horizon points along the boundary between sky and ground.
+        preprocessed: the output of preprocess
+
+        Returns x and y of the points, whether each point is valid, and a point on the sky side
+        of the horizon (used to find the direction of the sky). If no boundary was found,
+        the point on the sky side is (None, None).
+        """
+        raise NotImplementedError
+
+    def fit(self, x: np.ndarray, y: np.ndarray, inlier_thresh: float) -> tuple:
+        """
+        Fits the line y = m * x + b to the points.
+        Returns m, b, the distance of each point to the line and which points are inliers.
+        """
+        return fit_line(x, y, self.fitter, inlier_thresh, self.rng)
+
+    def score(self, distances: np.ndarray, is_inlier: np.ndarray, image_height: int) -> float:
+        """
+        Returns the variance of the fit, i.e. the average distance of the inliers to the line
+        as a percentage of the image height. This is treated as a confidence score.
+        """
+        return np.average(distances[is_inlier]) / image_height * 100
+
+    def _filter_sky_rows(self, image: np.ndarray, rows: slice, bgr2gray: np.ndarray,
+                            blue_filtered_greyscale: np.ndarray, sky_filter_buffers: tuple):
+        """
+        Converts the rows of the image to greyscale and filters out the blue from the sky,
+        writing the results to the same rows of bgr2gray and blue_filtered_greyscale.
+        sky_filter_buffers: buffers for the intermediate images of the sky filter
+        """
+        cv2.cvtColor(image[rows], cv2.COLOR_BGR2GRAY, dst=bgr2gray[rows])
+        sky_filter_buffers = [sky_filter_buffer[rows] for sky_filter_buffer in sky_filter_buffers]
+        if self.sky_lut is None:
+            _filter_sky(image[rows], bgr2gray[rows], *sky_filter_buffers, dst=blue_filtered_greyscale[rows])
+        else:
+            self._filter_sky_with_lut(image[rows], blue_filtered_greyscale[rows], *sky_filter_buffers)
+
+    def _blur_rows(self, image: np.ndarray, rows: slice, dst: np.ndarray, strip_buffer: np.ndarray):
+        """
+        Applies the bilateral filter to the rows of the image, writing the result to the same rows of dst.
+        The rows are filtered together with a halo of the rows around them, so that the result
+        is the same as if the whole image were filtered.
+        strip_buffer: buffer for the filtered rows and halo
+        """
+        halo = self.bilateral_diameter // 2
+        top = max(rows.start - halo, 0)
+        bottom = min(rows.stop + halo, image.shape[0])
+        strip = cv2.bilateralFilter(image[top:bottom],self.bilateral_diameter,50,50, dst=strip_buffer[:bottom - top])
+        dst[rows] = strip[rows.start - top:rows.stop - top]
+
+    def _filter_sky_with_lut(self, image: np.ndarray, dst: np.ndarray, quantized: np.ndarray,
+                                index: np.ndarray, channel: np.ndarray) -> np.ndarray:
+        """
+        Same as _filter_sky, but looks up the blue filtered greyscale value
+        of each pixel in self.sky_lut in a single pass.
+        quantized, index, channel: buffers for the intermediate images
+        """
+        # quantize the colors
+        shift = 8 - self.sky_lut_bits
+        if shift:
+            image = np.right_shift(image, shift, out=quantized)
+
+        # combine the color channels into an index into the lookup table
+        np.left_shift(image[..., 0], 2 * self.sky_lut_bits, out=index, dtype=np.uint32)
+        np.left_shift(image[..., 1], self.sky_lut_bits, out=channel, dtype=np.uint32)
+        index |= channel
+        index |= image[..., 2]
+        return np.take(self.sky_lut, index, out=dst)
+
+def _no_points() -> tuple:
+    """
+    The output of extract_boundary when no boundary was found.
+    """
+    no_points = np.empty(0, dtype=int)
+    return no_points, no_points, no_points.astype(bool), None, None
+
+class ContourBackend(DetectorBackend):
+    """
+    Finds the horizon along the largest contour of the Otsu sky/ground mask,
+    keeping the contour points that lie close to an edge of the greyscale image.
+    """
+    def extract_boundary(self, preprocessed: dict) -> tuple:
+        mask = preprocessed['mask']
+
+        # find contours
+        # chain = cv2.CHAIN_APPROX_SIMPLE
+        chain = cv2.CHAIN_APPROX_NONE
+        if OPERATING_SYSTEM == "Linux": # for raspberry pi
+            _, contours, _ = cv2.findContours(mask, cv2.RETR_TREE, chain)
+        else: # for windows
+            contours, _ = cv2.findContours(mask, cv2.RETR_TREE, chain)
+
+        # If there weren't any contours found (i.e. the image was all black), end early.
+        if len(contours) == 0:
+            return _no_points()
+
+        # find the contour with the largest area
+        largest_contour = sorted(contours, key=cv2.contourArea, reverse=True)[0]
+
+        # extract x and y values from contour
+        x_original = largest_contour[:, 0, 0]
+        y_original = largest_contour[:, 0, 1]
+
+        # Separate the points that lie on the edge of the image from all other points.
+        # Edge points will be used to find sky_is_up.
+        # All other points will be used to find the horizon.
+        on_frame_edge = (x_original == 0) | (x_original == mask.shape[1] - 1) | \
+                        (y_original == 0) | (y_original == mask.shape[0] - 1)
+        x_edge_points = x_original[on_frame_edge]
+        y_edge_points = y_original[on_frame_edge]
+        x_abbr = x_original[~on_frame_edge]
+        y_abbr = y_original[~on_frame_edge]
+
+        # If all of the points lie on the edge of the image (e.g. the image is all sky), end early.
+        if x_abbr.shape[0] == 0:
+            return _no_points()
+
+        # Find the average position of the edge points.
+        # This will help determine the direction of the sky.
+        # Reduce the number of edge points to improve performance.
+        maximum_number_of_points = 20
+        step_size = x_edge_points.shape[0]//maximum_number_of_points
+        if step_size > 1:
+            x_edge_points = x_edge_points[::step_size]
+            y_edge_points = y_edge_points[::step_size]
+
+        # Check if there are any edge points. If there are, take the average of them to determine
+        # sky_is_up. If there aren't any edge points, take the average of the abbreviated point list
+        # instead, since it is not possible to take the average of an empty list.
+        if x_edge_points.shape[0]:
+            avg_x = np.average(x_edge_points)
+            avg_y = np.average(y_edge_points)
+        else:
+            avg_x = np.average(x_abbr)
+            avg_y = np.average(y_abbr)
+
+        # Reduce the number of horizon points to improve performance.
+        step_size = x_original.shape[0]//MAXIMUM_NUMBER_OF_POINTS
+        if step_size > 1:
+            x_abbr = x_abbr[::step_size]
+            y_abbr = y_abbr[::step_size]
+
+        # Filter out points that don't lie on an edge.
+        # Only the neighbourhoods of the points are checked, all points at once.
+        border = 2 * (EDGE_RADIUS + 1)
+        padded = self.buffers.get('padded', (mask.shape[0] + border, mask.shape[1] + border))
+        is_on_edge = _is_near_edge(preprocessed['bgr2gray'], x_abbr, y_abbr, padded)
+
+        return x_abbr, y_abbr, is_on_edge, avg_x, avg_y
+
+class HoughBackend(DetectorBackend):
+    """
+    Finds the edges of the Otsu sky/ground mask and fits the horizon with a Hough transform
+    of the edge points, which picks the straight line that the most edge points agree on.
+    """
+    def preprocess(self, image: np.ndarray, otsu_thresh: float = None) -> dict:
+        preprocessed = super().preprocess(image, otsu_thresh)
+        # the mask is binary, so any thresholds will find its edges
+        edges = self.buffers.get('edges', preprocessed['mask'].shape)
+        preprocessed['edges'] = cv2.Canny(image=preprocessed['mask'], threshold1=100, threshold2=200, edges=edges)
+        return preprocessed
+
+    def extract_boundary(self, preprocessed: dict) -> tuple:
+        mask = preprocessed['mask']
+        avg_x, avg_y = _sky_centroid(mask)
+        if avg_x is None:
+            return _no_points()
+
+        # leave out the edge points on the border of the image
+        edges = preprocessed['edges'][1:-1, 1:-1]
+        y, x = np.nonzero(edges)
+        x += 1
+        y += 1
+
+        # Reduce the number of horizon points to improve performance.
+        step_size = x.shape[0]//MAXIMUM_NUMBER_OF_POINTS
+        if step_size > 1:
+            x = x[::step_size]
+            y = y[::step_size]
+
+        return x, y, np.ones(x.shape[0], dtype=bool), avg_x, avg_y
+
+    def fit(self, x: np.ndarray, y: np.ndarray, inlier_thresh: float) -> tuple:
+        # Each point votes for all the lines through it, as (theta, rho) with
+        # x * cos(theta) + y * sin(theta) = rho. All votes are cast at once.
+        thetas = np.arange(0, pi, HOUGH_THETA_STEP)
+        rhos = np.outer(x, np.cos(thetas)) + np.outer(y, np.sin(thetas))
+        max_rho = int(np.ceil(np.hypot(x.max(), y.max()) / HOUGH_RHO_STEP))
+        rho_indices = np.round(rhos / HOUGH_RHO_STEP).astype(int) + max_rho
+        number_of_rhos = 2 * max_rho + 1
+        votes = np.bincount((np.arange(thetas.shape[0]) * number_of_rhos + rho_indices).ravel(),
+                            minlength=thetas.shape[0] * number_of_rhos)
+
+        # the line with the most votes
+        best = np.argmax(votes)
+        theta = thetas[best // number_of_rhos]
+        rho = (best % number_of_rhos - max_rho) * HOUGH_RHO_STEP
+
+        # refine the line with a least squares fit of the points close to it
+        is_inlier = np.abs(x * np.cos(theta) + y * np.sin(theta) - rho) < inlier_thresh
+        if np.count_nonzero(is_inlier) < 2:
+            is_inlier[:] = True
+        m, b = np.polyfit(x[is_inlier], y[is_inlier], 1)
+        distances = distances_to_line(x, y, m, b)
+        return m, b, distances, distances < inlier_thresh
+
+class ColumnScanBackend(DetectorBackend):
+    """
+    Finds the horizon where evenly spaced columns of the Otsu sky/ground mask change
+    from sky to ground, or rows when the horizon is steep. Needs neither contours nor edges,
+    and returns the same number of points for every image of the same size, 
+    so there is nothing to sort or subsample.
+    """
+    def extract_boundary(self, preprocessed: dict) -> tuple:
+        mask = preprocessed['mask']
+
+        # A horizon that is less steep than 45 degrees crosses every column. Otherwise,
+        # the rows are scanned as well, and whichever crosses the horizon more often is used.
+        x, y, has_change, avg_x, avg_y = _scan_lines(mask)
+        if not has_change.all():
+            row_y, row_x, row_has_change, row_avg_y, row_avg_x = _scan_lines(mask.T)
+            if np.count_nonzero(row_has_change) > np.count_nonzero(has_change):
+                x, y, has_change, avg_x, avg_y = row_x, row_y, row_has_change, row_avg_x, row_avg_y
+
+        if avg_x is None:
+            return _no_points()
+        return x, y, has_change, avg_x, avg_y
+
+def _scan_lines(mask: np.ndarray) -> tuple:
+    """
+    Finds the first change between sky and ground in evenly spaced columns of the mask.
+    Pass mask.T to scan rows instead. The columns on the border of the image are left out.
+
+    Returns the index of each column, the position of the change within the column, 
+    whether the column changes between sky and ground at all and the average position
+    (column index, position within the column) of the ends of the columns that are sky.
+    The boundary lies between the last pixel before the change and the first pixel after it.
+    If neither end of any column is sky, the average position is (None, None).
+    """
+    step_size = -(-(mask.shape[1] - 2) // NUMBER_OF_SCAN_LINES) # rounded up
+    lines = np.arange(1, mask.shape[1] - 1, step_size)
+    columns = mask[:, 1:-1:step_size]
+    changes = columns[1:] != columns[:-1]
+    positions = changes.argmax(axis=0)
+    has_change = changes[positions, np.arange(lines.shape[0])]
+
+    # Find the average position of the ends of the columns that lie in the sky.
+    # Since the sky is the part of the image on one side of a straight horizon,
+    # this position lies on the sky side of the horizon.
+    first_is_sky = columns[0] != 0
+    last_is_sky = columns[-1] != 0
+    number_of_sky_ends = np.count_nonzero(first_is_sky) + np.count_nonzero(last_is_sky)
+    if number_of_sky_ends == 0:
+        return lines, positions + .5, has_change, None, None
+    avg_line = (lines[first_is_sky].sum() + lines[last_is_sky].sum()) / number_of_sky_ends
+    avg_position = (mask.shape[0] - 1) * np.count_nonzero(last_is_sky) / number_of_sky_ends
+    return lines, positions + .5, has_change, avg_line, avg_position
+
+# the backends that can be selected
+BACKENDS = {
+    'contour': ContourBackend,
+    'hough': HoughBackend,
+    'column_scan': ColumnScanBackend,
+}
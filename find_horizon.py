@@ -2,184 +2,402 @@
 # Author: Tim Huff
 
 import cv2
-import skimage.measure
-import platform
 import numpy as np
 from numpy.linalg import norm
 from math import atan2, cos, sin, pi, degrees, radians
 from draw_display import draw_horizon
+from line_fitting import distances_to_line, FITTERS
+from horizon_tracker import HorizonTracker
+from detector_backends import BACKENDS
+from buffer_arena import BufferArena
 
 # constants
 FULL_ROTATION = 360
-OPERATING_SYSTEM = platform.system()
-POOLING_KERNEL_SIZE = 5
+# extra pixels above and below the exclusion band when detecting within the band,
+# so that the bilateral filter and Canny have some context at the border of the band
+BAND_MARGIN = 3
+# methods to predict the next horizon, see HorizonDetector
+PREDICTORS = ('linear', 'kalman')
+# minimum number of horizon points needed to fit a horizon
+MINIMUM_NUMBER_OF_POINTS = 12
+# Robust line fitters treat points further from the line than this multiple 
+# of the acceptable variance as outliers.
+INLIER_THRESH_FACTOR = 2
+# size of the thumbnails that are compared to decide if the view has changed
+MOTION_THUMBNAIL_SIZE = (16, 16)
+# maximum number of frames in a row that can reuse the last horizon
+MAX_SKIPPED_FRAMES = 5
+# optical flow tracking
+TRACKING_NUMBER_OF_POINTS = 24 # points along the horizon that are tracked
+TRACKING_WINDOW_SIZE = (9, 9) # size of the Lucas-Kanade search window at each pyramid level
+TRACKING_PYRAMID_LEVELS = 2
+TRACKING_MAX_ERROR = 20 # points whose patches differ by more than this (mean per pixel, 0-255) are lost
+# number of frames that find_horizons allocates results for when the number of frames is not known
+BATCH_CAPACITY = 1024
+
+def _transform_points(transform: np.ndarray, x, y) -> tuple:
+    """
+    Applies a 2x3 affine transformation to the points (x, y).
+    Works for single points as well as arrays of points.
+    """
+    x_transformed = transform[0, 0] * x + transform[0, 1] * y + transform[0, 2]
+    y_transformed = transform[1, 0] * x + transform[1, 1] * y + transform[1, 2]
+    return x_transformed, y_transformed
 
 class HorizonDetector:
-    def __init__(self, exclusion_thresh: float, fov: float, acceptable_variance: float, frame_shape: tuple):
+    def __init__(self, exclusion_thresh: float, fov: float, acceptable_variance: float, frame_shape: tuple,
+                    band_detection: bool = False, band_refresh_interval: int = 30, pyramid_resolution: tuple = None,
+                    sky_lut_bits: int = None, fitter: str = 'polyfit', predictor: str = 'linear', backend: str = 'contour',
+                    motion_thresh: float = None, tracking_interval: int = None, preprocessing_threads: int = 1):
         """
         exclusion_thresh: parameter that controls how close horizon points have to be
         to predicted horizon in order to be considered valid
         fov: field of view of the camera
         acceptable_variance: minimum acceptable variance for horizon contour points.
-        frame_shape: together with fov used to convert exclusion_thresh 
-        from a pitch angle to pixels
+        frame_shape: (width, height) of the frames, i.e. the inference resolution.
+        Together with fov used to convert exclusion_thresh from a pitch angle to pixels.
+        band_detection: if True, only the band around the predicted horizon is processed
+        while the horizon is locked on. The whole frame is processed when the lock is lost.
+        band_refresh_interval: number of consecutive band detections after which the whole
+        frame is processed again, in order to refresh the Otsu threshold.
+        pyramid_resolution: if provided, e.g. (32, 32), a rough horizon is first found in a copy of
+        the frame scaled down to this resolution. The horizon is then refined within the band 
+        around the rough horizon at full resolution.
+        sky_lut_bits: if provided, the sky is filtered with a lookup table indexed by this number
+        of bits per color channel (1-8), instead of converting each frame to HSV.
+        fitter: method used to fit the horizon to the points, see line_fitting.FITTERS.
+        The robust methods ('ransac', 'irls') leave outliers out of the fit and the variance.
+        predictor: method used to predict the next horizon. 'linear' extrapolates from the last
+        two good horizons. 'kalman' tracks the horizon with a Kalman filter, which rides out short
+        dropouts and narrows the exclusion threshold (down to half) when the prediction is confident.
+        backend: method used to find the horizon points and fit the horizon, see detector_backends.BACKENDS.
+        'contour' follows the largest contour of the sky/ground mask, 'hough' finds the line through the
+        most edges of the mask and 'column_scan' finds where each column of the mask changes from sky to ground.
+        motion_thresh: if provided, frames that differ from the frame of the last good horizon by less than
+        this (the mean absolute difference of small thumbnails, in levels of 0-255) skip detection
+        and reuse the last horizon.
+        tracking_interval: if provided, after a good horizon is detected, points along the horizon are 
+        tracked with optical flow for up to this many frames, instead of running detection in each frame.
+        The horizon is detected again as soon as the tracked horizon is no longer good.
+        preprocessing_threads: number of threads that preprocess horizontal strips of the frame in parallel
         """
+        # check the names of the methods up front, e.g. for typos in the settings
+        if fitter not in FITTERS:
+            raise ValueError(f'Unknown fitter {fitter}. Choose from {FITTERS}.')
+        if predictor not in PREDICTORS:
+            raise ValueError(f'Unknown predictor {predictor}. Choose from {PREDICTORS}.')
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown backend {backend}. Choose from {tuple(BACKENDS)}.')
+
+        # frame_shape is given as a resolution, but is kept as (rows, columns), like frame.shape
+        self.frame_shape = (frame_shape[1], frame_shape[0])
         self.exclusion_thresh = exclusion_thresh # in degrees of pitch
-        self.exclusion_thresh_pixels = exclusion_thresh * frame_shape[0] // fov
+        self.exclusion_thresh_pixels = exclusion_thresh * self.frame_shape[0] // fov
         self.fov = fov
         self.acceptable_variance = acceptable_variance
         self.predicted_roll = None
         self.predicted_pitch = None
         self.recent_horizons = [None, None]
 
+        # How close horizon points have to be to the predicted horizon.
+        # Starts out as exclusion_thresh, but is adapted by the Kalman predictor.
+        self.predicted_exclusion_thresh = self.exclusion_thresh
+        self.predicted_exclusion_thresh_pixels = self.exclusion_thresh_pixels
+        self.tracker = None
+        if predictor == 'kalman':
+            self.tracker = HorizonTracker(fov, self.frame_shape, exclusion_thresh, exclusion_thresh / 2)
+
+        # band detection
+        self.band_detection = band_detection
+        self.band_refresh_interval = band_refresh_interval
+        self.band_detections_in_a_row = 0
+        self.otsu_thresh = None # Otsu threshold from the last full-frame detection
+
+        # coarse-to-fine detection
+        self.pyramid_resolution = None
+        if pyramid_resolution is not None:
+            self.pyramid_resolution = tuple(pyramid_resolution) # may be a list when loaded from json
+
+        # the backend that finds the horizon points and fits the horizon
+        self.rng = np.random.default_rng(0) # seeded, so that results can be reproduced
+        # the images of each frame are written to the same preallocated buffers
+        self.buffers = BufferArena(frame_shape[0] * frame_shape[1])
+        self.backend = BACKENDS[backend](sky_lut_bits, fitter, self.rng, self.buffers, preprocessing_threads)
+
+        # motion-gated frame skipping
+        self.motion_thresh = motion_thresh
+        self.reference_thumbnail = None # thumbnail of the frame of the last good horizon
+        self.last_output = None # output of the last detection
+        self.frame_skipped = False # whether the last frame reused the last horizon
+        self.skipped_frames_in_a_row = 0
+        self.number_of_frames = 0
+        self.number_of_skipped_frames = 0
+
+        # optical flow tracking
+        self.tracking_interval = tracking_interval
+        self.horizon_points = None # x, y of the points of the last detected horizon and a point on the sky side
+        self.tracking_points = None # (N, 1, 2) points along the horizon in tracking_greyscale
+        self.tracking_sky_point = None # a point on the sky side of the tracked horizon
+        self.tracking_greyscale = None # greyscale image of the last frame
+        self.tracking_buffer_index = 0 # greyscale images alternate between two buffers
+        self.tracking_mask = None # mask of the detection that tracking started from
+        self.tracked_frames_in_a_row = 0
+        self.frame_tracked = False # whether the horizon of the last frame was tracked instead of detected
+
+    def set_frame_shape(self, frame_shape: tuple, bilateral_diameter: int = None):
+        """
+        Switches to frames of a different shape, e.g. when the inference resolution changes.
+        Converts the exclusion thresholds to pixels of the new frame shape.
+        frame_shape: (width, height) of the frames, like in __init__
+        bilateral_diameter: if provided, also switches the bilateral filter of the backend to this diameter
+        """
+        if bilateral_diameter is not None:
+            self.backend.bilateral_diameter = bilateral_diameter
+        self.frame_shape = (frame_shape[1], frame_shape[0])
+        self.exclusion_thresh_pixels = self.exclusion_thresh * self.frame_shape[0] // self.fov
+        self.predicted_exclusion_thresh_pixels = self.predicted_exclusion_thresh * self.frame_shape[0] / self.fov
+        if self.tracker is not None:
+            self.tracker.frame_shape = self.frame_shape
+        # The tracked points and images are of the old frame shape,
+        # so the next frame runs a full detection.
+        self.tracking_points = None
+        self.tracking_greyscale = None
+        self.tracking_mask = None
+        self.tracked_frames_in_a_row = 0
+        self.reference_thumbnail = None
+
+    @property
+    def skip_rate(self) -> float:
+        """
+        Fraction of the frames so far that reused the last horizon instead of running detection.
+        """
+        if self.number_of_frames == 0:
+            return 0
+        return self.number_of_skipped_frames / self.number_of_frames
+
     def find_horizon(self, frame:np.ndarray, diagnostic_mode:bool=False):
         """
         frame: the image in which you want to find the horizon
         diagnostic_mode: if True, draws a diagnostic visualization. Should only be used for
         testing, as it slows down performance.
+        Outside of diagnostic mode, the returned mask is overwritten by the next call.
+        If motion_thresh is set, frame_skipped tells if the horizon was reused from the last frame.
+        """
+        return self._find_horizon(frame, diagnostic_mode)
+
+    def find_horizons(self, frames, diagnostic_mode: bool = False, on_frame = None) -> tuple:
+        """
+        Finds the horizon in a batch of frames, e.g. when reprocessing a recording.
+        frames: either an (N,H,W,3) array or an iterator of frames, already cropped and
+        scaled to the inference resolution. The frames are processed in order, so the
+        predicted horizon carries over from one frame to the next just as it does
+        when find_horizon is called one frame at a time. Iterators are consumed lazily,
+        so a long recording never has to be held in memory all at once.
+        diagnostic_mode: see find_horizon
+        on_frame: if provided, called after each frame with the frame number followed by the values
+        that find_horizon returns for the frame, e.g. to draw the frame.
+
+        Returns roll, pitch, variance and is_good_horizon as NumPy arrays of length N.
+        Frames without a horizon have NaN for roll, pitch and variance
+        and False for is_good_horizon.
+        """
+        # The results are written straight into preallocated rows of roll, pitch, variance
+        # and is_good_horizon. The number of frames of an iterator is not known up front,
+        # so its results grow by doubling.
+        capacity = len(frames) if hasattr(frames, '__len__') else BATCH_CAPACITY
+        results = np.full((4, capacity), np.nan)
+        number_of_frames = 0
+        for frame in frames:
+            if number_of_frames == results.shape[1]:
+                results = np.concatenate((results, np.full_like(results, np.nan)), axis=1)
+            output = self._find_horizon(frame, diagnostic_mode)
+            roll, pitch, variance, is_good_horizon, _ = output
+            if roll is not None:
+                results[:3, number_of_frames] = roll, pitch, variance
+            results[3, number_of_frames] = is_good_horizon == 1
+            if on_frame is not None:
+                on_frame(number_of_frames, *output)
+            number_of_frames += 1
+
+        rolls, pitches, variances, is_good_horizons = results[:, :number_of_frames]
+        return rolls, pitches, variances, is_good_horizons == 1
+
+    def _find_horizon(self, frame: np.ndarray, diagnostic_mode: bool = False) -> tuple:
+        """
+        Finds the horizon in a single frame, for find_horizon and find_horizons.
+        """
+        self.number_of_frames += 1
+        self.frame_skipped = False
+        if self.motion_thresh is None:
+            return self._track_or_detect_horizon(frame, diagnostic_mode)
+
+        # compare a thumbnail of the frame to the one of the last good horizon
+        thumbnail = cv2.resize(frame, MOTION_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+        if self.reference_thumbnail is not None and self.skipped_frames_in_a_row < MAX_SKIPPED_FRAMES:
+            motion = cv2.norm(thumbnail, self.reference_thumbnail, cv2.NORM_L1) / thumbnail.size
+            if motion < self.motion_thresh:
+                return self._reuse_horizon()
+
+        self.skipped_frames_in_a_row = 0
+        output = self._track_or_detect_horizon(frame, diagnostic_mode)
+        self.last_output = output
+        is_good_horizon = output[3]
+        self.reference_thumbnail = thumbnail if is_good_horizon else None
+        return output
+
+    def _reuse_horizon(self) -> tuple:
+        """
+        Reuses the last horizon for a frame in which the view has barely changed.
+        The predicted horizon is left as it is, so the next detection searches 
+        around the same horizon as it would have in this frame.
+        """
+        self.frame_skipped = True
+        self.skipped_frames_in_a_row += 1
+        self.number_of_skipped_frames += 1
+        return self.last_output
+
+    def _track_or_detect_horizon(self, frame: np.ndarray, diagnostic_mode: bool = False) -> tuple:
+        """
+        Tracks the horizon from the last frame with optical flow, if tracking is enabled and the
+        tracked horizon is still good. Otherwise, runs the full detection pipeline on the frame.
+        """
+        self.frame_tracked = False
+        if self.tracking_interval is None:
+            return self._detect_horizon(frame, diagnostic_mode)
+
+        # write the greyscale image to the buffer that does not hold the one of the last frame
+        self.tracking_buffer_index = 1 - self.tracking_buffer_index
+        greyscale = self.buffers.get(f'tracking_greyscale_{self.tracking_buffer_index}', frame.shape[:2])
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=greyscale)
+
+        if self.tracking_points is not None and self.tracked_frames_in_a_row < self.tracking_interval:
+            output = self._track_horizon(greyscale)
+            if output is not None:
+                self.frame_tracked = True
+                self.tracked_frames_in_a_row += 1
+                self.tracking_greyscale = greyscale
+                return output
+
+        # detect the horizon, and start tracking it if it is good
+        self.tracked_frames_in_a_row = 0
+        output = self._detect_horizon(frame, diagnostic_mode)
+        self.tracking_points = None
+        is_good_horizon = output[3]
+        if is_good_horizon:
+            x, y, sky_x, sky_y = self.horizon_points
+            step_size = max(x.shape[0] // TRACKING_NUMBER_OF_POINTS, 1)
+            points = np.column_stack((x[::step_size], y[::step_size]))
+            self.tracking_points = points.astype(np.float32).reshape(-1, 1, 2)
+            self.tracking_sky_point = np.array([sky_x, sky_y], dtype=np.float32)
+            self.tracking_greyscale = greyscale
+            self.tracking_mask = output[4]
+        return output
+
+    def _track_horizon(self, greyscale: np.ndarray) -> tuple:
+        """
+        Tracks the points along the horizon from the last frame into greyscale with pyramidal 
+        Lucas-Kanade optical flow, and fits the horizon to the tracked points.
+        Returns the same values as find_horizon (with the mask of the last detection),
+        or None if too few points could be tracked or the tracked horizon is not good.
+        """
+        points, status, error = cv2.calcOpticalFlowPyrLK(self.tracking_greyscale, greyscale, self.tracking_points, None,
+                                                            winSize=TRACKING_WINDOW_SIZE, maxLevel=TRACKING_PYRAMID_LEVELS)
+        x = points[:, 0, 0]
+        y = points[:, 0, 1]
+        is_tracked = (status[:, 0] == 1) & (error[:, 0] < TRACKING_MAX_ERROR) & \
+                        (x > 0) & (x < greyscale.shape[1] - 1) & (y > 0) & (y < greyscale.shape[0] - 1)
+        if np.count_nonzero(is_tracked) < MINIMUM_NUMBER_OF_POINTS:
+            return None
+
+        # Move the point on the sky side along with the horizon. Since points slide freely along
+        # the horizon, only the median motion of the points is used.
+        flow = points[is_tracked, 0] - self.tracking_points[is_tracked, 0]
+        sky_x, sky_y = self.tracking_sky_point + np.median(flow, axis=0)
+
+        fit = self._fit_horizon(x[is_tracked], y[is_tracked], sky_x, sky_y, greyscale.shape)
+        if fit is None:
+            return None
+        roll, pitch, variance = fit
+        if variance >= self.acceptable_variance:
+            return None
+
+        # keep tracking the points that were found in this frame
+        self.tracking_points = np.ascontiguousarray(points[is_tracked])
+        self.tracking_sky_point = np.array([sky_x, sky_y], dtype=np.float32)
+        is_good_horizon = 1
+        self._predict_next_horizon(roll, pitch, is_good_horizon)
+        return roll, pitch, variance, is_good_horizon, self.tracking_mask
+
+    def _detect_horizon(self, frame:np.ndarray, diagnostic_mode:bool=False):
+        """
+        Runs the full detection pipeline on the frame. See find_horizon.
         """
         # default values to return if no horizon can be found
         roll, pitch, variance, is_good_horizon = None, None, None, None
+        self.horizon_points = None
+
+        # When locked on to the horizon, only process the band around the predicted horizon.
+        # Otherwise, in pyramid mode, process the band around a rough horizon found in a
+        # scaled down copy of the frame. If neither is available, process the whole frame.
+        # The guide is the horizon to search around, together with how close to it (in pixels)
+        # horizon points have to be.
+        guide = None
+        if self._band_is_usable():
+            guide = (self.predicted_roll, self.predicted_pitch, self.predicted_exclusion_thresh_pixels)
+            self.band_detections_in_a_row += 1
+        else:
+            self.band_detections_in_a_row = 0
+            if self.pyramid_resolution is not None:
+                guide = self._find_coarse_horizon(frame)
+
+        # The band is rotated to be level and cut out of the frame, so that the 
+        # preprocessing only touches the pixels in the band.
+        band_transform = None
+        if guide is not None:
+            band_transform, band_size = self._get_band_transform(frame.shape, *guide)
+            band = self.buffers.get('band', (band_size[1], band_size[0], frame.shape[2]))
+            image = cv2.warpAffine(frame, band_transform, band_size, dst=band,
+                                    flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+            # Within the band, reuse the Otsu threshold of the last full image, since the band 
+            # alone does not contain enough sky and ground for Otsu to find a good threshold.
+            points = self._find_horizon_points(image, self.otsu_thresh)
+        else:
+            points = self._find_horizon_points(frame)
+        x_abbr, y_abbr, is_valid, avg_x, avg_y, mask, edges, blue_filtered_greyscale = points
 
-        # get greyscale
-        bgr2gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-        # filter our blue from the sky
-        lower = np.array([109, 0, 116]) 
-        upper = np.array([153, 255, 255]) 
-        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-        hsv_mask = cv2.inRange(hsv, lower, upper)
-        blue_filtered_greyscale = cv2.add(bgr2gray, hsv_mask)
-
-        # generate mask
-        blur = cv2.bilateralFilter(blue_filtered_greyscale,9,50,50)
-        _, mask = cv2.threshold(blur,250,255,cv2.THRESH_OTSU)
-        edges = cv2.Canny(image=bgr2gray, threshold1=200, threshold2=250) 
-        edges = skimage.measure.block_reduce(edges, (POOLING_KERNEL_SIZE , POOLING_KERNEL_SIZE), np.max)
-
-        # find contours
-        # chain = cv2.CHAIN_APPROX_SIMPLE
-        chain = cv2.CHAIN_APPROX_NONE 
-        if OPERATING_SYSTEM == "Linux": # for raspberry pi
-            _, contours, _ = cv2.findContours(mask, cv2.RETR_TREE, chain) 
-        else: # for windows
-            contours, _ = cv2.findContours(mask, cv2.RETR_TREE, chain)
-
-        # If there weren't any contours found (i.e. the image was all black),
+        # If there weren't any horizon points found (e.g. the image was all black),
         # end early, returning None values and the mask.
-        if len(contours) == 0:
+        if avg_x is None:
             # predict the next horizon
             self._predict_next_horizon()
 
             # convert the diagnostic image to color
             if diagnostic_mode:
+                if band_transform is not None:
+                    mask = cv2.warpAffine(mask, band_transform, frame.shape[1::-1])
                 mask = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
             return roll, pitch, variance, is_good_horizon, mask
 
-        # find the contour with the largest area
-        largest_contour = sorted(contours, key=cv2.contourArea, reverse=True)[0] 
-
-        # extract x and y values from contour
-        x_original = np.array([i[0][0] for i in largest_contour])
-        y_original = np.array([i[0][1] for i in largest_contour])
-
-        # Separate the points that lie on the edge of the frame from all other points.
-        # Edge points will be used to find sky_is_up.
-        # All other points will be used to find the horizon.
-        x_abbr = []
-        y_abbr = []
-        x_edge_points = []
-        y_edge_points = []
-        for n, x_point in enumerate(x_original):
-            y_point = y_original[n]
-            if x_point == 0 or x_point == frame.shape[1] - 1 or \
-                y_point == 0 or y_point == frame.shape[0]- 1:
-                x_edge_points.append(x_point)
-                y_edge_points.append(y_point)
-            else:
-                x_abbr.append(x_point)
-                y_abbr.append(y_point)
-
-        # Find the average position of the edge points.
-        # This will help determine the direction of the sky.
-        # Reduce the number of edge points to improve performance.
-        maximum_number_of_points = 20
-        step_size = len(x_edge_points)//maximum_number_of_points
-        if step_size > 1:
-            x_edge_points = x_edge_points[::step_size]
-            y_edge_points = y_edge_points[::step_size]
-        
-        # Check if there are any edge points. If there are, take the average of them to determine
-        # sky_is_up. If there aren't any edge points, take the average of the abbreviated point list
-        # instead, since it is not possible to take the average of an empty list.
-        if x_edge_points:
-            avg_x = np.average(x_edge_points)
-            avg_y = np.average(y_edge_points)
-        else:
-            avg_x = np.average(x_abbr)
-            avg_y = np.average(y_abbr)
-
-        # Reduce the number of horizon points to improve performance.
-        maximum_number_of_points = 100
-        step_size = len(x_original)//maximum_number_of_points
-        if step_size > 1:
-            x_abbr = x_abbr[::step_size]
-            y_abbr = y_abbr[::step_size]  
-
-        # define some values for checking distance to previous horizon
-        if self.predicted_roll is not None:
-            # convert predicted_roll to radians
-            predicted_roll_radians = radians(self.predicted_roll)
-
-            # find the distance 
-            distance = self.predicted_pitch / self.fov * frame.shape[0]
-
-            # define the line perpendicular to horizon
-            angle_perp = predicted_roll_radians + pi / 2
-            x_perp = distance * cos(angle_perp) + frame.shape[1]/2
-            y_perp = distance * sin(angle_perp) + frame.shape[0]/2
-
-            # convert from roll and pitch of predicted horizon to m and b
-            run = cos(predicted_roll_radians)
-            rise = sin(predicted_roll_radians) 
-            if run != 0:
-                predicted_m = rise / run
-                predicted_b = y_perp - predicted_m * x_perp            
-
-            # define two points on the line from the previous horizon
-            p1 = np.array([0, predicted_b])
-            p2 = np.array([frame.shape[1], predicted_m * frame.shape[1] + predicted_b])
-            p2_minus_p1 = p2 - p1 
-
-        # Initialize some lists to contain the new (filtered) x and y values.
-        x_filtered = []
-        y_filtered = []
-        # Filter out points that don't lie on an edge.
-        for idx, x_point in enumerate(x_abbr):
-            y_point = y_abbr[idx]
-
-            # evaluate if the point exists on an edge
-            if edges[y_point//POOLING_KERNEL_SIZE][x_point//POOLING_KERNEL_SIZE] == 0:
-                continue # do not append the point
-
-            # If there is no predicted horizon, perform no further
-            # filtering on this point and accept it as valid.
-            if self.predicted_roll is None:
-                x_filtered.append(x_point)
-                y_filtered.append(y_point)
-                continue 
-
-            # If there is a predicted horizon, check if the current point
-            # is reasonably close to it.
-            p3 = np.array([x_point, y_point])
-            distance = norm(np.cross(p2_minus_p1, p1-p3))/norm(p2_minus_p1)
-            if distance < self.exclusion_thresh_pixels:
-                x_filtered.append(x_point)
-                y_filtered.append(y_point)
-
-        # convert to numpy array
-        x_filtered = np.array(x_filtered)
-        y_filtered = np.array(y_filtered)
+        # If the points were found within the band, convert them to the coordinates
+        # of the frame and filter out the points that lie outside of the frame.
+        if band_transform is not None:
+            avg_x, avg_y = _transform_points(band_transform, avg_x, avg_y)
+            x_abbr, y_abbr = _transform_points(band_transform, x_abbr, y_abbr)
+            is_valid &= (x_abbr > 0) & (x_abbr < frame.shape[1] - 1) & \
+                        (y_abbr > 0) & (y_abbr < frame.shape[0] - 1)
+
+        # Filter out the points that are not reasonably close to the horizon that 
+        # was searched around, or else to the predicted horizon, if there is one.
+        if guide is None and self.predicted_roll is not None:
+            guide = (self.predicted_roll, self.predicted_pitch, self.predicted_exclusion_thresh_pixels)
+        if guide is not None:
+            guide_roll, guide_pitch, guide_thresh_pixels = guide
+            guide_m, guide_b = self._get_line(guide_roll, guide_pitch, frame.shape)
+            distances = distances_to_line(x_abbr, y_abbr, guide_m, guide_b)
+            is_valid &= distances < guide_thresh_pixels
+
+        x_filtered = x_abbr[is_valid]
+        y_filtered = y_abbr[is_valid]
 
         # Draw the diagnostic information.
         # Only use for diagnostics, as this slows down inferences. 
@@ -189,6 +407,10 @@ class HorizonDetector:
             scale_factor = desired_height / frame.shape[0]
             desired_width = int(np.round(frame.shape[1] * scale_factor))
             desired_dimensions = (desired_width, desired_height)
+            # put the band back in its place within the frame
+            if band_transform is not None:
+                mask = cv2.warpAffine(mask, band_transform, frame.shape[1::-1])
+                blue_filtered_greyscale = cv2.warpAffine(blue_filtered_greyscale, band_transform, frame.shape[1::-1])
             mask = cv2.resize(mask, desired_dimensions)
             # convert the diagnostic image to color
             mask = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
@@ -205,28 +427,79 @@ class HorizonDetector:
                 cv2.circle(mask, (circle_x, circle_y), 5, (0,255,0), -1)
             # draw the predicted horizon, if there is one
             if self.predicted_roll:
-                lower_pitch = self.predicted_pitch + self.exclusion_thresh
+                lower_pitch = self.predicted_pitch + self.predicted_exclusion_thresh
                 draw_horizon(mask, self.predicted_roll, lower_pitch, self.fov, (0,150,255),  False)
-                upper_pitch = self.predicted_pitch - self.exclusion_thresh
+                upper_pitch = self.predicted_pitch - self.predicted_exclusion_thresh
                 draw_horizon(mask, self.predicted_roll, upper_pitch, self.fov, (0,150,255),  False)
                 cv2.putText(mask, 'Horizon Lock',(20,40),cv2.FONT_HERSHEY_COMPLEX_SMALL,1,(0,150,255),1,cv2.LINE_AA)
 
             # for testing
-            _, edges_binary = cv2.threshold(edges,10,255,cv2.THRESH_BINARY)
-            edges_binary = cv2.resize(edges_binary, desired_dimensions)
-            cv2.imshow('canny', edges_binary)
+            if edges is not None: # not every backend uses edges
+                _, edges_binary = cv2.threshold(edges,10,255,cv2.THRESH_BINARY)
+                edges_binary = cv2.resize(edges_binary, desired_dimensions)
+                cv2.imshow('canny', edges_binary)
             blue_filtered_greyscale = cv2.resize(blue_filtered_greyscale, desired_dimensions)
             cv2.imshow('blue_filtered_greyscale', blue_filtered_greyscale)
             mask = cv2.resize(mask, desired_dimensions)
             cv2.imshow('mask', mask)
                 
         # Return None values for horizon, since too few points were found.
-        if x_filtered.shape[0] < 12:
+        if x_filtered.shape[0] < MINIMUM_NUMBER_OF_POINTS:
             self._predict_next_horizon()
             return roll, pitch, variance, is_good_horizon, mask
 
-        # polyfit
-        m, b = np.polyfit(x_filtered, y_filtered, 1)
+        # fit the horizon to the points
+        fit = self._fit_horizon(x_filtered, y_filtered, avg_x, avg_y, frame.shape)
+        if fit is None:
+            self._predict_next_horizon()
+            return roll, pitch, variance, is_good_horizon, mask
+        roll, pitch, variance = fit
+
+        # determine if the horizon is acceptable
+        if variance < self.acceptable_variance: 
+            is_good_horizon = 1
+        else:
+            is_good_horizon = 0
+
+        # predict the approximate position of the next horizon
+        self._predict_next_horizon(roll, pitch, is_good_horizon)
+
+        # keep the points of the horizon, e.g. for tracking them into the next frame
+        self.horizon_points = (x_filtered, y_filtered, avg_x, avg_y)
+
+        # return the calculated values for horizon
+        return roll, pitch, variance, is_good_horizon, mask
+
+    def _find_horizon_points(self, image: np.ndarray, otsu_thresh: float = None) -> tuple:
+        """
+        Finds the candidate horizon points in the image with the backend.
+        image: the image to search, either the whole frame or a band cut out of it
+        otsu_thresh: threshold for generating the mask. If None, the threshold is found 
+        with Otsu's method and saved for later detections.
+
+        Returns x and y of the points, whether each point is valid, a point on the sky side 
+        of the horizon (used to find the direction of the sky) and the mask, edges and 
+        blue filtered greyscale images for diagnostics. If no horizon points were found,
+        the point on the sky side is None.
+        """
+        preprocessed = self.backend.preprocess(image, otsu_thresh)
+        if otsu_thresh is None:
+            self.otsu_thresh = preprocessed['otsu_thresh']
+        x, y, is_valid, avg_x, avg_y = self.backend.extract_boundary(preprocessed)
+        return x, y, is_valid, avg_x, avg_y, preprocessed['mask'], preprocessed['edges'], preprocessed['blue_filtered_greyscale']
+
+    def _fit_horizon(self, x: np.ndarray, y: np.ndarray, avg_x: float, avg_y: float, frame_shape: tuple) -> tuple:
+        """
+        Fits a horizon to the points (x, y) within a frame of frame_shape.
+        avg_x, avg_y: a point on the sky side of the horizon,
+        used to determine the direction of the sky
+        Returns roll, pitch and variance, or None if too few of the points fit the horizon.
+        """
+        # fit a line to the points
+        inlier_thresh = self.acceptable_variance / 100 * frame_shape[0] * INLIER_THRESH_FACTOR
+        m, b, distances, is_inlier = self.backend.fit(x, y, inlier_thresh)
+        if np.count_nonzero(is_inlier) < MINIMUM_NUMBER_OF_POINTS:
+            return None
         roll = atan2(m,1)
         roll = degrees(roll)
 
@@ -241,51 +514,129 @@ class HorizonDetector:
         # based on field of view of the camera and the height of the image.
         # Define two points along horizon.
         p1 = np.array([0, b])
-        p2 = np.array([frame.shape[1], m * frame.shape[1] + b])
+        p2 = np.array([frame_shape[1], m * frame_shape[1] + b])
         # Center of the image
-        p3 = np.array([frame.shape[1]//2, frame.shape[0]//2])
+        p3 = np.array([frame_shape[1]//2, frame_shape[0]//2])
         # Find distance to horizon
         distance_to_horizon = norm(np.cross(p2-p1, p1-p3))/norm(p2-p1)
         # Find out if plane is pointing above or below horizon
-        if p3[1] < m * frame.shape[1]//2 + b and sky_is_up:
+        if p3[1] < m * frame_shape[1]//2 + b and sky_is_up:
             plane_pointing_up = 1
-        elif p3[1] > m *frame.shape[1]//2 + b and sky_is_up == False:
+        elif p3[1] > m *frame_shape[1]//2 + b and sky_is_up == False:
             plane_pointing_up = 1
         else:
             plane_pointing_up = 0
-        pitch = distance_to_horizon / frame.shape[0] * self.fov
+        pitch = distance_to_horizon / frame_shape[0] * self.fov
         if not plane_pointing_up:
             pitch *= -1
 
         # FIND VARIANCE 
         # This will be treated as a confidence score.
-        p1 = np.array([0, b])
-        p2 = np.array([frame.shape[1], m * frame.shape[1] + b])
-        p2_minus_p1 = p2 - p1
-        distance_list = []
-        for n, x_point in enumerate(x_filtered):
-            y_point = y_filtered[n]
-            p3 = np.array([x_point, y_point])
-            distance = norm(np.cross(p2_minus_p1, p1-p3))/norm(p2_minus_p1)
-            distance_list.append(distance)
-            
-        variance = np.average(distance_list) / frame.shape[0] * 100
+        # Outliers that were left out of the fit are also left out of the variance.
+        variance = self.backend.score(distances, is_inlier, frame_shape[0])
         
         # adjust the roll within the range of 0 - 360 degrees
         roll = self._adjust_roll(roll, sky_is_up) 
 
-        # determine if the horizon is acceptable
-        if variance < self.acceptable_variance: 
-            is_good_horizon = 1
-        else:
-            is_good_horizon = 0
+        return roll, pitch, variance
 
-        # predict the approximate position of the next horizon
-        self._predict_next_horizon(roll, pitch, is_good_horizon)
+    def _find_coarse_horizon(self, frame: np.ndarray) -> tuple:
+        """
+        Finds a rough horizon in a copy of the frame scaled down to pyramid_resolution.
+        Returns roll and pitch of the rough horizon, together with the exclusion threshold 
+        in pixels to search around it, or None if no horizon was found.
+        """
+        small_frame = self.buffers.get('small_frame', (self.pyramid_resolution[1], self.pyramid_resolution[0], frame.shape[2]))
+        cv2.resize(frame, self.pyramid_resolution, dst=small_frame, interpolation=cv2.INTER_AREA)
+        x, y, is_valid, avg_x, avg_y, *_ = self._find_horizon_points(small_frame)
+        if avg_x is None:
+            return None
+
+        # filter out the points that are not reasonably close to the predicted horizon
+        if self.predicted_roll is not None:
+            predicted_m, predicted_b = self._get_line(self.predicted_roll, self.predicted_pitch, small_frame.shape)
+            distances = distances_to_line(x, y, predicted_m, predicted_b)
+            is_valid &= distances < self.predicted_exclusion_thresh * small_frame.shape[0] / self.fov
+
+        if np.count_nonzero(is_valid) < MINIMUM_NUMBER_OF_POINTS:
+            return None
+        fit = self._fit_horizon(x[is_valid], y[is_valid], avg_x, avg_y, small_frame.shape)
+        if fit is None:
+            return None
+        roll, pitch, _ = fit
+        # The rough horizon is only as accurate as the scaled down frame, so
+        # search around it with the full exclusion threshold.
+        return roll, pitch, self.exclusion_thresh_pixels
+
+    def _get_line(self, roll: float, pitch: float, frame_shape: tuple) -> tuple:
+        """
+        Converts the roll and pitch of a horizon into the slope (m) and 
+        y intercept (b) of the horizon within a frame of frame_shape.
+        """
+        # convert roll to radians
+        roll_radians = radians(roll)
+
+        # find the distance 
+        distance = pitch / self.fov * frame_shape[0]
+
+        # define the line perpendicular to horizon
+        angle_perp = roll_radians + pi / 2
+        x_perp = distance * cos(angle_perp) + frame_shape[1]/2
+        y_perp = distance * sin(angle_perp) + frame_shape[0]/2
+
+        # convert from roll and pitch of the horizon to m and b
+        run = cos(roll_radians)
+        rise = sin(roll_radians) 
+        m = rise / run
+        b = y_perp - m * x_perp
+        return m, b
+
+    def _band_is_usable(self) -> bool:
+        """
+        Checks if the next detection can be limited to the band around the predicted horizon.
+        """
+        if not self.band_detection or self.predicted_roll is None or self.otsu_thresh is None:
+            return False
+        # periodically process the whole frame to refresh the Otsu threshold
+        return self.band_detections_in_a_row < self.band_refresh_interval
+
+    def _get_band_transform(self, frame_shape: tuple, roll: float, pitch: float, thresh_pixels: float) -> tuple:
+        """
+        Finds the transformation that maps the level band image onto the band
+        around the horizon (roll, pitch) within a frame of frame_shape.
+        thresh_pixels: distance from the horizon to the top and bottom of the band, 
+        not counting BAND_MARGIN
+        Returns the 2x3 affine transformation and the size (width, height) of the band image.
+        """
+        # convert roll to radians
+        roll_radians = radians(roll)
+
+        # find the point on the horizon closest to the center of the frame
+        distance = pitch / self.fov * frame_shape[0]
+        angle_perp = roll_radians + pi / 2
+        x_perp = distance * cos(angle_perp) + frame_shape[1]/2
+        y_perp = distance * sin(angle_perp) + frame_shape[0]/2
+
+        # unit vectors along and across the horizon
+        along = np.array([cos(roll_radians), sin(roll_radians)])
+        across = np.array([-along[1], along[0]])
+
+        # find how far the frame extends along the predicted horizon by
+        # projecting the corners of the frame onto the horizon
+        corners = np.array([[0, 0], [frame_shape[1], 0], [0, frame_shape[0]], [frame_shape[1], frame_shape[0]]])
+        projections = (corners - (x_perp, y_perp)) @ along
+        start = np.floor(projections.min())
+        width = int(np.ceil(projections.max()) - start)
+
+        # the height of the band covers the exclusion threshold above and below the horizon
+        half_height = int(np.ceil(thresh_pixels)) + BAND_MARGIN
+        height = 2 * half_height + 1
+
+        # the origin of the band image in frame coordinates
+        origin = np.array([x_perp, y_perp]) + start * along - half_height * across
+        band_transform = np.column_stack((along, across, origin))
+        return band_transform, (width, height)
 
-        # return the calculated values for horizon
-        return roll, pitch, variance, is_good_horizon, mask
-    
     def _adjust_roll(self, roll: float, sky_is_up: bool) -> float:
         """
         Adjusts the roll to be within the range of 0-360 degrees.
@@ -308,6 +659,15 @@ class HorizonDetector:
         position of the next horizon.
         Used to filter out noise in the next iteration.
         """
+        # let the Kalman filter predict the next horizon and the exclusion threshold
+        if self.tracker is not None:
+            self.tracker.update(current_roll, current_pitch, is_good_horizon)
+            self.predicted_roll = self.tracker.predicted_roll
+            self.predicted_pitch = self.tracker.predicted_pitch
+            self.predicted_exclusion_thresh = self.tracker.exclusion_thresh
+            self.predicted_exclusion_thresh_pixels = self.predicted_exclusion_thresh * self.frame_shape[0] / self.fov
+            return
+
         # if the current horizon is not good, mark it as None
         if not is_good_horizon:
             current_horizon = None
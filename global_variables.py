@@ -17,6 +17,43 @@ settings_dict = {
     'resolution': '(640,480)',
     'acceptable_variance': 1.3,
     'exclusion_thresh': 4,       
+    # only process the band around the predicted horizon while locked on (0 or 1)
+    'band_detection': 0,
+    # resolution for finding a rough horizon before refining it, e.g. (32,32), or None to disable
+    'pyramid_resolution': None,
+    # bits per color channel of the sky filter lookup table (1-8), or None to convert frames to HSV
+    'sky_lut_bits': None,
+    # method for fitting the horizon line: polyfit, ransac or irls
+    'fitter': 'polyfit',
+    # method for predicting the next horizon: linear or kalman
+    'predictor': 'linear',
+    # method for finding the horizon: contour, hough or column_scan
+    'backend': 'contour',
+    # lowest inference resolution to step down to when detection falls behind, or None to disable
+    'min_inference_resolution': None,
+    # also reduce the bilateral filter once the lowest inference resolution is reached (0 or 1)
+    'adapt_bilateral_filter': 0,
+    # reuse the last horizon when the view changes by less than this (mean difference, 0-255), or None to disable
+    'motion_thresh': None,
+    # maximum number of frames to track the horizon with optical flow between detections, or None to disable
+    'tracking_interval': None,
+    # number of threads that preprocess strips of the frame in parallel
+    'preprocessing_threads': 1,
+    # run detection, control and rendering as overlapping stages in their own threads (0 or 1)
+    'pipelined': 0,
+    # run the horizon detection in a separate process (0 or 1)
+    'detection_process': 0,
+    # play video files back at the frame rate of the recording (1), or as fast as possible (0)
+    'paced_playback': 1,
+    # format to capture frames from the webcam in: MJPG, YUYV or NV12 to skip decoding and color conversion,
+    # or JPEG to keep the MJPG frames compressed (decoded at a reduced scale, and recorded without re-encoding)
+    'capture_format': 'MJPG',
+    # number of frames that can wait to be recorded, which bounds the memory they take up
+    'recording_queue_size': 60,
+    # what to do when recording falls behind: block the main loop, drop_oldest frame, or decimate to every Nth frame
+    'recording_drop_policy': 'drop_oldest',
+    # N for the decimate drop policy
+    'recording_decimation': 2,
     # FOV constant for Raspberry Pi Camera v2
     # for more info: https://www.raspberrypi.com/documentation/accessories/camera.html
     'fov': 48.8       
@@ -35,6 +72,24 @@ dtype_dict = {
     'resolution': eval,
     'acceptable_variance': float,
     'exclusion_thresh': float,
+    'band_detection': int,
+    'pyramid_resolution': eval,
+    'sky_lut_bits': eval,
+    'fitter': str,
+    'predictor': str,
+    'backend': str,
+    'min_inference_resolution': eval,
+    'adapt_bilateral_filter': int,
+    'motion_thresh': eval,
+    'tracking_interval': eval,
+    'preprocessing_threads': int,
+    'pipelined': int,
+    'detection_process': int,
+    'paced_playback': int,
+    'capture_format': str,
+    'recording_queue_size': int,
+    'recording_drop_policy': str,
+    'recording_decimation': int,
     'fov': float
 }
 
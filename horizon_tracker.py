@@ -0,0 +1,136 @@
+import numpy as np
+from math import tan, radians
+
+FULL_ROTATION = 360
+
+class HorizonTracker:
+    def __init__(self, fov: float, frame_shape: tuple, max_exclusion_thresh: float, min_exclusion_thresh: float,
+                    roll_noise: float = 1, pitch_noise: float = .5, roll_accel: float = 1, pitch_accel: float = .5,
+                    max_dropout: int = 5, number_of_sigmas: float = 3, gate: float = 5):
+        """
+        Tracks the roll and pitch of the horizon with a constant-velocity Kalman filter.
+        Predicts where the horizon will be in the next frame, along with how far
+        from that prediction the horizon could reasonably be (the exclusion threshold).
+
+        fov: field of view of the camera
+        frame_shape: (rows, columns) of the frames in which the horizon is detected
+        max_exclusion_thresh, min_exclusion_thresh: limits of the exclusion threshold, in degrees of pitch
+        roll_noise, pitch_noise: standard deviation of the detected roll and pitch, in degrees
+        roll_accel, pitch_accel: standard deviation of the change in roll and pitch rate
+        from one frame to the next, in degrees per frame per frame
+        max_dropout: number of frames in a row without a good horizon after which the track is lost
+        number_of_sigmas: width of the exclusion threshold in standard deviations of the prediction
+        gate: horizons further than this many standard deviations from the prediction are
+        treated like bad horizons, so that a single wrong detection cannot throw off the track
+        """
+        self.fov = fov
+        self.frame_shape = frame_shape
+        self.max_exclusion_thresh = max_exclusion_thresh
+        self.min_exclusion_thresh = min_exclusion_thresh
+        self.max_dropout = max_dropout
+        self.number_of_sigmas = number_of_sigmas
+        self.gate = gate
+
+        # measurement noise variance and process noise covariance for roll and pitch
+        self.measurement_noise = np.array([roll_noise, pitch_noise]) ** 2
+        accel = np.array([roll_accel, pitch_accel]) ** 2
+        self.process_noise = accel[:, None, None] * np.array([[.25, .5], [.5, 1]])
+
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the track, e.g. after the horizon has been lost for too long.
+        """
+        # state: one row each for roll and pitch, with the value and the rate of change per frame
+        self.state = np.zeros((2, 2))
+        # one 2x2 covariance matrix each for roll and pitch
+        self.covariance = np.zeros((2, 2, 2))
+        self.number_of_measurements = 0
+        self.frames_since_measurement = 0
+        self.predicted_roll = None
+        self.predicted_pitch = None
+        self.exclusion_thresh = self.max_exclusion_thresh
+
+    def update(self, roll: float = None, pitch: float = None, is_good_horizon: bool = None):
+        """
+        Takes the horizon found in the current frame and predicts the horizon in the next frame.
+        Bad horizons (and good ones that fall outside the gate) are ignored, and the track 
+        coasts on its last known rates until max_dropout frames have passed.
+        """
+        corrected = is_good_horizon and self._correct(roll, pitch)
+        if not corrected and self.number_of_measurements:
+            self.frames_since_measurement += 1
+            if self.frames_since_measurement > self.max_dropout:
+                self.reset()
+
+        if self.number_of_measurements == 0:
+            return
+        self._predict()
+
+        # wait for a second measurement, so that there is an estimate of the rates
+        if self.number_of_measurements < 2:
+            return
+        self.predicted_roll = self.state[0, 0] % FULL_ROTATION
+        self.predicted_pitch = self.state[1, 0]
+
+        # The horizon could be off from the prediction by an offset in pitch, or by a tilt in roll,
+        # which moves the horizon the most at the left and right sides of the frame.
+        roll_sigma, pitch_sigma = np.sqrt(self.covariance[:, 0, 0])
+        rows, columns = self.frame_shape
+        half_width = self.fov * columns / 2 / rows # in degrees of pitch
+        roll_offset = tan(radians(min(roll_sigma, 45))) * half_width
+        exclusion_thresh = self.number_of_sigmas * np.hypot(pitch_sigma, roll_offset)
+        self.exclusion_thresh = float(np.clip(exclusion_thresh, self.min_exclusion_thresh, self.max_exclusion_thresh))
+
+    def _correct(self, roll: float, pitch: float) -> bool:
+        """
+        Corrects the predicted state with the measured roll and pitch.
+        Returns False if the measurement was rejected for being too far from the prediction.
+        """
+        measurement = np.array([roll, pitch])
+
+        # initialize the track with the first measurement
+        if self.number_of_measurements == 0:
+            self.frames_since_measurement = 0
+            self.number_of_measurements = 1
+            self.state[:, 0] = measurement
+            self.state[:, 1] = 0
+            self.covariance[:] = 0
+            self.covariance[:, 0, 0] = self.measurement_noise
+            self.covariance[:, 1, 1] = self.max_exclusion_thresh ** 2 # the rates are unknown
+            return True
+
+        # the difference in roll is wrapped, so that e.g. 359 to 1 degrees is a change of 2 degrees
+        innovation = measurement - self.state[:, 0]
+        innovation[0] = (innovation[0] + FULL_ROTATION / 2) % FULL_ROTATION - FULL_ROTATION / 2
+
+        # reject measurements that are too far from the prediction
+        innovation_variance = self.covariance[:, 0, 0] + self.measurement_noise
+        if np.any(np.abs(innovation) > self.gate * np.sqrt(innovation_variance)):
+            return False
+        self.frames_since_measurement = 0
+        self.number_of_measurements += 1
+
+        # Kalman gain, for roll and pitch at once
+        gain = self.covariance[:, :, 0] / innovation_variance[:, None]
+
+        self.state += gain * innovation[:, None]
+        self.covariance -= gain[:, :, None] * self.covariance[:, None, 0, :]
+        return True
+
+    def _predict(self):
+        """
+        Moves the state forward by one frame.
+        """
+        # x = F x, with F = [[1, 1], [0, 1]]
+        self.state[:, 0] += self.state[:, 1]
+
+        # P = F P F^T + Q
+        p00, p01, p10, p11 = (self.covariance[:, i, j] for i, j in ((0, 0), (0, 1), (1, 0), (1, 1)))
+        predicted = np.empty_like(self.covariance)
+        predicted[:, 0, 0] = p00 + p01 + p10 + p11
+        predicted[:, 0, 1] = p01 + p11
+        predicted[:, 1, 0] = p10 + p11
+        predicted[:, 1, 1] = p11
+        self.covariance = predicted + self.process_noise
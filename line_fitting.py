@@ -0,0 +1,110 @@
+import numpy as np
+
+# the line fitting methods that can be selected
+FITTERS = ('polyfit', 'ransac', 'irls')
+
+# RANSAC
+RANSAC_MAX_ITERATIONS = 64 # maximum number of candidate lines
+RANSAC_BATCH_SIZE = 16 # candidate lines evaluated at once
+RANSAC_GOOD_ENOUGH = .9 # stop early once this fraction of the points are inliers
+
+# iteratively reweighted least squares
+IRLS_MAX_ITERATIONS = 10
+IRLS_TOLERANCE = 1e-3 # stop early once the line moves less than this many pixels
+
+def distances_to_line(x: np.ndarray, y: np.ndarray, m: float, b: float) -> np.ndarray:
+    """
+    Returns the perpendicular distance from each point (x, y) to the line y = m * x + b.
+    """
+    return np.abs(m * x - y + b) / np.sqrt(m * m + 1)
+
+def fit_line(x: np.ndarray, y: np.ndarray, method: str = 'polyfit', inlier_thresh: float = 2, rng=None) -> tuple:
+    """
+    Fits the line y = m * x + b to the points (x, y).
+    method: 'polyfit' for an ordinary least squares fit of all points, 'ransac' or 'irls'
+    for a fit that is robust to outliers
+    inlier_thresh: points further than this from the line (in pixels) are considered outliers
+    by the robust methods
+    rng: numpy random Generator used by 'ransac'
+
+    Returns m, b, the distance of each point to the line and a boolean array marking the inliers.
+    With 'polyfit', all points are inliers.
+    """
+    if method not in FITTERS:
+        raise ValueError(f'Unknown fitter {method}. Choose from {FITTERS}.')
+    if method == 'ransac':
+        return _fit_line_ransac(x, y, inlier_thresh, rng)
+    if method == 'irls':
+        return _fit_line_irls(x, y, inlier_thresh)
+
+    m, b = np.polyfit(x, y, 1)
+    distances = distances_to_line(x, y, m, b)
+    return m, b, distances, np.ones(x.shape[0], dtype=bool)
+
+def _fit_line_ransac(x: np.ndarray, y: np.ndarray, inlier_thresh: float, rng) -> tuple:
+    """
+    Fits a line with RANSAC. Candidate lines through random pairs of points are
+    evaluated in batches, all at once, and the search stops early as soon as one of
+    them explains RANSAC_GOOD_ENOUGH of the points. The best candidate is then refined
+    with a least squares fit of its inliers.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    number_of_points = x.shape[0]
+    best_inliers = None
+    best_count = 0
+    for _ in range(RANSAC_MAX_ITERATIONS // RANSAC_BATCH_SIZE):
+        # pick two random points for each candidate line
+        i, j = rng.integers(0, number_of_points, size=(2, RANSAC_BATCH_SIZE))
+        dx = (x[j] - x[i]).astype(float)
+        dy = (y[j] - y[i]).astype(float)
+        length = np.hypot(dx, dy)
+        length[length == 0] = np.nan # the same point was picked twice
+
+        # distance of every point to every candidate line, as a (batch, points) array
+        cross = dx[:, None] * (y[i][:, None] - y[None, :]) - dy[:, None] * (x[i][:, None] - x[None, :])
+        inliers = np.abs(cross) / length[:, None] < inlier_thresh
+        counts = inliers.sum(axis=1)
+
+        # keep the candidate with the most inliers
+        best = np.argmax(counts)
+        if counts[best] > best_count:
+            best_count = counts[best]
+            best_inliers = inliers[best]
+        if best_count >= RANSAC_GOOD_ENOUGH * number_of_points:
+            break
+
+    # fall back to all points if no candidate line was good enough to refine
+    if best_count < 2:
+        best_inliers = np.ones(number_of_points, dtype=bool)
+
+    # refine the line with the inliers
+    m, b = np.polyfit(x[best_inliers], y[best_inliers], 1)
+    distances = distances_to_line(x, y, m, b)
+    return m, b, distances, distances < inlier_thresh
+
+def _fit_line_irls(x: np.ndarray, y: np.ndarray, inlier_thresh: float) -> tuple:
+    """
+    Fits a line with iteratively reweighted least squares. Starting from an ordinary
+    least squares fit, each iteration refits the line with Tukey's biweight, so that
+    points far from the line have little or no influence. Stops early once the line
+    settles.
+    """
+    # use a Tukey cutoff that keeps the points within a few inlier thresholds
+    cutoff = 3 * inlier_thresh
+    m, b = np.polyfit(x, y, 1)
+    for _ in range(IRLS_MAX_ITERATIONS):
+        distances = distances_to_line(x, y, m, b)
+        weights = np.clip(1 - (distances / cutoff) ** 2, 0, None) ** 2
+        if np.count_nonzero(weights) < 2:
+            break
+        # np.polyfit applies its weights to the residuals, so it takes the square root
+        new_m, new_b = np.polyfit(x, y, 1, w=np.sqrt(weights))
+        # measure how far the line moved at both ends of the points
+        moved = max(abs(new_b - b + (new_m - m) * x.min()), abs(new_b - b + (new_m - m) * x.max()))
+        m, b = new_m, new_b
+        if moved < IRLS_TOLERANCE:
+            break
+
+    distances = distances_to_line(x, y, m, b)
+    return m, b, distances, distances < inlier_thresh
@@ -1,20 +1,23 @@
 # standard libraries
 import cv2
-import os
-import shutil
 import platform
 import numpy as np
-import json
 from time import sleep
+from threading import Lock, Thread
 from timeit import default_timer as timer
-from itertools import count
 from datetime import datetime
 
 # my libraries
-from video_classes import CustomVideoCapture, CustomVideoWriter
+from video_classes import CustomVideoCapture, CustomVideoWriter, get_luma, get_chroma, to_bgr, decode_jpeg
 import global_variables as gv
-from crop_and_scale import get_cropping_and_scaling_parameters, crop_and_scale
+from crop_and_scale import get_cropping_and_scaling_parameters, get_jpeg_decoding_parameters, crop_and_scale, crop_and_scale_yuv
 from find_horizon import HorizonDetector
+from detection_worker import DetectionWorker
+from detector_backends import BILATERAL_DIAMETER
+from resolution_governor import ResolutionGovernor
+from pipeline import LatestValue, PipelineStage
+from telemetry_log import TelemetryWriter
+from thumbdrive_sync import RecordingsSync
 from draw_display import draw_horizon, draw_hud, draw_roi
 from disable_wifi_and_bluetooth import disable_wifi_and_bluetooth
 from flight_controller import FlightController
@@ -24,10 +27,7 @@ def main():
     print('----------STARTING HORIZON DETECTOR----------')
 
     # load settings from txt
-    ret = settings.read()
-    if not ret:
-        print('Failed to read settings. Terminating program.')
-        return
+    settings.read()
     
     # General Constants
     # the video source, either a webcam (by index) or a video file (by file path)
@@ -42,6 +42,42 @@ def main():
     # contour points will be filtered out.
     EXCLUSION_THRESH = settings.get_value('exclusion_thresh')
     FOV = settings.get_value('fov')
+    # BAND_DETECTION limits detection to the band around the predicted horizon while locked on.
+    BAND_DETECTION = settings.get_value('band_detection')
+    # PYRAMID_RESOLUTION is the resolution of the rough horizon search in coarse-to-fine detection.
+    PYRAMID_RESOLUTION = settings.get_value('pyramid_resolution')
+    # SKY_LUT_BITS selects the lookup table used to filter the sky instead of an HSV conversion.
+    SKY_LUT_BITS = settings.get_value('sky_lut_bits')
+    # FITTER is the method used to fit the horizon line to the contour points.
+    FITTER = settings.get_value('fitter')
+    # PREDICTOR is the method used to predict the next horizon and its exclusion band.
+    PREDICTOR = settings.get_value('predictor')
+    # BACKEND is the method used to find the horizon points and fit the horizon.
+    BACKEND = settings.get_value('backend')
+    # MIN_INFERENCE_RESOLUTION is the lowest inference resolution to step down to when detection falls behind.
+    MIN_INFERENCE_RESOLUTION = settings.get_value('min_inference_resolution')
+    # ADAPT_BILATERAL_FILTER also reduces the bilateral filter when detection falls behind.
+    ADAPT_BILATERAL_FILTER = settings.get_value('adapt_bilateral_filter')
+    # MOTION_THRESH is how much the view has to change for the horizon to be detected again, instead of reused.
+    MOTION_THRESH = settings.get_value('motion_thresh')
+    # TRACKING_INTERVAL is the maximum number of frames to track the horizon with optical flow between detections.
+    TRACKING_INTERVAL = settings.get_value('tracking_interval')
+    # PREPROCESSING_THREADS is the number of threads that preprocess strips of the frame in parallel.
+    PREPROCESSING_THREADS = settings.get_value('preprocessing_threads')
+    # PIPELINED runs detection, control and rendering as overlapping stages in their own threads.
+    PIPELINED = settings.get_value('pipelined')
+    # DETECTION_PROCESS runs the HorizonDetector in a separate process.
+    DETECTION_PROCESS = settings.get_value('detection_process')
+    # PACED_PLAYBACK plays video files back at the frame rate of the recording, instead of as fast as possible.
+    PACED_PLAYBACK = settings.get_value('paced_playback')
+    # CAPTURE_FORMAT is the format to capture frames from the webcam in: MJPG, JPEG, YUYV or NV12.
+    CAPTURE_FORMAT = settings.get_value('capture_format')
+    # RECORDING_QUEUE_SIZE is the number of frames that can wait to be recorded, which bounds the memory they take up.
+    RECORDING_QUEUE_SIZE = settings.get_value('recording_queue_size')
+    # RECORDING_DROP_POLICY is what to do with frames when recording falls behind: block, drop_oldest or decimate.
+    RECORDING_DROP_POLICY = settings.get_value('recording_drop_policy')
+    # RECORDING_DECIMATION is the N in recording every Nth frame, when the drop policy is decimate.
+    RECORDING_DECIMATION = settings.get_value('recording_decimation')
     OPERATING_SYSTEM = platform.system()
 
     # Validate inference_resolution
@@ -73,11 +109,11 @@ def main():
         render_image = True
 
     # functions
-    def finish_recording():
+    def get_metadata() -> dict:
         """
-        Finishes up the recording and saves the diagnostic data file.
+        Returns the metadata for the recording (resolution, fps, datetime, etc.).
         """
-        # pack up values into dictionary
+        metadata = {}
         metadata['datetime'] = dt_string
         metadata['ail_kp'] = settings.get_value('ail_kp')
         metadata['elev_kp'] = settings.get_value('elev_kp')
@@ -89,33 +125,64 @@ def main():
         metadata['acceptable_variance'] = ACCEPTABLE_VARIANCE
         metadata['exclusion_thresh'] = EXCLUSION_THRESH
         metadata['fov'] = FOV
+        metadata['band_detection'] = BAND_DETECTION
+        metadata['pyramid_resolution'] = PYRAMID_RESOLUTION
+        metadata['sky_lut_bits'] = SKY_LUT_BITS
+        metadata['fitter'] = FITTER
+        metadata['predictor'] = PREDICTOR
+        metadata['backend'] = BACKEND
+        metadata['min_inference_resolution'] = MIN_INFERENCE_RESOLUTION
+        metadata['adapt_bilateral_filter'] = ADAPT_BILATERAL_FILTER
+        metadata['motion_thresh'] = MOTION_THRESH
+        metadata['tracking_interval'] = TRACKING_INTERVAL
+        metadata['preprocessing_threads'] = PREPROCESSING_THREADS
+        metadata['pipelined'] = PIPELINED
+        metadata['detection_process'] = DETECTION_PROCESS
+        metadata['paced_playback'] = PACED_PLAYBACK
+        metadata['capture_format'] = CAPTURE_FORMAT
+        metadata['recording_queue_size'] = RECORDING_QUEUE_SIZE
+        metadata['recording_drop_policy'] = RECORDING_DROP_POLICY
+        metadata['recording_decimation'] = RECORDING_DECIMATION
+        return metadata
+
+    def finish_recording():
+        """
+        Finishes up the recording. The rest of the recording is saved in a separate thread
+        (see save_recording), so that the main loop does not have to wait for it.
+        """
+        metadata = get_metadata()
+        # average time that each stage of the main loop took so far, in seconds
+        metadata['stage_times'] = {stage.name: stage.average_time for stage in stages}
+        # fraction of the frames of the recording that reused the last horizon
+        metadata['skip_rate'] = recording_skipped_frames / max(telemetry_writer.number_of_records, 1)
+
+        # the writers of the next recording may be started before this one is saved
+        saving_thread = Thread(target=save_recording, args=(video_writer, telemetry_writer, metadata))
+        saving_thread.start()
+        saving_threads.append(saving_thread)
 
+    def save_recording(video_writer: CustomVideoWriter, telemetry_writer: TelemetryWriter, metadata: dict):
+        """
+        Waits for the frames left in the queue to be written, saves the diagnostic data file,
+        and then copies the recording to the thumbdrive in the background.
+        """
         # wait for video_writer to finish recording      
+        video_writer.finish()
         while video_writer.run:
             sleep(.01) 
+        # how many frames were recorded and dropped, and how long writing them took
+        metadata['video_writer'] = video_writer.counters
 
-        # save the json file
-        print('Saving diagnostic data...')
-        with open(f'{file_path}/{dt_string}.json', 'w') as convert_file: 
-            convert_file.write(json.dumps(datadict))
+        # the telemetry has been saved during the recording, only the final metadata is left
+        telemetry_writer.close(metadata)
         print('Diagnostic data saved.')
-            
-        # check if the thumbdrive is attached
-        thumbdrive = '/media/pi/scratch'
-        if not os.path.exists(thumbdrive):
-            return # do nothing with the thumbdrive
-        
-        # check if the recordings folder exists on the thumbdrive
-        # if not, create it
-        dst = f'{thumbdrive}/recordings'
-        if not os.path.exists(dst):
-            os.makedirs(dst)
-        
-        # move files to thumbdrive
-        src_folder = '/home/pi/horizon_detector/recordings'
-        for file in os.listdir(src_folder):
-                shutil.copy(f'{src_folder}/{file}', dst)
-        
+
+        # copy the new recording to the thumbdrive in the background,
+        # unless the next recording has already started
+        if not gv.recording:
+            recordings_sync.resume()
+        recordings_sync.request()
+
     # paused frame displayed when real-time display is not active
     paused_frame = np.zeros((500, 500, 1), dtype = "uint8")
     cv2.putText(paused_frame, 'Real-time display is paused.',(20,30),cv2.FONT_HERSHEY_COMPLEX_SMALL,.75,(255,255,255),1,cv2.LINE_AA)
@@ -124,8 +191,14 @@ def main():
     cv2.putText(paused_frame, "Press 'q' to quit.",(20,120),cv2.FONT_HERSHEY_COMPLEX_SMALL,.75,(255,255,255),1,cv2.LINE_AA)
     cv2.imshow("Real-time Display", paused_frame)
 
+    # copies the recordings to the thumbdrive in the background, if it is attached.
+    # Sync once at the start as well, to finish any copies that were interrupted last time.
+    recordings_sync = RecordingsSync()
+    recordings_sync.start()
+    recordings_sync.request()
+
     # define VideoCapture
-    video_capture = CustomVideoCapture(RESOLUTION, SOURCE)
+    video_capture = CustomVideoCapture(RESOLUTION, SOURCE, PACED_PLAYBACK, CAPTURE_FORMAT)
 
     # start VideoStreamer
     video_capture.start_stream()
@@ -133,9 +206,24 @@ def main():
 
     # get some parameters for cropping and scaling
     crop_and_scale_parameters = get_cropping_and_scaling_parameters(video_capture.resolution, INFERENCE_RESOLUTION)
+    # frames captured as JPEG are decoded at a reduced scale, and then cropped and scaled the rest of the way
+    jpeg_reduction, jpeg_crop_and_scale_parameters = get_jpeg_decoding_parameters(video_capture.resolution, INFERENCE_RESOLUTION)
     
-    # define the HorizonDetector
-    horizon_detector = HorizonDetector(EXCLUSION_THRESH, FOV, ACCEPTABLE_VARIANCE, INFERENCE_RESOLUTION)
+    # define the HorizonDetector, or the DetectionWorker that runs it in a separate process
+    detector_class = DetectionWorker if DETECTION_PROCESS else HorizonDetector
+    # the DetectionWorker waits for the worker process for up to a couple of frame periods
+    worker_options = {'fps': FPS} if DETECTION_PROCESS else {}
+    horizon_detector = detector_class(EXCLUSION_THRESH, FOV, ACCEPTABLE_VARIANCE, INFERENCE_RESOLUTION,
+                                        band_detection=BAND_DETECTION, pyramid_resolution=PYRAMID_RESOLUTION,
+                                        sky_lut_bits=SKY_LUT_BITS, fitter=FITTER, predictor=PREDICTOR,
+                                        backend=BACKEND, motion_thresh=MOTION_THRESH, tracking_interval=TRACKING_INTERVAL,
+                                        preprocessing_threads=PREPROCESSING_THREADS, **worker_options)
+
+    # define the ResolutionGovernor, which adapts the inference resolution to keep up with FPS
+    resolution_governor = None
+    if MIN_INFERENCE_RESOLUTION is not None:
+        resolution_governor = ResolutionGovernor(INFERENCE_RESOLUTION, MIN_INFERENCE_RESOLUTION, FPS, 
+                                                    ADAPT_BILATERAL_FILTER, BILATERAL_DIAMETER)
     
     # initialize some values related to the flight controller
     recording_switch_new_position = None
@@ -164,39 +252,83 @@ def main():
         # pitch trim reader
         pitch_trim_reader = TrimReader(25)
         
-    # initialize variables for main loop
-    t1 = timer() # for measuring frame rate
-    n = 0 # frame number
-    while video_capture.run:
-        # get a frame from the webcam or video
-        frame = video_capture.read_frame()
-
+    # functions for the stages of the main loop
+    def detect(frame: np.ndarray) -> dict:
+        """
+        Crops and scales the frame, and finds the horizon.
+        Returns None if the frame is corrupt and has to be skipped.
+        """
+        nonlocal crop_and_scale_parameters, jpeg_reduction, jpeg_crop_and_scale_parameters, scaled_and_cropped_frame
+        nonlocal corrupt_frames
         # crop and scale the image
-        scaled_and_cropped_frame = crop_and_scale(frame, **crop_and_scale_parameters)
+        detection_start = timer()
+        if DETECTION_PROCESS and scaled_and_cropped_frame is not None:
+            # write the frame straight to the shared memory of the DetectionWorker
+            scaled_and_cropped_frame = horizon_detector.get_frame_buffer(scaled_and_cropped_frame.shape)
+        if video_capture.pixel_format == 'BGR':
+            scaled_and_cropped_frame = crop_and_scale(frame, **crop_and_scale_parameters, dst=scaled_and_cropped_frame)
+        elif video_capture.pixel_format == 'JPEG':
+            decoded_frame = decode_jpeg(frame, jpeg_reduction)
+            if decoded_frame is None:
+                # a corrupt or truncated frame from the webcam is skipped, and counted as dropped
+                corrupt_frames += 1
+                video_capture.number_of_dropped_frames += 1
+                return None
+            scaled_and_cropped_frame = crop_and_scale(decoded_frame, **jpeg_crop_and_scale_parameters, 
+                                                        dst=scaled_and_cropped_frame)
+        else:
+            # only convert the cropped and scaled frame from YUV to BGR
+            luma = get_luma(frame, video_capture.pixel_format)
+            u, v = get_chroma(frame, video_capture.pixel_format)
+            scaled_and_cropped_frame = crop_and_scale_yuv(luma, u, v, **crop_and_scale_parameters, dst=scaled_and_cropped_frame)
 
         # find the horizon
-        output = horizon_detector.find_horizon(scaled_and_cropped_frame, diagnostic_mode=render_image)
+        # (the diagnostic windows are only drawn from the main thread)
+        output = horizon_detector.find_horizon(scaled_and_cropped_frame, diagnostic_mode=render_image and not PIPELINED)
         roll, pitch, variance, is_good_horizon, _ = output
-            
-        # run the flight controller
-        if OPERATING_SYSTEM == "Linux":
-            if pitch is not None:
-                adjusted_pitch = pitch + pitch_trim
-            else:
-                adjusted_pitch = None
-            ail_stick_val, elev_stick_val, ail_val, elev_val, ail_trim, elev_trim = flt_ctrl.run(roll, adjusted_pitch, is_good_horizon)
-            flt_mode = flt_ctrl.program_id  
+        detection = {'frame': frame, 'roll': roll, 'pitch': pitch, 'variance': variance, 
+                        'is_good_horizon': is_good_horizon,
+                        'crop_and_scale_parameters': crop_and_scale_parameters,
+                        'inference_resolution': scaled_and_cropped_frame.shape[1::-1],
+                        'frame_skipped': horizon_detector.frame_skipped,
+                        'frame_tracked': horizon_detector.frame_tracked,
+                        'capture_timestamp': video_capture.timestamp,
+                        'dropped_frames': video_capture.dropped_frames + corrupt_frames}
+        corrupt_frames = 0
+
+        # adapt the inference resolution to the time that detection took
+        # (frames that reused or tracked the last horizon say nothing about how long detection takes)
+        if resolution_governor is not None and not horizon_detector.frame_skipped and \
+                not horizon_detector.frame_tracked and resolution_governor.update(timer() - detection_start):
+            crop_and_scale_parameters = get_cropping_and_scaling_parameters(video_capture.resolution, 
+                                                                            resolution_governor.resolution)
+            jpeg_reduction, jpeg_crop_and_scale_parameters = get_jpeg_decoding_parameters(video_capture.resolution, 
+                                                                                            resolution_governor.resolution)
+            horizon_detector.set_frame_shape(resolution_governor.resolution, resolution_governor.bilateral_diameter)
+        return detection
 
-        # save the horizon data for diagnostic purposes
-        if gv.recording:
-            # determine the number of the frame within the current recording
-            recording_frame_num = next(recording_frame_iter)
+    def control(detection: dict) -> dict:
+        """
+        Runs the flight controller on the horizon found in a frame, and records the frame.
+        Returns the telemetry of the frame.
+        """
+        nonlocal ail_stick_val, elev_stick_val, ail_val, elev_val, flt_mode, ail_trim, elev_trim
+        nonlocal recording_skipped_frames
+        roll, pitch, is_good_horizon = detection['roll'], detection['pitch'], detection['is_good_horizon']
+        with control_lock:
+            # run the flight controller
+            if OPERATING_SYSTEM == "Linux":
+                if pitch is not None:
+                    adjusted_pitch = pitch + pitch_trim
+                else:
+                    adjusted_pitch = None
+                ail_stick_val, elev_stick_val, ail_val, elev_val, ail_trim, elev_trim = flt_ctrl.run(roll, adjusted_pitch, is_good_horizon)
+                flt_mode = flt_ctrl.program_id  
 
-            # save diagnostic data to frame_data dictionary
             frame_data = {}
             frame_data['roll'] = roll
             frame_data['pitch'] = pitch
-            frame_data['variance'] = variance
+            frame_data['variance'] = detection['variance']
             frame_data['is_good_horizon'] = is_good_horizon
             frame_data['actual_fps'] = actual_fps
             frame_data['ail_val'] = ail_val
@@ -207,42 +339,127 @@ def main():
             frame_data['elev_trim'] = elev_trim
             frame_data['flt_mode'] = flt_mode
             frame_data['pitch_trim'] = pitch_trim 
-            frames[recording_frame_num] = frame_data
-         
-        if render_image:
-            frame_copy = frame.copy() # copy the frame so that we have an unmarked frame to draw on
-            # draw roi
-            draw_roi(frame_copy, crop_and_scale_parameters)
-            
-            # draw pitch trim
-            if roll and is_good_horizon:
-                color = (240,240,240)
-                adjusted_pitch = pitch + pitch_trim
-                draw_horizon(frame_copy, roll, adjusted_pitch, FOV, color, draw_groundline=False)
-            
-            # draw horizon
-            if roll:
-                if is_good_horizon:
-                    color = (255,0,0)
-                else:
-                    color = (0,0,255)
-                draw_horizon(frame_copy, roll, pitch, 
-                            FOV, color, draw_groundline=is_good_horizon)
+            frame_data['inference_resolution'] = detection['inference_resolution']
+            frame_data['frame_skipped'] = detection['frame_skipped']
+            frame_data['frame_tracked'] = detection['frame_tracked']
+            # number of frames from the camera that were dropped before this one
+            frame_data['dropped_frames'] = detection['dropped_frames']
+            # seconds from capturing the frame to running the flight controller on it
+            frame_data['latency'] = timer() - detection['capture_timestamp']
+            frame_data['timestamp'] = detection['capture_timestamp']
+
+            # save the horizon data for diagnostic purposes
+            if gv.recording:
+                # stream the diagnostic data to the telemetry file
+                record_number = telemetry_writer.write(frame_data)
+                recording_skipped_frames += detection['frame_skipped']
+                # add frame to recording queue. Once it is written, its index in the video
+                # is saved in its record, so that dropped frames do not misalign the telemetry.
+                video_writer.write(detection['frame'], record_number)
+        return detection, frame_data
+
+    def render(output: tuple):
+        """
+        Draws the horizon and the HUD on the frame and shows it.
+        """
+        nonlocal frame_copy
+        if not render_image:
+            return
+        detection, frame_data = output
+        frame = detection['frame']
+        roll, pitch, is_good_horizon = frame_data['roll'], frame_data['pitch'], frame_data['is_good_horizon']
 
-            # draw HUD
-            draw_hud(frame_copy, roll, pitch, actual_fps, is_good_horizon, gv.recording)
+        # copy the frame so that we have an unmarked frame to draw on
+        # (frames captured as YUV are converted to BGR here, only when they are shown)
+        frame_copy = to_bgr(frame, video_capture.pixel_format, dst=frame_copy)
+        # draw roi
+        draw_roi(frame_copy, detection['crop_and_scale_parameters'])
+        
+        # draw pitch trim
+        if roll and is_good_horizon:
+            color = (240,240,240)
+            adjusted_pitch = pitch + frame_data['pitch_trim']
+            draw_horizon(frame_copy, roll, adjusted_pitch, FOV, color, draw_groundline=False)
+        
+        # draw horizon
+        if roll:
+            if is_good_horizon:
+                color = (255,0,0)
+            else:
+                color = (0,0,255)
+            draw_horizon(frame_copy, roll, pitch, 
+                        FOV, color, draw_groundline=is_good_horizon)
 
-            # draw center circle
-            center = (frame_copy.shape[1]//2, frame_copy.shape[0]//2)
-            radius = frame.shape[0]//100
-            cv2.circle(frame_copy, center, radius, (255,0,0), 2)
+        # draw HUD
+        draw_hud(frame_copy, roll, pitch, frame_data['actual_fps'], is_good_horizon, gv.recording)
 
-            # show image
-            cv2.imshow("Real-time Display", frame_copy)
+        # draw center circle
+        center = (frame_copy.shape[1]//2, frame_copy.shape[0]//2)
+        radius = frame_copy.shape[0]//100
+        cv2.circle(frame_copy, center, radius, (255,0,0), 2)
 
-        # add frame to recording queue
-        if gv.recording:
-            video_writer.queue.put(frame)     
+        # show image
+        cv2.imshow("Real-time Display", frame_copy)
+
+    def wait_for_next_frame():
+        """
+        Waits long enough for the actual frame rate to be equal to the target frame rate.
+        """
+        nonlocal t1, actual_fps, n
+        # DYNAMIC WAIT
+        # Figure out how much longer we need to wait in order 
+        # for the actual frame rate to be equal to the target frame rate.
+        t2 = timer()
+        waited_so_far = t2 - t1
+        extra = .0000058 * FPS # compensates for some time that is lost each iteration of loop, not sure why, but this improves accuracy
+        addl_time_to_wait = 1/FPS - waited_so_far - extra
+        # when a video file is played back as fast as possible, the decoding sets the pace
+        if addl_time_to_wait > 0 and (video_capture.using_camera or PACED_PLAYBACK):
+            sleep(addl_time_to_wait)
+
+        # record the actual fps
+        t_final = timer()
+        actual_fps = 1/(t_final - t1)
+        t1 = timer()
+        
+        # increment the frame count for the whole runtime           
+        n += 1
+
+    # the stages of the main loop, which keep track of how long each of them takes
+    detect_stage = PipelineStage('detect', detect)
+    control_stage = PipelineStage('control', control)
+    render_stage = PipelineStage('render', render)
+    stages = (detect_stage, control_stage, render_stage)
+    # keeps the control stage from running while the user input changes the flight program or the recording
+    control_lock = Lock()
+
+    # initialize variables for main loop
+    t1 = timer() # for measuring frame rate
+    n = 0 # frame number
+    # buffers that are reused from one frame to the next
+    scaled_and_cropped_frame = None
+    frame_copy = None
+    corrupt_frames = 0 # frames skipped since the last detection, because they could not be decoded
+    recording_skipped_frames = 0
+    saving_threads = [] # threads that save the recordings that have been stopped
+    if PIPELINED:
+        # Detection and control run in their own threads, and rendering runs in the main loop.
+        # Each stage hands its latest output to the next, so that detection of a frame 
+        # overlaps with the control of the previous frame and the rendering of the one before that.
+        detection_slot = LatestValue()
+        telemetry_slot = LatestValue()
+        detect_stage.start(output_slot=detection_slot, source=video_capture.read_frame, wait=wait_for_next_frame)
+        control_stage.start(detection_slot, telemetry_slot)
+    while video_capture.run and (not PIPELINED or (detect_stage.run and control_stage.run)):
+        if PIPELINED:
+            render_stage.step(telemetry_slot, timeout=1/FPS)
+        else:
+            # get a new frame from the webcam or video
+            # (waits for the next frame, instead of detecting the horizon in the same frame twice)
+            frame = video_capture.read_frame()
+            detection = detect_stage.process(frame) if frame is not None else None
+            if detection is not None:
+                render_stage.process(control_stage.process(detection))
 
         # check for user input
         if OPERATING_SYSTEM == 'Linux':
@@ -257,84 +474,90 @@ def main():
         key = cv2.waitKey(1)
         
         # do things based on detected user input
-        if key == ord('q'):
-            break
-        elif key == ord('d'):
-            cv2.destroyAllWindows()
-            cv2.imshow("Real-time Display", paused_frame)
-            render_image = not render_image
-            print(f'Real-time display: {render_image}')
-        elif autopilot_switch_new_position == 1 and flt_ctrl.program_id != 2:
-            flt_ctrl.select_program(2)
-        elif autopilot_switch_new_position == 0 and flt_ctrl.program_id == 2:
-            flt_ctrl.select_program(0)
-        elif (key == ord('r') or recording_switch_new_position == 1) and not gv.recording:
-            # toggle the recording flag
-            gv.recording = not gv.recording
-            
-            # start the recording
-            # create an interator to keep track of frame numbers within the recording
-            recording_frame_iter = count()
-
-            # get datetime
-            now = datetime.now()
-            dt_string = now.strftime("%m.%d.%Y.%H.%M.%S")
-            filename = f'{dt_string}.avi'
-
-            # start the CustomVideoWriter
-            file_path = 'recordings'
-            video_writer = CustomVideoWriter(filename, file_path, video_capture.resolution, FPS)
-            video_writer.start_writing()
-
-            # create some dictionaries to save the diagnostic data
-            datadict = {} # top-level dictionary that contains all diagnostic data
-            metadata = {} # metadata for the recording (resolution, fps, datetime, etc.)
-            frames = {} # contains data for each frame of the recording
-            datadict['metadata'] = metadata
-            datadict['frames'] = frames
-            
-            # do a surface check
-            if OPERATING_SYSTEM == 'Linux':
-                flt_ctrl.select_program(1)
+        recording_stopped = False
+        with control_lock:
+            if key == ord('q'):
+                break
+            elif key == ord('d'):
+                cv2.destroyAllWindows()
+                cv2.imshow("Real-time Display", paused_frame)
+                render_image = not render_image
+                print(f'Real-time display: {render_image}')
+            elif autopilot_switch_new_position == 1 and flt_ctrl.program_id != 2:
+                flt_ctrl.select_program(2)
+            elif autopilot_switch_new_position == 0 and flt_ctrl.program_id == 2:
+                flt_ctrl.select_program(0)
+            elif (key == ord('r') or recording_switch_new_position == 1) and not gv.recording:
+                # toggle the recording flag
+                gv.recording = not gv.recording
                 
-        elif (key == ord('r') or recording_switch_new_position == 0) and gv.recording:
-            # toggle the recording flag
-            gv.recording = not gv.recording
-            
+                # start the recording
+                # keep the storage free for the recording, until it is finished
+                recordings_sync.pause()
+                recording_skipped_frames = 0 # frames of the recording that reused the last horizon
+
+                # get datetime
+                now = datetime.now()
+                dt_string = now.strftime("%m.%d.%Y.%H.%M.%S")
+                filename = f'{dt_string}.avi'
+
+                # stream the diagnostic data of each frame to a telemetry file
+                file_path = 'recordings'
+                telemetry_writer = TelemetryWriter(f'{file_path}/{dt_string}.telemetry', get_metadata())
+
+                # start the CustomVideoWriter
+                video_writer = CustomVideoWriter(filename, file_path, video_capture.resolution, FPS,
+                                                    video_capture.pixel_format, RECORDING_QUEUE_SIZE,
+                                                    RECORDING_DROP_POLICY, RECORDING_DECIMATION,
+                                                    telemetry_writer.set_video_frame)
+                video_writer.start_writing()
+                
+                # do a surface check
+                if OPERATING_SYSTEM == 'Linux':
+                    flt_ctrl.select_program(1)
+                    
+            elif (key == ord('r') or recording_switch_new_position == 0) and gv.recording:
+                # toggle the recording flag
+                gv.recording = not gv.recording
+                recording_stopped = True
+
+        if recording_stopped:
             # finish the recording, save diagnostic about recording
+            # (without holding up the control stage while the recording is saved)
             finish_recording()
             
             # wiggle servos to confirm completion of recording
             if OPERATING_SYSTEM == 'Linux':
-                flt_ctrl.select_program(3)
+                with control_lock:
+                    flt_ctrl.select_program(3)
 
-        # DYNAMIC WAIT
-        # Figure out how much longer we need to wait in order 
-        # for the actual frame rate to be equal to the target frame rate.
-        t2 = timer()
-        waited_so_far = t2 - t1
-        extra = .0000058 * FPS # compensates for some time that is lost each iteration of loop, not sure why, but this improves accuracy
-        addl_time_to_wait = 1/FPS - waited_so_far - extra
-        if addl_time_to_wait > 0:
-            sleep(addl_time_to_wait)
-
-        # record the actual fps
-        t_final = timer()
-        actual_fps = 1/(t_final - t1)
-        t1 = timer()
-        
-        # increment the frame count for the whole runtime           
-        n += 1
+        if not PIPELINED:
+            wait_for_next_frame()
     
     # CLEAN UP AND FINISH PROGRAM
+    for stage in stages:
+        stage.stop()
     # Stop the recording if it hasn't already been stopped. 
     if gv.recording:
         gv.recording = not gv.recording
         finish_recording()
+    # wait for the recordings to be saved, and copied to the thumbdrive
+    for saving_thread in saving_threads:
+        saving_thread.join()
+    if recordings_sync.syncing or recordings_sync.sync_requested:
+        print('Waiting for the recordings to be synced to the thumbdrive...')
+    recordings_sync.finish()
     video_capture.release()
+    if DETECTION_PROCESS:
+        horizon_detector.close()
     cv2.destroyAllWindows()
     gv.recording = False
     gv.run = False
+    if MOTION_THRESH is not None:
+        print(f'Reused the last horizon in {horizon_detector.skip_rate:.1%} of frames.')
+    for stage in stages:
+        print(f'{stage.name}: {stage.average_time * 1000:.2f} ms per frame, '\
+                f'{stage.number_of_dropped_values} frames dropped')
     print('---------------------END---------------------')
 
 if __name__ == '__main__':
@@ -0,0 +1,117 @@
+from threading import Condition, Thread
+from timeit import default_timer as timer
+
+class LatestValue:
+    def __init__(self):
+        """
+        Single-slot handoff from one pipeline stage to the next. Putting a value overwrites
+        the value that the next stage has not gotten yet, so a stage that falls behind always
+        works on the latest value, instead of on a backlog of old ones.
+        """
+        self.condition = Condition()
+        self.value = None
+        self.sequence_number = 0 # number of values put so far
+
+    def put(self, value):
+        with self.condition:
+            self.value = value
+            self.sequence_number += 1
+            self.condition.notify_all()
+
+    def get(self, last_sequence_number: int, timeout: float = None) -> tuple:
+        """
+        Waits for a value newer than the one with last_sequence_number.
+        Returns the sequence number and the value, or last_sequence_number and None if
+        there was no newer value before the timeout (in seconds).
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence_number > last_sequence_number, timeout):
+                return last_sequence_number, None
+            return self.sequence_number, self.value
+
+class PipelineStage:
+    def __init__(self, name: str, function):
+        """
+        One stage of the main loop (e.g. detect, control or render), which keeps track of how long it takes.
+        The stage can either be called from the main loop with process, or run in its own thread with start.
+        name: name of the stage, used when reporting the timing
+        function: does the work of the stage. Takes the output of the previous stage
+        (or of the source, for the first stage) and returns the input of the next stage.
+        """
+        self.name = name
+        self.function = function
+        self.run = False
+        self.thread = None
+        self.last_sequence_number = 0
+
+        # timing
+        self.number_of_runs = 0
+        self.time_spent = 0 # in seconds
+        self.last_time = 0 # in seconds
+        # number of values from the previous stage that were overwritten before this stage got to them
+        self.number_of_dropped_values = 0
+
+    @property
+    def average_time(self) -> float:
+        return self.time_spent / max(self.number_of_runs, 1)
+
+    def process(self, *args):
+        t1 = timer()
+        output = self.function(*args)
+        self.last_time = timer() - t1
+        self.time_spent += self.last_time
+        self.number_of_runs += 1
+        return output
+
+    def step(self, input_slot: LatestValue, output_slot: LatestValue = None, timeout: float = None) -> bool:
+        """
+        Waits for a new value in input_slot, processes it and puts the output into output_slot.
+        Returns False if there was no new value before the timeout (in seconds).
+        """
+        sequence_number, value = input_slot.get(self.last_sequence_number, timeout)
+        if value is None:
+            return False
+        self.number_of_dropped_values += sequence_number - self.last_sequence_number - 1
+        self.last_sequence_number = sequence_number
+        output = self.process(value)
+        if output_slot is not None and output is not None:
+            output_slot.put(output)
+        return True
+
+    def start(self, input_slot: LatestValue = None, output_slot: LatestValue = None, source=None, wait=None):
+        """
+        Runs the stage in its own thread until stop is called.
+        input_slot: the slot to take values from. If None, this is the first stage of the pipeline,
+        which takes its values from source instead.
+        source: for the first stage, function that returns the next value (e.g. waits for the next frame),
+        or None if there is none. The time spent waiting for it does not count towards the stage.
+        wait: for the first stage, function to call between runs, e.g. to keep the frame rate
+        """
+        def thread():
+            try:
+                while self.run:
+                    if input_slot is not None:
+                        self.step(input_slot, output_slot, timeout=.1)
+                        continue
+                    value = source()
+                    if value is None:
+                        continue
+                    output = self.process(value)
+                    if output_slot is not None and output is not None:
+                        output_slot.put(output)
+                    if wait is not None:
+                        wait()
+            finally:
+                # let the main loop know that the pipeline is broken, e.g. if the function raised an exception
+                self.run = False
+        self.run = True
+        self.thread = Thread(target=thread, name=self.name)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the stage, and waits for its thread to finish the value it is working on.
+        """
+        self.run = False
+        if self.thread is not None:
+            self.thread.join()
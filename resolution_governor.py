@@ -0,0 +1,90 @@
+import numpy as np
+
+# fraction of the frame time (1/fps) that horizon detection may take up,
+# leaving the rest for the flight controller, rendering and recording
+DETECTION_BUDGET = .5
+# each step down in inference resolution scales the height by this factor
+RESOLUTION_STEP = .85
+# bilateral filter diameters to step down to, after the minimum inference resolution is reached
+REDUCED_BILATERAL_DIAMETERS = (7, 5)
+# Step back up once the detection time is below this fraction of the budget. Stepping up
+# makes detection take about 1 / RESOLUTION_STEP ** 2 times longer, so this leaves some headroom.
+STEP_UP_MARGIN = .65
+# weight of the latest frame in the average detection time
+SMOOTHING = .1
+# number of frames to wait after a step, before stepping down or up again
+FRAMES_BEFORE_STEP_DOWN = 5
+FRAMES_BEFORE_STEP_UP = 60
+
+class ResolutionGovernor:
+    def __init__(self, max_resolution: tuple, min_resolution: tuple, fps: float,
+                    adapt_bilateral_filter: bool = False, bilateral_diameter: int = 9):
+        """
+        Keeps the main loop on schedule by watching how long horizon detection takes and
+        moving the inference resolution down when detection overruns its share of the frame time,
+        and back up when there is time to spare.
+        max_resolution: the inference resolution to use when there is enough time
+        min_resolution: the lowest inference resolution to step down to. Only its height
+        is used, since the aspect ratio of max_resolution is kept.
+        fps: target frame rate of the main loop
+        adapt_bilateral_filter: if True, the diameter of the bilateral filter is reduced as well,
+        once the minimum inference resolution has been reached.
+        bilateral_diameter: the diameter of the bilateral filter when there is enough time
+        """
+        self.budget = DETECTION_BUDGET / fps # in seconds
+
+        # Make a list of levels, from the highest to the lowest quality.
+        # Each level is an inference resolution and a bilateral filter diameter.
+        aspect_ratio = max_resolution[0] / max_resolution[1]
+        min_height = min(min_resolution[1], max_resolution[1])
+        height = max_resolution[1]
+        heights = [height]
+        while height > min_height:
+            height = max(int(height * RESOLUTION_STEP), min_height)
+            heights.append(height)
+        self.levels = [((int(np.round(height * aspect_ratio)), height), bilateral_diameter) for height in heights]
+        if adapt_bilateral_filter:
+            for diameter in REDUCED_BILATERAL_DIAMETERS:
+                if diameter < bilateral_diameter:
+                    self.levels.append((self.levels[-1][0], diameter))
+
+        self.level = 0
+        self.average_detection_time = None
+        self.frames_since_step = 0
+
+    @property
+    def resolution(self) -> tuple:
+        return self.levels[self.level][0]
+
+    @property
+    def bilateral_diameter(self) -> int:
+        return self.levels[self.level][1]
+
+    def update(self, detection_time: float) -> bool:
+        """
+        Takes the time (in seconds) that detecting the horizon in the last frame took.
+        Returns True if the level changed, in which case the caller should switch to
+        the new resolution and bilateral_diameter.
+        """
+        # average out the detection time, so that a single slow frame does not cause a step
+        if self.average_detection_time is None:
+            self.average_detection_time = detection_time
+        else:
+            self.average_detection_time += SMOOTHING * (detection_time - self.average_detection_time)
+        self.frames_since_step += 1
+
+        if self.average_detection_time > self.budget:
+            if self.level == len(self.levels) - 1 or self.frames_since_step < FRAMES_BEFORE_STEP_DOWN:
+                return False
+            self.level += 1
+        elif self.average_detection_time < STEP_UP_MARGIN * self.budget:
+            if self.level == 0 or self.frames_since_step < FRAMES_BEFORE_STEP_UP:
+                return False
+            self.level -= 1
+        else:
+            return False
+
+        # start measuring the detection time at the new level from scratch
+        self.average_detection_time = None
+        self.frames_since_step = 0
+        return True
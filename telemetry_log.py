@@ -0,0 +1,259 @@
+import json
+import os
+import sys
+import numpy as np
+from threading import Lock
+from timeit import default_timer as timer
+
+# first bytes of every telemetry file
+MAGIC = b'HZNTLM01'
+# The header (MAGIC, the length of the header json and the header json itself) is padded to this size,
+# so that the records start at a fixed offset, and so that the metadata can be rewritten in place
+# when the recording is finished.
+HEADER_SIZE = 8192
+# records are written to the file after this many records, or this many seconds, whichever comes first
+FLUSH_RECORDS = 30
+FLUSH_INTERVAL = 1 # in seconds
+
+# one record per frame of the recording. Values that were None are stored as NaN,
+# or as -1 for the integer fields.
+TELEMETRY_DTYPE = np.dtype([
+    ('timestamp', '<f8'), # capture time of the frame, in seconds since the start of the recording
+    ('roll', '<f4'),
+    ('pitch', '<f4'),
+    ('variance', '<f4'),
+    ('is_good_horizon', 'i1'),
+    ('actual_fps', '<f4'),
+    ('ail_val', '<f4'),
+    ('elev_val', '<f4'),
+    ('ail_stick_val', '<f4'),
+    ('elev_stick_val', '<f4'),
+    ('ail_trim', '<f4'),
+    ('elev_trim', '<f4'),
+    ('flt_mode', 'i1'),
+    ('pitch_trim', '<f4'),
+    ('inference_width', '<i2'),
+    ('inference_height', '<i2'),
+    ('frame_skipped', '?'),
+    ('frame_tracked', '?'),
+    ('dropped_frames', '<i4'),
+    ('latency', '<f4'), # in seconds
+    ('video_frame', '<i4'), # index of the frame in the video file, -1 if it was dropped (or not written yet)
+])
+
+def _to_field(name: str, value):
+    if value is None:
+        return -1 if TELEMETRY_DTYPE[name].kind == 'i' else np.nan
+    return value
+
+def _from_field(value):
+    value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+class TelemetryWriter:
+    def __init__(self, path: str, metadata: dict = None):
+        """
+        Streams the telemetry of a recording to an append-only file of fixed-width records
+        (see TELEMETRY_DTYPE), so that it does not pile up in memory during the flight, and so that
+        everything up to the last flush survives if the recording is never finished.
+        The file can be read with read_telemetry, which maps the records with numpy.memmap.
+        path: path of the telemetry file
+        metadata: metadata of the recording (resolution, fps, etc.), saved in the header.
+        It can be updated when the recording is finished, with close.
+        """
+        self.path = path
+        self.file = open(path, 'wb')
+        self._write_header(metadata or {})
+        self.file.flush()
+        # the video frames of records that have already been flushed are filled in through a second handle
+        self.patch_file = open(path, 'r+b')
+        self.lock = Lock() # set_video_frame is called from the thread of the video writer
+        self.is_closed = False
+
+        # records since the last flush
+        self.buffer = np.zeros(FLUSH_RECORDS, dtype=TELEMETRY_DTYPE)
+        self.buffered_records = 0
+        self.last_flush = timer()
+        self.number_of_records = 0
+        self.start_timestamp = None
+
+    def _write_header(self, metadata: dict):
+        header = json.dumps({'dtype': TELEMETRY_DTYPE.descr, 'metadata': metadata}).encode()
+        if len(MAGIC) + 4 + len(header) > HEADER_SIZE:
+            raise ValueError(f'Telemetry metadata does not fit into the header of {HEADER_SIZE} bytes.')
+        self.file.seek(0)
+        self.file.write(MAGIC + len(header).to_bytes(4, 'little') + header.ljust(HEADER_SIZE - len(MAGIC) - 4))
+
+    def write(self, frame_data: dict) -> int:
+        """
+        Appends the telemetry of a frame. frame_data has the same keys as the frames of the
+        json layout, plus 'timestamp'. The video frame is filled in later, with set_video_frame.
+        Returns the number of the record.
+        """
+        with self.lock:
+            return self._write(frame_data)
+
+    def _write(self, frame_data: dict) -> int:
+        if self.start_timestamp is None:
+            self.start_timestamp = frame_data['timestamp']
+        record = self.buffer[self.buffered_records]
+        for name in TELEMETRY_DTYPE.names:
+            if name == 'video_frame':
+                record[name] = -1
+            elif name == 'timestamp':
+                record[name] = frame_data['timestamp'] - self.start_timestamp
+            elif name == 'inference_width':
+                record[name] = frame_data['inference_resolution'][0]
+            elif name == 'inference_height':
+                record[name] = frame_data['inference_resolution'][1]
+            else:
+                record[name] = _to_field(name, frame_data[name])
+        self.buffered_records += 1
+        self.number_of_records += 1
+
+        if self.buffered_records == FLUSH_RECORDS or timer() - self.last_flush > FLUSH_INTERVAL:
+            self._flush()
+        return self.number_of_records - 1
+
+    def set_video_frame(self, record_number: int, video_frame: int):
+        """
+        Sets the index of the frame in the video file of a record, once the frame has been written.
+        Can be passed to CustomVideoWriter as on_frame_written, with the record numbers as tags.
+        """
+        with self.lock:
+            if self.is_closed:
+                return
+            buffer_index = record_number - (self.number_of_records - self.buffered_records)
+            if buffer_index >= 0:
+                self.buffer[buffer_index]['video_frame'] = video_frame
+                return
+            self.patch_file.seek(HEADER_SIZE + record_number * TELEMETRY_DTYPE.itemsize
+                                    + TELEMETRY_DTYPE.fields['video_frame'][1])
+            self.patch_file.write(np.int32(video_frame).tobytes())
+
+    def flush(self):
+        """
+        Hands the buffered records to the operating system.
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.patch_file.flush()
+        self.file.write(self.buffer[:self.buffered_records].tobytes())
+        self.file.flush()
+        self.buffered_records = 0
+        self.last_flush = timer()
+
+    def close(self, metadata: dict = None):
+        """
+        Writes the remaining records and closes the file.
+        metadata: if not None, replaces the metadata in the header
+        """
+        with self.lock:
+            self._flush()
+            self.patch_file.close()
+            if metadata is not None:
+                self._write_header(metadata)
+            self.file.close()
+            self.is_closed = True
+
+def read_telemetry(path: str) -> tuple:
+    """
+    Returns the metadata and the records of a telemetry file. The records are a read-only
+    numpy.memmap of TELEMETRY_DTYPE, so each column (e.g. records['roll']) can be read without
+    loading the whole file. A file that is still being written can be read as well.
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a telemetry file.')
+        header_length = int.from_bytes(file.read(4), 'little')
+        header = json.loads(file.read(header_length))
+    dtype = np.dtype([tuple(field) for field in header['dtype']])
+    number_of_records = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    if number_of_records == 0:
+        return header['metadata'], np.zeros(0, dtype=dtype)
+    records = np.memmap(path, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(number_of_records,))
+    return header['metadata'], records
+
+def get_video_frame_records(records: np.ndarray) -> np.ndarray:
+    """
+    Returns the records of the frames that are in the video file, in the order of the video,
+    so that the telemetry of video frame n is the record at index n.
+    Frames can be dropped from the video when recording falls behind.
+    """
+    if 'video_frame' not in records.dtype.names:
+        return records # recorded before the video frame was saved, when no frames were dropped
+    records = records[records['video_frame'] >= 0]
+    return records[np.argsort(records['video_frame'])]
+
+def records_to_frames(records: np.ndarray) -> dict:
+    """
+    Converts records to the frames of the json layout: {frame number: {key: value}}.
+    """
+    frames = {}
+    for frame_num, record in enumerate(records):
+        frame_data = {}
+        for name in records.dtype.names:
+            if name in ('inference_width', 'inference_height'):
+                continue
+            frame_data[name] = _from_field(record[name])
+        frame_data['is_good_horizon'] = None if record['is_good_horizon'] == -1 else int(record['is_good_horizon'])
+        frame_data['inference_resolution'] = [int(record['inference_width']), int(record['inference_height'])]
+        frames[str(frame_num)] = frame_data
+    return frames
+
+def frames_to_records(frames: dict) -> np.ndarray:
+    """
+    Converts the frames of the json layout to records, so that older recordings
+    can be read the same way as telemetry files.
+    """
+    records = np.zeros(len(frames), dtype=TELEMETRY_DTYPE)
+    for frame_num in range(len(frames)):
+        frame_data = frames[str(frame_num)]
+        record = records[frame_num]
+        for name in TELEMETRY_DTYPE.names:
+            if name == 'video_frame':
+                record[name] = frame_data.get('video_frame', frame_num)
+            elif name == 'inference_width':
+                record[name] = frame_data.get('inference_resolution', (0, 0))[0]
+            elif name == 'inference_height':
+                record[name] = frame_data.get('inference_resolution', (0, 0))[1]
+            else:
+                record[name] = _to_field(name, frame_data.get(name))
+    return records
+
+def load_recording(path: str) -> tuple:
+    """
+    Returns the metadata and the records of a recording, from its telemetry file,
+    or from its json file if it was recorded before telemetry files were introduced.
+    path: path of the recording without the extension, e.g. recordings/01.01.2024.12.00.00
+    """
+    if os.path.exists(f'{path}.telemetry'):
+        return read_telemetry(f'{path}.telemetry')
+    with open(f'{path}.json') as json_file:
+        datadict = json.load(json_file)
+    return datadict['metadata'], frames_to_records(datadict['frames'])
+
+def convert_to_json(path: str):
+    """
+    Converts a telemetry file to a json file of the same name, in the layout that
+    main.py used to save: {'metadata': {...}, 'frames': {'0': {...}, '1': {...}, ...}}
+    In that layout, frame n is the telemetry of video frame n, so the records of the frames
+    that were dropped from the video are left out.
+    """
+    metadata, records = read_telemetry(path)
+    datadict = {'metadata': metadata, 'frames': records_to_frames(get_video_frame_records(records))}
+    with open(path.replace('.telemetry', '.json'), 'w') as convert_file:
+        convert_file.write(json.dumps(datadict))
+
+if __name__ == "__main__":
+    # convert the telemetry files given as arguments, or all of them in the recordings folder
+    recordings_path = 'recordings'
+    paths = sys.argv[1:] or [f'{recordings_path}/{item}' for item in sorted(os.listdir(recordings_path))
+                                if item.endswith('.telemetry')]
+    for path in paths:
+        print(f'Converting {path}...')
+        convert_to_json(path)
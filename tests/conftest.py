@@ -0,0 +1,31 @@
+import os
+import sys
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import detector_backends
+
+@pytest.fixture(autouse=True)
+def find_contours_api(monkeypatch):
+    # The Raspberry Pi runs OpenCV 3, whose findContours returns three values.
+    # Select the code path by the installed OpenCV instead of by the operating system.
+    if int(cv2.__version__.split('.')[0]) >= 4:
+        monkeypatch.setattr(detector_backends, 'OPERATING_SYSTEM', 'Windows')
+
+@pytest.fixture
+def horizon_frame():
+    def horizon_frame(shape: tuple = (100, 100), roll: float = 10, offset: float = 0) -> np.ndarray:
+        """
+        Returns a BGR frame with blue sky above a green ground, split by a horizon at roll
+        (in degrees), offset pixels below the center of the frame.
+        """
+        height, width = shape
+        y, x = np.mgrid[0:height, 0:width]
+        line = (x - width / 2) * np.tan(np.radians(roll)) + height / 2 + offset
+        frame = np.where((y < line)[..., None], (230, 170, 120), (40, 90, 50)).astype(np.uint8)
+        rng = np.random.default_rng(0)
+        return np.clip(frame + rng.normal(0, 4, frame.shape), 0, 255).astype(np.uint8)
+    return horizon_frame
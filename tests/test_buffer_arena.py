@@ -0,0 +1,33 @@
+import numpy as np
+from buffer_arena import BufferArena
+from find_horizon import HorizonDetector
+
+def test_buffers_are_reused():
+    buffers = BufferArena(100 * 100)
+    image = buffers.get('image', (100, 100, 3))
+    assert image.shape == (100, 100, 3) and image.flags['C_CONTIGUOUS']
+    # smaller images share the memory of the buffer
+    smaller = buffers.get('image', (50, 80, 3))
+    assert np.shares_memory(image, smaller)
+    # other names, and other dtypes, get their own buffers
+    assert not np.shares_memory(image, buffers.get('mask', (100, 100)))
+    assert buffers.get('image', (10, 10), np.uint32).dtype == np.uint32
+
+def test_buffers_grow():
+    buffers = BufferArena(10 * 10)
+    image = buffers.get('image', (10, 10))
+    larger = buffers.get('image', (20, 20))
+    assert larger.shape == (20, 20)
+    assert not np.shares_memory(image, larger)
+    assert np.shares_memory(larger, buffers.get('image', (20, 20)))
+
+def test_detection_does_not_allocate_new_buffers(horizon_frame):
+    horizon_detector = HorizonDetector(10, 48.8, 1.3, (100, 100), band_detection=True, tracking_interval=5)
+    frames = [horizon_frame(roll=roll) for roll in np.linspace(0, 10, 20)]
+    horizon_detector.find_horizons(frames[:10])
+    buffers = dict(horizon_detector.buffers.buffers)
+    horizon_detector.find_horizons(frames[10:])
+    # every buffer that was used in the first frames is used again in place
+    assert horizon_detector.buffers.buffers.keys() == buffers.keys()
+    for name, buffer in buffers.items():
+        assert horizon_detector.buffers.buffers[name] is buffer
@@ -0,0 +1,66 @@
+import os
+import signal
+import time
+import pytest
+import detection_worker
+from detection_worker import DetectionWorker, NO_HORIZON
+
+# The worker runs in a fresh process, which selects the findContours API by the operating system,
+# so the tests use a backend that does not need it.
+BACKEND = 'column_scan'
+
+def wait_for_horizon(worker: DetectionWorker, frame, timeout: float = 30) -> tuple:
+    # the first frames after a (re)start get no horizon, until the worker is ready
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        output = worker.find_horizon(frame)
+        if output[3]:
+            return output
+        time.sleep(.01)
+    raise TimeoutError('The detection worker did not find the horizon.')
+
+@pytest.fixture
+def worker():
+    worker = DetectionWorker(10, 48.8, 1.3, (100, 100), backend=BACKEND, fps=30)
+    yield worker
+    worker.close()
+
+def test_horizon_is_found(worker, horizon_frame):
+    roll, pitch, variance, is_good_horizon, mask = wait_for_horizon(worker, horizon_frame(roll=10))
+    assert abs(roll - 10) < 2
+    assert mask is None
+    assert worker.number_of_restarts == 0
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGSTOP'), reason='needs SIGSTOP to stall the worker')
+def test_stuck_worker_is_restarted(worker, horizon_frame, monkeypatch):
+    monkeypatch.setattr(detection_worker, 'WORKER_TIMEOUT', .3)
+    frame = horizon_frame(roll=10)
+    wait_for_horizon(worker, frame)
+    stuck_pid = worker.process.pid
+    os.kill(stuck_pid, signal.SIGSTOP)
+    try:
+        # every frame gets no horizon, without holding up the caller for more than the frame periods
+        start = time.monotonic()
+        while worker.number_of_restarts == 0:
+            call_start = time.monotonic()
+            assert worker.find_horizon(frame) == NO_HORIZON
+            assert time.monotonic() - call_start < worker.timeout + .2
+            assert time.monotonic() - start < 5
+        assert worker.process.pid != stuck_pid
+    finally:
+        if worker.process.pid == stuck_pid:
+            os.kill(stuck_pid, signal.SIGCONT)
+    wait_for_horizon(worker, frame)
+
+def test_crashed_worker_is_restarted(worker, horizon_frame):
+    frame = horizon_frame(roll=10)
+    wait_for_horizon(worker, frame)
+    worker.process.kill()
+    worker.process.join()
+    assert worker.find_horizon(frame) == NO_HORIZON
+    assert worker.number_of_restarts == 1
+    wait_for_horizon(worker, frame)
+
+def test_invalid_arguments_stop_the_start():
+    with pytest.raises(RuntimeError):
+        DetectionWorker(10, 48.8, 1.3, (100, 100), backend=BACKEND, fitter='ransack')
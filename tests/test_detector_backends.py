@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+import detector_backends
+from line_fitting import fit_line
+
+def test_damaged_sky_lut_is_rebuilt(tmp_path, monkeypatch):
+    monkeypatch.setattr(detector_backends, 'SKY_LUT_PATH', str(tmp_path / 'sky_lut_{}bit.npy'))
+    sky_lut = detector_backends._load_sky_lut(4)
+    path = tmp_path / 'sky_lut_4bit.npy'
+    # cut off, as by a power cut while the table was saved
+    with open(path, 'r+b') as lut_file:
+        lut_file.truncate(path.stat().st_size // 2)
+    assert np.array_equal(detector_backends._load_sky_lut(4), sky_lut)
+    assert np.array_equal(np.load(path), sky_lut)
+    assert sorted(item.name for item in tmp_path.iterdir()) == ['sky_lut_4bit.npy']
+
+def test_unknown_fitter_is_rejected():
+    with pytest.raises(ValueError):
+        fit_line(np.arange(5), np.arange(5), 'lsq')
+
+def true_line(shape: tuple, roll: float, offset: float = 0) -> tuple:
+    # slope and intercept of the horizon drawn by the horizon_frame fixture
+    height, width = shape
+    m = np.tan(np.radians(roll))
+    return m, height / 2 + offset - m * width / 2
+
+@pytest.mark.parametrize('backend', sorted(detector_backends.BACKENDS))
+def test_backend_stages(backend, horizon_frame):
+    frame = horizon_frame((120, 160), roll=15, offset=5)
+    detector_backend = detector_backends.BACKENDS[backend]()
+    preprocessed = detector_backend.preprocess(frame)
+    assert set(preprocessed) >= {'bgr2gray', 'blue_filtered_greyscale', 'mask', 'edges', 'otsu_thresh'}
+    assert preprocessed['mask'].shape == frame.shape[:2]
+
+    x, y, is_valid, avg_x, avg_y = detector_backend.extract_boundary(preprocessed)
+    assert x.shape == y.shape == is_valid.shape
+    assert np.count_nonzero(is_valid) >= 12
+    m, b = true_line(frame.shape[:2], 15, 5)
+    # the boundary follows the horizon, and the point on the sky side lies above it
+    assert np.all(np.abs(y[is_valid] - (m * x[is_valid] + b)) < 3)
+    assert avg_y < m * avg_x + b
+
+    fit_m, fit_b, distances, is_inlier = detector_backend.fit(x[is_valid], y[is_valid], 2)
+    assert fit_m == pytest.approx(m, abs=.02)
+    assert detector_backend.score(distances, is_inlier, frame.shape[0]) < 1.3
+
+@pytest.mark.parametrize('backend', sorted(detector_backends.BACKENDS))
+def test_backend_finds_no_boundary_in_uniform_image(backend):
+    detector_backend = detector_backends.BACKENDS[backend]()
+    preprocessed = detector_backend.preprocess(np.full((120, 160, 3), 128, dtype=np.uint8))
+    x, y, is_valid, avg_x, avg_y = detector_backend.extract_boundary(preprocessed)
+    assert avg_x is None or not is_valid.any()
+
+def test_scan_lines_find_the_change_in_each_column():
+    # sky above row 30 at the left, sloping down to row 50 at the right
+    mask = np.zeros((80, 100), dtype=np.uint8)
+    boundary = np.round(np.linspace(30, 50, 100)).astype(int)
+    for column, row in enumerate(boundary):
+        mask[:row, column] = 255
+    lines, positions, has_change, avg_line, avg_position = detector_backends._scan_lines(mask)
+    assert lines[0] == 1 and lines[-1] < 99
+    assert has_change.all()
+    # the boundary lies between the last sky pixel and the first ground pixel
+    np.testing.assert_array_equal(positions, boundary[lines] - .5)
+    # only the top ends of the columns are sky
+    assert avg_position == 0
+    assert avg_line == pytest.approx(lines.mean())
+
+@pytest.mark.parametrize('roll', [10, 60, -70])
+def test_column_scan_follows_steep_horizons(roll, horizon_frame):
+    frame = horizon_frame((120, 160), roll=roll)
+    detector_backend = detector_backends.ColumnScanBackend()
+    x, y, is_valid, avg_x, avg_y = detector_backend.extract_boundary(detector_backend.preprocess(frame))
+    m, b = true_line(frame.shape[:2], roll)
+    # a steep horizon is scanned along the rows, so the points still lie on it
+    assert np.count_nonzero(is_valid) >= 12
+    distances = detector_backends.distances_to_line(x[is_valid], y[is_valid], m, b)
+    assert np.all(distances < 2)
+
+def test_column_scan_returns_the_same_number_of_points(horizon_frame):
+    detector_backend = detector_backends.ColumnScanBackend()
+    numbers_of_points = set()
+    for roll in (0, 20, 40):
+        x, *_ = detector_backend.extract_boundary(detector_backend.preprocess(horizon_frame((120, 160), roll=roll)))
+        numbers_of_points.add(x.shape[0])
+    assert len(numbers_of_points) == 1
+
+@pytest.mark.parametrize('sky_lut_bits', [None, 6])
+def test_strips_match_the_whole_image(sky_lut_bits, horizon_frame, tmp_path, monkeypatch):
+    monkeypatch.setattr(detector_backends, 'SKY_LUT_PATH', str(tmp_path / 'sky_lut_{}bit.npy'))
+    frame = horizon_frame((120, 160), roll=25)
+    whole = detector_backends.ContourBackend(sky_lut_bits).preprocess(frame)
+    # the rows of each strip are blurred with a halo of rows around them, so the seams do not show
+    detector_backend = detector_backends.ContourBackend(sky_lut_bits, number_of_threads=4)
+    strips = detector_backend.preprocess(frame)
+    assert 'blur_strip_3' in detector_backend.buffers.buffers
+    for name in ('bgr2gray', 'blue_filtered_greyscale', 'mask'):
+        np.testing.assert_array_equal(strips[name], whole[name])
+    assert strips['otsu_thresh'] == whole['otsu_thresh']
+
+def test_small_images_are_not_split(horizon_frame):
+    # fewer rows than two strips of MIN_ROWS_PER_STRIP
+    frame = horizon_frame((20, 160), roll=0)
+    whole = detector_backends.ContourBackend().preprocess(frame)
+    detector_backend = detector_backends.ContourBackend(number_of_threads=4)
+    strips = detector_backend.preprocess(frame)
+    assert 'blur_strip_0' not in detector_backend.buffers.buffers
+    np.testing.assert_array_equal(strips['mask'], whole['mask'])
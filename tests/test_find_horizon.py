@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+import find_horizon
+from find_horizon import HorizonDetector
+from detector_backends import BACKENDS
+
+@pytest.mark.parametrize('backend', sorted(BACKENDS))
+@pytest.mark.parametrize('color', [(230, 170, 120), (255, 255, 255), (0, 0, 0)])
+def test_uniform_frame_has_no_horizon(backend, color):
+    # all sky, overexposed or all ground: every contour point lies on the edge of the frame
+    horizon_detector = HorizonDetector(10, 48.8, 1.3, (100, 100), backend=backend)
+    frame = np.full((100, 100, 3), color, dtype=np.uint8)
+    for _ in range(3):
+        roll, pitch, variance, is_good_horizon, _ = horizon_detector.find_horizon(frame)
+        assert not is_good_horizon
+
+def test_horizon_is_found(horizon_frame):
+    horizon_detector = HorizonDetector(10, 48.8, 1.3, (100, 100))
+    roll, pitch, variance, is_good_horizon, _ = horizon_detector.find_horizon(horizon_frame(roll=10))
+    assert is_good_horizon
+    assert abs(roll - 10) < 2
+
+def test_tracking_across_resolution_steps(horizon_frame):
+    # the governor steps the resolution down while the horizon is being tracked
+    from resolution_governor import ResolutionGovernor
+    governor = ResolutionGovernor((100, 100), (50, 50), 30)
+    horizon_detector = HorizonDetector(10, 48.8, 1.3, governor.resolution, tracking_interval=10)
+    steps = 0
+    tracked_frames = 0
+    for frame_num in range(60):
+        frame = horizon_frame(governor.resolution[::-1], roll=10 + frame_num * .2)
+        roll, pitch, variance, is_good_horizon, _ = horizon_detector.find_horizon(frame)
+        assert is_good_horizon
+        assert abs(roll - (10 + frame_num * .2)) < 2
+        # pretend that detection takes too long, so that the resolution steps down every few frames
+        if governor.update(1):
+            steps += 1
+            horizon_detector.set_frame_shape(governor.resolution, governor.bilateral_diameter)
+        tracked_frames += horizon_detector.frame_tracked
+    assert steps > 1
+    assert tracked_frames > 0
+
+@pytest.mark.parametrize('option', [{'fitter': 'ransack'}, {'predictor': 'kalmann'}, {'backend': 'hugh'}])
+def test_unknown_method_is_rejected(option):
+    with pytest.raises(ValueError):
+        HorizonDetector(10, 48.8, 1.3, (100, 100), **option)
+
+@pytest.mark.parametrize('predictor', ['linear', 'kalman'])
+def test_find_horizons_matches_find_horizon(horizon_frame, predictor, monkeypatch):
+    frames = np.stack([horizon_frame(roll=roll, offset=offset) for roll, offset in
+                        zip(np.linspace(0, 20, 12), np.linspace(-10, 10, 12))])
+    frames[5] = frames[5, 0] # a uniform frame, without a horizon
+
+    horizon_detector = HorizonDetector(10, 48.8, 1.3, (100, 100), predictor=predictor)
+    expected = []
+    for frame in frames:
+        roll, pitch, variance, is_good_horizon, _ = horizon_detector.find_horizon(frame)
+        expected.append((np.nan, np.nan, np.nan, False) if roll is None else (roll, pitch, variance, is_good_horizon == 1))
+    expected = np.array(expected).T
+
+    assert np.isnan(expected[0, 5])
+    # both as an array and as an iterator, whose results have to grow
+    monkeypatch.setattr(find_horizon, 'BATCH_CAPACITY', 4)
+    for batch in (frames, iter(frames)):
+        horizon_detector = HorizonDetector(10, 48.8, 1.3, (100, 100), predictor=predictor)
+        rolls, pitches, variances, is_good_horizons = horizon_detector.find_horizons(batch)
+        assert is_good_horizons.dtype == bool
+        np.testing.assert_array_equal(np.array([rolls, pitches, variances, is_good_horizons]), expected)
+
+def flight_frames(horizon_frame, number_of_frames: int = 40, shape: tuple = (120, 160)) -> list:
+    # the horizon rolls and moves down a little from frame to frame
+    return [horizon_frame(shape, roll=5 + frame_num * .5, offset=frame_num * .25 - 5)
+            for frame_num in range(number_of_frames)]
+
+def test_band_detection_matches_full_frame_detection(horizon_frame):
+    frames = flight_frames(horizon_frame)
+    full = HorizonDetector(10, 48.8, 1.3, (160, 120)).find_horizons(frames)
+
+    horizon_detector = HorizonDetector(10, 48.8, 1.3, (160, 120), band_detection=True, band_refresh_interval=10)
+    band_detections = []
+    for frame in frames:
+        horizon_detector.find_horizon(frame)
+        band_detections.append(horizon_detector.band_detections_in_a_row)
+    # the whole frame is processed at first, and again every band_refresh_interval frames
+    assert band_detections[0] == 0
+    assert max(band_detections) == 10
+    assert band_detections.count(0) > 1
+
+    band = HorizonDetector(10, 48.8, 1.3, (160, 120), band_detection=True, band_refresh_interval=10).find_horizons(frames)
+    rolls, pitches, variances, is_good_horizons = band
+    assert is_good_horizons.all()
+    np.testing.assert_allclose(rolls, full[0], atol=.5)
+    np.testing.assert_allclose(pitches, full[1], atol=.5)
+
+def test_pyramid_detection_matches_full_frame_detection(horizon_frame, monkeypatch):
+    frames = flight_frames(horizon_frame)
+    full = HorizonDetector(10, 48.8, 1.3, (160, 120)).find_horizons(frames)
+
+    coarse_horizons = []
+    find_coarse_horizon = HorizonDetector._find_coarse_horizon
+    def spy(self, frame):
+        coarse_horizons.append(find_coarse_horizon(self, frame))
+        return coarse_horizons[-1]
+    monkeypatch.setattr(HorizonDetector, '_find_coarse_horizon', spy)
+
+    pyramid = HorizonDetector(10, 48.8, 1.3, (160, 120), pyramid_resolution=(32, 24)).find_horizons(frames)
+    rolls, pitches, variances, is_good_horizons = pyramid
+    # every frame is first searched at the scaled down resolution
+    assert len(coarse_horizons) == len(frames)
+    assert None not in coarse_horizons
+    assert is_good_horizons.all()
+    np.testing.assert_allclose(rolls, full[0], atol=.5)
+    np.testing.assert_allclose(pitches, full[1], atol=.5)
+
+def test_still_frames_reuse_the_last_horizon(horizon_frame):
+    horizon_detector = HorizonDetector(10, 48.8, 1.3, (100, 100), motion_thresh=2)
+    frame = horizon_frame(roll=10)
+    output = horizon_detector.find_horizon(frame)
+    assert not horizon_detector.frame_skipped
+
+    # the view does not change, so detection is skipped, but at most MAX_SKIPPED_FRAMES in a row
+    skipped = []
+    for _ in range(2 * find_horizon.MAX_SKIPPED_FRAMES + 2):
+        assert horizon_detector.find_horizon(frame)[:4] == output[:4]
+        skipped.append(horizon_detector.frame_skipped)
+    assert skipped == ([True] * find_horizon.MAX_SKIPPED_FRAMES + [False]) * 2
+    assert horizon_detector.skip_rate == pytest.approx(10 / 13)
+
+    # the view changes, so the horizon is detected again
+    roll, *_ = horizon_detector.find_horizon(horizon_frame(roll=20))
+    assert not horizon_detector.frame_skipped
+    assert abs(roll - 20) < 2
+
+def test_frames_without_a_good_horizon_are_not_skipped():
+    horizon_detector = HorizonDetector(10, 48.8, 1.3, (100, 100), motion_thresh=2)
+    frame = np.full((100, 100, 3), 128, dtype=np.uint8)
+    for _ in range(3):
+        horizon_detector.find_horizon(frame)
+        assert not horizon_detector.frame_skipped
@@ -0,0 +1,92 @@
+from math import radians, tan
+import numpy as np
+import pytest
+from find_horizon import HorizonDetector
+from horizon_tracker import HorizonTracker
+
+def test_half_width_of_non_square_frame():
+    # in 160x120 frames, the sides are about 32.5 degrees of pitch from the center, not 18.3
+    tracker = HorizonTracker(48.8, (120, 160), 1000, 0)
+    tracker.update(0, 0, True)
+    tracker.update(0, 0, True)
+    roll_sigma, pitch_sigma = np.sqrt(tracker.covariance[:, 0, 0])
+    expected = tracker.number_of_sigmas * np.hypot(pitch_sigma, tan(radians(roll_sigma)) * 48.8 * 160 / 2 / 120)
+    assert tracker.exclusion_thresh == pytest.approx(expected)
+
+def test_frame_shape_is_converted_to_rows_and_columns():
+    horizon_detector = HorizonDetector(10, 48.8, 1.3, (160, 120), predictor='kalman')
+    assert horizon_detector.frame_shape == (120, 160)
+    assert horizon_detector.tracker.frame_shape == (120, 160)
+    assert horizon_detector.exclusion_thresh_pixels == 10 * 120 // 48.8
+
+    horizon_detector.set_frame_shape((80, 60))
+    assert horizon_detector.tracker.frame_shape == (60, 80)
+    assert horizon_detector.exclusion_thresh_pixels == 10 * 60 // 48.8
+
+def test_non_square_frame_is_tracked(horizon_frame):
+    horizon_detector = HorizonDetector(10, 48.8, 1.3, (160, 120), predictor='kalman')
+    for frame_num in range(20):
+        roll = 10 + frame_num * .5
+        _, _, _, is_good_horizon, _ = horizon_detector.find_horizon(horizon_frame((120, 160), roll=roll))
+        assert is_good_horizon
+    assert abs(horizon_detector.predicted_roll - (roll + .5)) < 2
+
+def track(tracker: HorizonTracker, number_of_frames: int, roll_rate: float = 1, pitch_rate: float = .2):
+    for frame_num in range(number_of_frames):
+        tracker.update(frame_num * roll_rate, frame_num * pitch_rate, True)
+
+def test_track_coasts_through_short_dropout():
+    tracker = HorizonTracker(48.8, (100, 100), 10, 5, max_dropout=5)
+    track(tracker, 20)
+    assert tracker.predicted_roll == pytest.approx(20, abs=.5)
+    assert tracker.predicted_pitch == pytest.approx(4, abs=.2)
+    confident_thresh = tracker.exclusion_thresh
+
+    # the horizon is lost for a few frames, and the track keeps moving at its last rates
+    for frame_num in range(20, 23):
+        tracker.update(None, None, False)
+        assert tracker.predicted_roll == pytest.approx(frame_num + 1, abs=.5)
+    assert tracker.exclusion_thresh > confident_thresh
+
+    # the horizon comes back where the track predicted it
+    tracker.update(23, 4.6, True)
+    assert tracker.frames_since_measurement == 0
+    assert tracker.predicted_roll == pytest.approx(24, abs=.5)
+
+def test_track_is_lost_after_long_dropout():
+    tracker = HorizonTracker(48.8, (100, 100), 10, 5, max_dropout=5)
+    track(tracker, 20)
+    for _ in range(6):
+        tracker.update(None, None, False)
+    assert tracker.predicted_roll is None
+    assert tracker.predicted_pitch is None
+    assert tracker.exclusion_thresh == 10
+
+def test_outlier_is_gated():
+    tracker = HorizonTracker(48.8, (100, 100), 10, 5)
+    track(tracker, 20)
+    number_of_measurements = tracker.number_of_measurements
+    # a wrong detection far from the track is treated like a bad horizon
+    tracker.update(180, -20, True)
+    assert tracker.number_of_measurements == number_of_measurements
+    assert tracker.predicted_roll == pytest.approx(21, abs=.5)
+
+def test_roll_wraps_around():
+    tracker = HorizonTracker(48.8, (100, 100), 10, 5)
+    for frame_num in range(10):
+        tracker.update((355 + frame_num) % 360, 0, True)
+    assert tracker.predicted_roll == pytest.approx(5, abs=.5)
+
+def test_detector_keeps_track_through_dropped_frames(horizon_frame):
+    horizon_detector = HorizonDetector(10, 48.8, 1.3, (100, 100), predictor='kalman')
+    for frame_num in range(30):
+        if 15 <= frame_num < 18:
+            # e.g. the camera was blinded by the sun
+            frame = np.full((100, 100, 3), 255, dtype=np.uint8)
+        else:
+            frame = horizon_frame(roll=frame_num * .5)
+        _, _, _, is_good_horizon, _ = horizon_detector.find_horizon(frame)
+        assert bool(is_good_horizon) != (15 <= frame_num < 18)
+        # from the second frame on, the prediction carries on through the dropped frames
+        if frame_num > 0:
+            assert horizon_detector.predicted_roll == pytest.approx((frame_num + 1) * .5, abs=1)
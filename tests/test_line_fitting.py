@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from line_fitting import fit_line, distances_to_line
+
+@pytest.fixture
+def points_with_outliers():
+    # points along y = .3 * x + 20 with a little noise, and a cluster of outliers
+    # (e.g. a tree line) far below the line
+    rng = np.random.default_rng(0)
+    x = np.arange(0, 160, 2, dtype=float)
+    y = .3 * x + 20 + rng.normal(0, .5, x.shape)
+    is_outlier = (x > 100) & (x < 130)
+    y[is_outlier] += 25
+    return x, y, is_outlier
+
+@pytest.mark.parametrize('method', ['ransac', 'irls'])
+def test_robust_fit_ignores_outliers(points_with_outliers, method):
+    x, y, is_outlier = points_with_outliers
+    m, b, distances, is_inlier = fit_line(x, y, method, inlier_thresh=2, rng=np.random.default_rng(0))
+    assert m == pytest.approx(.3, abs=.01)
+    assert b == pytest.approx(20, abs=1)
+    np.testing.assert_array_equal(is_inlier, ~is_outlier)
+    np.testing.assert_allclose(distances, distances_to_line(x, y, m, b))
+
+def test_polyfit_is_pulled_by_outliers(points_with_outliers):
+    x, y, is_outlier = points_with_outliers
+    m, b, distances, is_inlier = fit_line(x, y, 'polyfit')
+    # the outliers lift the line
+    assert np.mean(m * x + b - (.3 * x + 20)) > 3
+    assert is_inlier.all()
+
+@pytest.mark.parametrize('method', ['polyfit', 'ransac', 'irls'])
+def test_fit_without_outliers(method):
+    x = np.arange(50, dtype=float)
+    y = -2 * x + 7
+    m, b, distances, is_inlier = fit_line(x, y, method, rng=np.random.default_rng(0))
+    assert m == pytest.approx(-2)
+    assert b == pytest.approx(7)
+    assert is_inlier.all()
@@ -0,0 +1,69 @@
+import threading
+import time
+import pytest
+from pipeline import LatestValue, PipelineStage
+
+def test_latest_value_overwrites_old_values():
+    slot = LatestValue()
+    assert slot.get(0, timeout=0) == (0, None)
+    slot.put('a')
+    slot.put('b')
+    assert slot.get(0) == (2, 'b')
+    # nothing newer than the value that was gotten last
+    assert slot.get(2, timeout=.01) == (2, None)
+
+def test_latest_value_wakes_up_waiting_stage():
+    slot = LatestValue()
+    timer = threading.Timer(.05, slot.put, ('frame',))
+    timer.start()
+    assert slot.get(0, timeout=5) == (1, 'frame')
+    timer.join()
+
+def test_process_keeps_time():
+    stage = PipelineStage('double', lambda value: value * 2)
+    assert stage.average_time == 0
+    assert stage.process(3) == 6
+    assert stage.process(4) == 8
+    assert stage.number_of_runs == 2
+    assert stage.average_time == stage.time_spent / 2
+
+def test_step_counts_dropped_values():
+    input_slot = LatestValue()
+    output_slot = LatestValue()
+    stage = PipelineStage('double', lambda value: value * 2)
+    assert not stage.step(input_slot, output_slot, timeout=.01)
+    input_slot.put(1)
+    input_slot.put(2)
+    input_slot.put(3)
+    assert stage.step(input_slot, output_slot)
+    # the stage fell behind by two values, and only processed the latest one
+    assert stage.number_of_dropped_values == 2
+    assert output_slot.get(0) == (1, 6)
+
+def test_stages_in_threads():
+    frames = iter(range(1, 21))
+    detections = LatestValue()
+    results = []
+    detect = PipelineStage('detect', lambda frame: frame * 10)
+    control = PipelineStage('control', results.append)
+    control.start(detections)
+    # the first stage takes its values from the source, which has none left after the 20th frame
+    detect.start(output_slot=detections, source=lambda: next(frames, None), wait=lambda: time.sleep(.002))
+    deadline = time.monotonic() + 5
+    while (not results or results[-1] != 200) and time.monotonic() < deadline:
+        time.sleep(.01)
+    detect.stop()
+    control.stop()
+    assert results[-1] == 200
+    assert results == sorted(results)
+    assert len(results) + control.number_of_dropped_values == 20
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_exception_stops_the_stage():
+    def fail(value):
+        raise ValueError(value)
+    stage = PipelineStage('fail', fail)
+    stage.start(source=lambda: 1)
+    stage.thread.join(5)
+    assert not stage.run
+    assert not stage.thread.is_alive()
@@ -0,0 +1,46 @@
+import pytest
+from resolution_governor import ResolutionGovernor, FRAMES_BEFORE_STEP_DOWN, FRAMES_BEFORE_STEP_UP
+
+FPS = 30
+SLOW = 1 / FPS # takes the whole frame time, twice the budget
+FAST = .1 / FPS
+
+def run(governor: ResolutionGovernor, detection_time: float, number_of_frames: int) -> int:
+    return sum(governor.update(detection_time) for _ in range(number_of_frames))
+
+def test_levels_keep_the_aspect_ratio():
+    governor = ResolutionGovernor((160, 120), (80, 60), FPS)
+    assert governor.levels[0] == ((160, 120), 9)
+    assert governor.levels[-1][0][1] == 60
+    for (width, height), _ in governor.levels:
+        assert width / height == pytest.approx(4 / 3, abs=.02)
+
+def test_steps_down_when_detection_is_slow_and_back_up_when_it_is_fast():
+    governor = ResolutionGovernor((160, 120), (80, 60), FPS)
+    # no step before FRAMES_BEFORE_STEP_DOWN frames at a level
+    assert run(governor, SLOW, FRAMES_BEFORE_STEP_DOWN - 1) == 0
+    assert governor.update(SLOW)
+    assert governor.level == 1
+    # keeps stepping down to the lowest level, and stays there
+    run(governor, SLOW, 20 * FRAMES_BEFORE_STEP_DOWN)
+    assert governor.level == len(governor.levels) - 1
+    assert governor.resolution[1] == 60
+
+    # once detection is fast again, steps up one level at a time, waiting longer before each step
+    assert any(governor.update(FAST) for _ in range(FRAMES_BEFORE_STEP_UP))
+    assert governor.level == len(governor.levels) - 2
+    assert run(governor, FAST, FRAMES_BEFORE_STEP_UP - 1) == 0
+    assert governor.update(FAST)
+    run(governor, FAST, len(governor.levels) * FRAMES_BEFORE_STEP_UP)
+    assert governor.level == 0
+
+def test_single_slow_frame_does_not_step_down():
+    governor = ResolutionGovernor((160, 120), (80, 60), FPS)
+    run(governor, FAST, 10)
+    assert run(governor, SLOW, 1) + run(governor, FAST, 10) == 0
+
+def test_bilateral_filter_is_reduced_at_the_lowest_resolution():
+    governor = ResolutionGovernor((160, 120), (80, 60), FPS, adapt_bilateral_filter=True)
+    run(governor, SLOW, 100 * FRAMES_BEFORE_STEP_DOWN)
+    assert governor.resolution[1] == 60
+    assert governor.bilateral_diameter == 5
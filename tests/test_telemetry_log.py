@@ -0,0 +1,71 @@
+import json
+import numpy as np
+import pytest
+import telemetry_log
+from telemetry_log import TelemetryWriter, read_telemetry, convert_to_json, get_video_frame_records
+
+def make_frame_data(frame_num: int) -> dict:
+    return {'timestamp': 100 + frame_num / 30, 'roll': frame_num * .5, 'pitch': -1.5,
+            'variance': .2, 'is_good_horizon': 1, 'actual_fps': 30., 'ail_val': .1, 'elev_val': -.1,
+            'ail_stick_val': 0., 'elev_stick_val': 0., 'ail_trim': 0., 'elev_trim': 0., 'flt_mode': 2,
+            'pitch_trim': 0., 'inference_resolution': (100, 100), 'frame_skipped': False,
+            'frame_tracked': frame_num % 2 == 1, 'dropped_frames': 0, 'latency': .01}
+
+def write_recording(path, number_of_records: int, dropped: set = ()) -> TelemetryWriter:
+    telemetry_writer = TelemetryWriter(path, {'fps': 30})
+    video_frame = 0
+    for frame_num in range(number_of_records):
+        record_number = telemetry_writer.write(make_frame_data(frame_num))
+        if frame_num not in dropped:
+            telemetry_writer.set_video_frame(record_number, video_frame)
+            video_frame += 1
+    return telemetry_writer
+
+def test_records_round_trip(tmp_path, monkeypatch):
+    # flush in the middle of the recording, so that some video frames are patched into the file
+    monkeypatch.setattr(telemetry_log, 'FLUSH_RECORDS', 4)
+    path = str(tmp_path / 'recording.telemetry')
+    telemetry_writer = write_recording(path, 10)
+
+    # the flushed records can be read while the recording is still going on
+    _, records = read_telemetry(path)
+    assert len(records) == 8
+
+    telemetry_writer.close({'fps': 30, 'frames': 10})
+    metadata, records = read_telemetry(path)
+    assert metadata == {'fps': 30, 'frames': 10}
+    assert len(records) == 10
+    np.testing.assert_allclose(records['timestamp'], np.arange(10) / 30)
+    np.testing.assert_allclose(records['roll'], np.arange(10) * .5)
+    np.testing.assert_array_equal(records['video_frame'], np.arange(10))
+    np.testing.assert_array_equal(records['frame_tracked'], np.arange(10) % 2 == 1)
+    assert set(records['inference_width']) == {100}
+
+def test_video_frame_is_patched_after_flush(tmp_path):
+    path = str(tmp_path / 'recording.telemetry')
+    telemetry_writer = TelemetryWriter(path)
+    record_number = telemetry_writer.write(make_frame_data(0))
+    telemetry_writer.flush()
+    # the video writer finishes the frame after its record was flushed
+    telemetry_writer.set_video_frame(record_number, 0)
+    telemetry_writer.close()
+    _, records = read_telemetry(path)
+    assert records['video_frame'][0] == 0
+
+def test_convert_to_json_leaves_out_dropped_frames(tmp_path):
+    path = str(tmp_path / 'recording.telemetry')
+    write_recording(path, 6, dropped={1, 4}).close({'fps': 30})
+    _, records = read_telemetry(path)
+    assert len(get_video_frame_records(records)) == 4
+
+    convert_to_json(path)
+    with open(str(tmp_path / 'recording.json')) as json_file:
+        datadict = json.load(json_file)
+    assert datadict['metadata'] == {'fps': 30}
+    frames = datadict['frames']
+    # frame n of the json is video frame n
+    assert sorted(frames) == ['0', '1', '2', '3']
+    for video_frame, frame_num in enumerate([0, 2, 3, 5]):
+        assert frames[str(video_frame)]['video_frame'] == video_frame
+        assert frames[str(video_frame)]['roll'] == pytest.approx(frame_num * .5)
+        assert frames[str(video_frame)]['inference_resolution'] == [100, 100]
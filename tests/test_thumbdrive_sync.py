@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import time
+import pytest
+import thumbdrive_sync
+from thumbdrive_sync import RecordingsSync, MANIFEST_NAME, PARTIAL_EXTENSION
+
+@pytest.fixture
+def recordings_sync(tmp_path, monkeypatch):
+    # small chunks, so that the files are copied in several of them
+    monkeypatch.setattr(thumbdrive_sync, 'CHUNK_SIZE', 1000)
+    source_folder = tmp_path / 'recordings'
+    source_folder.mkdir()
+    thumbdrive = tmp_path / 'thumbdrive'
+    thumbdrive.mkdir()
+    for name, size in (('01.avi', 4500), ('01.telemetry', 1200)):
+        (source_folder / name).write_bytes(os.urandom(size))
+    return RecordingsSync(str(source_folder), str(thumbdrive))
+
+def load_manifest(recordings_sync: RecordingsSync) -> dict:
+    with open(f'{recordings_sync.destination_folder}/{MANIFEST_NAME}') as manifest_file:
+        return json.load(manifest_file)
+
+def copied_files(recordings_sync: RecordingsSync, monkeypatch) -> list:
+    # records the files that are copied, instead of only checked against the manifest
+    files = []
+    copy = RecordingsSync._copy
+    def spy(self, file, status, manifest):
+        files.append(file)
+        return copy(self, file, status, manifest)
+    monkeypatch.setattr(RecordingsSync, '_copy', spy)
+    return files
+
+def test_new_and_changed_files_are_copied(recordings_sync, monkeypatch):
+    files = copied_files(recordings_sync, monkeypatch)
+    recordings_sync._sync()
+    assert files == ['01.avi', '01.telemetry']
+    assert sorted(os.listdir(recordings_sync.destination_folder)) == sorted([MANIFEST_NAME, '01.avi', '01.telemetry'])
+    manifest = load_manifest(recordings_sync)
+    for file in files:
+        source_path = f'{recordings_sync.source_folder}/{file}'
+        with open(source_path, 'rb') as source_file, open(f'{recordings_sync.destination_folder}/{file}', 'rb') as copy:
+            contents = source_file.read()
+            assert copy.read() == contents
+        assert manifest[file] == {'size': len(contents), 'mtime': os.stat(source_path).st_mtime,
+                                    'hash': hashlib.sha256(contents).hexdigest()}
+    assert recordings_sync.progress['bytes_copied'] == 5700
+
+    # nothing changed
+    files.clear()
+    recordings_sync._sync()
+    assert files == []
+
+    # only the mtime changed, which the hash tells apart from a change of the contents
+    source_path = f'{recordings_sync.source_folder}/01.avi'
+    os.utime(source_path, (time.time() + 10, time.time() + 10))
+    recordings_sync._sync()
+    assert files == []
+    assert load_manifest(recordings_sync)['01.avi']['mtime'] == os.stat(source_path).st_mtime
+
+    # the file grew, e.g. the recording went on
+    with open(source_path, 'ab') as source_file:
+        source_file.write(b'more')
+    recordings_sync._sync()
+    assert files == ['01.avi']
+    assert load_manifest(recordings_sync)['01.avi']['size'] == 4504
+
+def test_partial_copy_is_resumed(recordings_sync, monkeypatch):
+    # an earlier sync was interrupted after two chunks of 01.avi
+    source_path = f'{recordings_sync.source_folder}/01.avi'
+    status = os.stat(source_path)
+    os.makedirs(recordings_sync.destination_folder)
+    partial_path = f'{recordings_sync.destination_folder}/01.avi{PARTIAL_EXTENSION}'
+    with open(source_path, 'rb') as source_file, open(partial_path, 'wb') as partial_file:
+        contents = source_file.read()
+        partial_file.write(contents[:2000])
+    with open(f'{recordings_sync.destination_folder}/{MANIFEST_NAME}', 'w') as manifest_file:
+        json.dump({'01.avi' + PARTIAL_EXTENSION: {'size': status.st_size, 'mtime': status.st_mtime}}, manifest_file)
+
+    # the part that was already copied is hashed again, instead of being copied again
+    hashed = []
+    hash_file = thumbdrive_sync._hash_file
+    def spy(path, size=None):
+        hashed.append((path, size))
+        return hash_file(path, size)
+    monkeypatch.setattr(thumbdrive_sync, '_hash_file', spy)
+    recordings_sync._sync()
+    assert hashed == [(partial_path, 2000)]
+    manifest = load_manifest(recordings_sync)
+    assert '01.avi' + PARTIAL_EXTENSION not in manifest
+    assert manifest['01.avi']['hash'] == hashlib.sha256(contents).hexdigest()
+    with open(f'{recordings_sync.destination_folder}/01.avi', 'rb') as copy:
+        assert copy.read() == contents
+    assert not os.path.exists(partial_path)
+    assert recordings_sync.number_of_bytes_copied == 5700
+
+def test_sync_waits_while_paused(recordings_sync):
+    recordings_sync.start()
+    recordings_sync.pause()
+    recordings_sync.request()
+    time.sleep(.1)
+    # e.g. while recording, nothing is copied
+    assert not os.path.exists(recordings_sync.destination_folder)
+    recordings_sync.resume()
+    # finish completes the requested sync before the thread stops
+    recordings_sync.finish()
+    assert sorted(load_manifest(recordings_sync)) == ['01.avi', '01.telemetry']
+    assert not recordings_sync.thread.is_alive()
+
+def test_missing_thumbdrive_is_skipped(tmp_path):
+    recordings_sync = RecordingsSync(str(tmp_path), str(tmp_path / 'not_attached'))
+    recordings_sync._sync()
+    assert not os.path.exists(recordings_sync.destination_folder)
@@ -0,0 +1,271 @@
+import time
+import cv2
+import numpy as np
+import pytest
+import video_classes
+from video_classes import CustomVideoCapture
+
+class FakeCamera:
+    """
+    Stands in for cv2.VideoCapture of a webcam. Delivers number_of_frames frames of resolution, 
+    one every frame_time seconds, in the layout that OpenCV hands out raw frames in. The first
+    pixel of each BGR frame is its number.
+    """
+    resolution = (64, 48)
+    number_of_frames = 30
+    frame_time = .002
+    pixel_format = 'BGR'
+
+    def __init__(self, *args):
+        self.frame_num = 0
+        # keep the settings that the camera was opened with, in case its thread outlives the test
+        for name in ('resolution', 'number_of_frames', 'frame_time', 'pixel_format'):
+            setattr(self, name, getattr(FakeCamera, name))
+
+    def set(self, *args):
+        return True
+
+    def get(self, property_id):
+        return {3: self.resolution[0], 4: self.resolution[1]}.get(property_id, 0)
+
+    def read(self):
+        time.sleep(self.frame_time)
+        if self.frame_num == self.number_of_frames:
+            return False, None
+        self.frame_num += 1
+        frame = make_frame(self.frame_num, self.resolution)
+        if self.pixel_format == 'YUYV':
+            return True, cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_YUY2).reshape(1, -1)
+        if self.pixel_format == 'NV12':
+            i420 = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
+            height, width = frame.shape[:2]
+            u, v = i420[height:].reshape(2, height // 2, width // 2)
+            return True, np.concatenate((i420[:height].reshape(-1), np.dstack((u, v)).reshape(-1)))[None]
+        if self.pixel_format == 'JPEG':
+            return True, cv2.imencode('.jpg', frame)[1].reshape(1, -1)
+        return True, frame
+
+    def release(self):
+        pass
+
+def make_frame(frame_num: int, resolution: tuple) -> np.ndarray:
+    width, height = resolution
+    y, x = np.mgrid[0:height, 0:width]
+    frame = np.dstack((x * 4, y * 4, np.full_like(x, 128))).astype(np.uint8)
+    frame[0, 0, 0] = frame_num
+    return frame
+
+@pytest.fixture
+def fake_camera(monkeypatch):
+    monkeypatch.setattr(video_classes.cv2, 'VideoCapture', FakeCamera)
+    return FakeCamera
+
+def read_all_frames(capture: CustomVideoCapture, delay: float = 0) -> list:
+    frames = []
+    while True:
+        frame = capture.read_frame(timeout=.5)
+        if frame is None:
+            return frames
+        frames.append((capture.sequence_number, capture.dropped_frames, frame))
+        time.sleep(delay)
+
+def test_camera_hands_out_the_latest_frame(fake_camera):
+    capture = CustomVideoCapture(fake_camera.resolution, '0')
+    capture.start_stream()
+    # the reader is slower than the camera, so frames are dropped
+    frames = read_all_frames(capture, delay=.01)
+    capture.release()
+
+    sequence_numbers = [sequence_number for sequence_number, _, _ in frames]
+    assert sequence_numbers == sorted(set(sequence_numbers))
+    assert sequence_numbers[-1] == fake_camera.number_of_frames
+    # every frame was either read or counted as dropped
+    assert len(frames) + capture.number_of_dropped_frames == fake_camera.number_of_frames
+    assert capture.number_of_dropped_frames > 0
+    for sequence_number, _, frame in frames:
+        assert frame[0, 0, 0] == sequence_number
+
+def test_camera_frame_is_not_returned_twice(fake_camera, monkeypatch):
+    monkeypatch.setattr(fake_camera, 'number_of_frames', 2)
+    monkeypatch.setattr(fake_camera, 'frame_time', .2)
+    capture = CustomVideoCapture(fake_camera.resolution, '0')
+    capture.start_stream()
+    assert capture.read_frame(timeout=1) is not None
+    # the next frame is not there yet
+    assert capture.read_frame(timeout=.05) is None
+    assert capture.read_frame(timeout=1) is not None
+    assert capture.sequence_number == 2
+    capture.release()
+
+@pytest.fixture
+def video_file(tmp_path) -> str:
+    # 20 frames of 64x48, each brighter than the one before
+    path = str(tmp_path / 'video.avi')
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, (64, 48))
+    for frame_num in range(20):
+        writer.write(np.full((48, 64, 3), frame_num * 10, dtype=np.uint8))
+    writer.release()
+    return path
+
+@pytest.mark.parametrize('decode_ahead_budget', [video_classes.DECODE_AHEAD_BUDGET, 1])
+def test_video_file_frames_are_handed_out_in_order(video_file, decode_ahead_budget, monkeypatch):
+    # with a budget of 1 byte, only one frame is decoded ahead
+    monkeypatch.setattr(video_classes, 'DECODE_AHEAD_BUDGET', decode_ahead_budget)
+    capture = CustomVideoCapture(source=video_file, paced=False)
+    assert capture.resolution == (64, 48)
+    capture.start_stream()
+    frames = read_all_frames(capture)
+    assert not capture.run
+    # frames from a video file are never dropped
+    assert [sequence_number for sequence_number, _, _ in frames] == list(range(1, 21))
+    brightness = [frame.mean() for _, _, frame in frames]
+    np.testing.assert_allclose(brightness, np.arange(20) * 10, atol=2)
+
+def test_video_file_is_paced(video_file):
+    capture = CustomVideoCapture(source=video_file, paced=True)
+    capture.start_stream()
+    start = time.monotonic()
+    timestamps = []
+    for _ in range(10):
+        assert capture.read_frame() is not None
+        timestamps.append(capture.timestamp)
+    # the frames are handed out at the frame rate of the recording
+    assert time.monotonic() - start >= 9 / 30
+    np.testing.assert_allclose(np.diff(timestamps), 1 / 30)
+    read_all_frames(capture)
+
+@pytest.mark.parametrize('pixel_format', ['YUYV', 'NV12'])
+def test_raw_frames_from_camera(pixel_format, fake_camera, monkeypatch):
+    from crop_and_scale import get_cropping_and_scaling_parameters, crop_and_scale, crop_and_scale_yuv
+    monkeypatch.setattr(fake_camera, 'pixel_format', pixel_format)
+    monkeypatch.setattr(fake_camera, 'number_of_frames', 1)
+    capture = CustomVideoCapture(fake_camera.resolution, '0', capture_format=pixel_format)
+    assert capture.pixel_format == pixel_format
+    capture.start_stream()
+    frame = capture.read_frame(timeout=1)
+    capture.release()
+
+    # the frame is handed out as it was captured, and converted only where it is needed
+    width, height = fake_camera.resolution
+    assert frame.shape == ((height, width, 2) if pixel_format == 'YUYV' else (height * 3 // 2, width))
+    bgr = video_classes.to_bgr(frame, pixel_format)
+    expected = make_frame(1, fake_camera.resolution)
+    assert np.abs(bgr.astype(int) - expected).mean() < 3
+    luma = video_classes.get_luma(frame, pixel_format)
+    assert luma.shape == (height, width) and np.shares_memory(luma, frame)
+    u, v = video_classes.get_chroma(frame, pixel_format)
+    assert u.shape == v.shape == ((height, width // 2) if pixel_format == 'YUYV' else (height // 2, width // 2))
+
+    # cropping and scaling the planes gives the same inference frame as converting the whole frame first
+    parameters = get_cropping_and_scaling_parameters(fake_camera.resolution, (24, 24))
+    inference_frame = crop_and_scale_yuv(luma, u, v, **parameters)
+    assert inference_frame.shape == (24, 24, 3)
+    assert np.abs(inference_frame.astype(int) - crop_and_scale(bgr, **parameters)).mean() < 3
+
+def encode_frames(number_of_frames: int, resolution: tuple = (64, 48)) -> list:
+    width, height = resolution
+    return [cv2.imencode('.jpg', np.full((height, width, 3), frame_num * 10, dtype=np.uint8))[1]
+            for frame_num in range(number_of_frames)]
+
+def test_mjpeg_avi_can_be_read_back(tmp_path):
+    path = str(tmp_path / 'recording.avi')
+    writer = video_classes.MjpegAviWriter(path, (64, 48), 30)
+    for jpeg in encode_frames(20):
+        assert writer.write(jpeg)
+    writer.release()
+
+    capture = cv2.VideoCapture(path)
+    assert capture.get(cv2.CAP_PROP_FRAME_COUNT) == 20
+    assert capture.get(cv2.CAP_PROP_FPS) == pytest.approx(30)
+    brightness = []
+    while True:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        assert frame.shape == (48, 64, 3)
+        brightness.append(frame.mean())
+    capture.release()
+    np.testing.assert_allclose(brightness, np.arange(20) * 10, atol=2)
+
+def test_full_mjpeg_avi_stops_growing(tmp_path, monkeypatch):
+    jpegs = encode_frames(10)
+    path = str(tmp_path / 'recording.avi')
+    writer = video_classes.MjpegAviWriter(path, (64, 48), 30)
+    # room for about half of the frames, with their chunk headers and index entries
+    room = 5 * (max(jpeg.nbytes for jpeg in jpegs) + 1 + 8 + 16)
+    monkeypatch.setattr(video_classes, 'MAX_AVI_SIZE', writer.file.tell() + room)
+    is_written = [writer.write(jpeg) for jpeg in jpegs]
+    writer.release()
+    assert 0 < sum(is_written) < 10
+    assert is_written == sorted(is_written, reverse=True)
+
+    # the frames that were written can still be played back
+    capture = cv2.VideoCapture(path)
+    assert capture.get(cv2.CAP_PROP_FRAME_COUNT) == sum(is_written)
+    assert capture.read()[0]
+    capture.release()
+
+@pytest.mark.parametrize('reduction', [1, 2, 4, 8])
+def test_jpeg_is_decoded_at_reduced_scale(reduction):
+    jpeg, = encode_frames(1, (640, 480))
+    assert video_classes.decode_jpeg(jpeg, reduction).shape == (480 // reduction, 640 // reduction, 3)
+
+def test_corrupt_jpeg_is_not_decoded():
+    jpeg, = encode_frames(1, (640, 480))
+    assert video_classes.decode_jpeg(jpeg[:jpeg.shape[0] // 3]) is None
+
+def write_recording(tmp_path, drop_policy: str, number_of_frames: int = 10, start_first: bool = False) -> tuple:
+    """
+    Writes JPEG frames tagged with their number to a writer with room for 4 frames in its queue.
+    Unless start_first, the frames are all written before the writer thread starts, 
+    as if writing had fallen far behind. Returns the writer, what write returned for each frame
+    and the tags of the frames that ended up in the video.
+    """
+    written_tags = []
+    def on_frame_written(tag, video_frame):
+        assert video_frame == len(written_tags)
+        written_tags.append(tag)
+    writer = video_classes.CustomVideoWriter('recording.avi', str(tmp_path), (64, 48), 30, 'JPEG',
+                                                max_queued_frames=4, drop_policy=drop_policy, on_frame_written=on_frame_written)
+    if start_first:
+        writer.start_writing()
+    is_queued = [writer.write(jpeg, tag) for tag, jpeg in enumerate(encode_frames(number_of_frames))]
+    if not start_first:
+        writer.start_writing()
+    writer.finish()
+    deadline = time.monotonic() + 5
+    while writer.run and time.monotonic() < deadline:
+        time.sleep(.01)
+    assert not writer.run
+    return writer, is_queued, written_tags
+
+def test_drop_oldest_keeps_the_latest_frames(tmp_path):
+    writer, is_queued, written_tags = write_recording(tmp_path, 'drop_oldest')
+    assert all(is_queued)
+    assert written_tags == [6, 7, 8, 9]
+    assert writer.frames_dropped == 6
+    assert writer.counters['max_queue_length'] == 4
+
+def test_decimate_drops_frames_once_the_queue_is_half_full(tmp_path):
+    writer, is_queued, written_tags = write_recording(tmp_path, 'decimate')
+    # the 4th frame is let through by the decimation, and then the queue is full
+    assert is_queued == [True] * 4 + [False] * 6
+    assert written_tags == [0, 1, 2, 3]
+    assert writer.frames_dropped == 6
+
+def test_block_waits_for_room(tmp_path, monkeypatch):
+    # slow down writing, so that the queue fills up while the frames are written
+    write = video_classes.MjpegAviWriter.write
+    def slow_write(self, frame):
+        time.sleep(.01)
+        return write(self, frame)
+    monkeypatch.setattr(video_classes.MjpegAviWriter, 'write', slow_write)
+    writer, is_queued, written_tags = write_recording(tmp_path, 'block', 20, start_first=True)
+    assert all(is_queued)
+    assert written_tags == list(range(20))
+    assert writer.frames_dropped == 0
+    assert cv2.VideoCapture(str(tmp_path / 'recording.avi')).get(cv2.CAP_PROP_FRAME_COUNT) == 20
+
+def test_unknown_drop_policy_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        video_classes.CustomVideoWriter('recording.avi', str(tmp_path), (64, 48), 30, 'JPEG', drop_policy='drop_newest')
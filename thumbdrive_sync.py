@@ -0,0 +1,238 @@
+import hashlib
+import json
+import os
+import platform
+import subprocess
+from threading import Condition, Thread, get_native_id
+
+# folder that the recordings are saved to, and the thumbdrive that they are copied to
+SOURCE_FOLDER = '/home/pi/horizon_detector/recordings'
+THUMBDRIVE = '/media/pi/scratch'
+# name of the file on the thumbdrive that keeps track of the files that have been copied
+MANIFEST_NAME = '.sync_manifest.json'
+# files are copied in chunks of this many bytes, so that a copy can be paused and resumed
+CHUNK_SIZE = 1024 * 1024
+# extension of a file that is being copied, until it is complete
+PARTIAL_EXTENSION = '.part'
+
+def _hash_file(path: str, size: int = None):
+    """
+    Returns the sha256 hash object of the first size bytes of the file (all of them if size is None).
+    """
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        remaining = size
+        while remaining is None or remaining > 0:
+            chunk = file.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            file_hash.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return file_hash
+
+class RecordingsSync:
+    def __init__(self, source_folder: str = SOURCE_FOLDER, thumbdrive: str = THUMBDRIVE):
+        """
+        Copies the recordings to the thumbdrive in a background thread, so that the main loop
+        does not have to wait for it. Only files that are new or have changed since they were
+        last copied are copied, according to a manifest of their size, mtime and hash on the thumbdrive.
+        Files are copied in chunks, under a temporary name, so that a copy that was paused or
+        interrupted (e.g. by the program ending) can be resumed where it left off.
+        The thread runs at the lowest CPU and I/O priority, and can be paused while recording.
+        """
+        self.source_folder = source_folder
+        self.thumbdrive = thumbdrive
+        self.destination_folder = f'{thumbdrive}/recordings'
+
+        self.condition = Condition()
+        self.run = False
+        self.paused = False
+        self.sync_requested = False
+        self.thread = None
+
+        # progress of the current sync
+        self.number_of_files = 0
+        self.number_of_files_copied = 0
+        self.number_of_bytes = 0
+        self.number_of_bytes_copied = 0
+        self.current_file = None
+        self.syncing = False
+
+    @property
+    def progress(self) -> dict:
+        return {'syncing': self.syncing,
+                'current_file': self.current_file,
+                'files_copied': self.number_of_files_copied,
+                'files_to_copy': self.number_of_files,
+                'bytes_copied': self.number_of_bytes_copied,
+                'bytes_to_copy': self.number_of_bytes}
+
+    def start(self):
+        self.run = True
+        self.thread = Thread(target=self._sync_thread, name='recordings_sync', daemon=True)
+        self.thread.start()
+
+    def request(self):
+        """
+        Asks for the recordings to be synced to the thumbdrive. Returns immediately.
+        """
+        with self.condition:
+            self.sync_requested = True
+            self.condition.notify_all()
+
+    def pause(self):
+        """
+        Pauses copying after the current chunk, e.g. to keep the SD card free for the recording.
+        """
+        with self.condition:
+            self.paused = True
+
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    def finish(self):
+        """
+        Finishes the requested sync, and stops the thread.
+        """
+        with self.condition:
+            self.run = False
+            self.paused = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _lower_priority(self):
+        # on Linux, the priorities can be set for this thread only
+        if platform.system() != 'Linux':
+            return
+        thread_id = get_native_id()
+        try:
+            os.setpriority(os.PRIO_PROCESS, thread_id, 19)
+            # idle I/O class: only gets the SD card and the thumbdrive when nothing else needs them
+            subprocess.run(['ionice', '-c', '3', '-p', str(thread_id)], check=False, capture_output=True)
+        except (OSError, FileNotFoundError):
+            pass
+
+    def _wait_while_paused(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.paused)
+
+    def _sync_thread(self):
+        self._lower_priority()
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.sync_requested or not self.run)
+                if not self.sync_requested:
+                    break
+                self.sync_requested = False
+            self._wait_while_paused()
+            try:
+                self._sync()
+            except OSError as error:
+                # e.g. the thumbdrive was removed. Whatever was not copied is copied with the next sync.
+                print(f'Syncing the recordings to the thumbdrive failed: {error}')
+            self.syncing = False
+            self.current_file = None
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(f'{self.destination_folder}/{MANIFEST_NAME}') as manifest_file:
+                return json.load(manifest_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, manifest: dict):
+        # write to a temporary file first, so that the manifest is never left half-written
+        path = f'{self.destination_folder}/{MANIFEST_NAME}'
+        with open(path + '.tmp', 'w') as manifest_file:
+            manifest_file.write(json.dumps(manifest))
+        os.replace(path + '.tmp', path)
+
+    def _sync(self):
+        # check if the thumbdrive is attached
+        if not os.path.exists(self.thumbdrive) or not os.path.exists(self.source_folder):
+            return # do nothing with the thumbdrive
+        os.makedirs(self.destination_folder, exist_ok=True)
+        manifest = self._load_manifest()
+
+        # find the files that are new or have changed since they were copied
+        files = []
+        for file in sorted(os.listdir(self.source_folder)):
+            path = f'{self.source_folder}/{file}'
+            if not os.path.isfile(path):
+                continue
+            status = os.stat(path)
+            entry = manifest.get(file)
+            if entry is not None and entry['size'] == status.st_size and \
+                    os.path.exists(f'{self.destination_folder}/{file}'):
+                if entry['mtime'] == status.st_mtime:
+                    continue
+                # only the mtime changed, so check if the contents did as well
+                if _hash_file(path).hexdigest() == entry['hash']:
+                    entry['mtime'] = status.st_mtime
+                    continue
+            files.append((file, status))
+        if not files:
+            self._save_manifest(manifest)
+            return
+
+        self.syncing = True
+        self.number_of_files = len(files)
+        self.number_of_files_copied = 0
+        self.number_of_bytes = sum(status.st_size for _, status in files)
+        self.number_of_bytes_copied = 0
+        print(f'Syncing {len(files)} files ({self.number_of_bytes / 1e6:.1f} MB) to the thumbdrive...')
+
+        for file, status in files:
+            self.current_file = file
+            file_hash = self._copy(file, status, manifest)
+            manifest[file] = {'size': status.st_size, 'mtime': status.st_mtime, 'hash': file_hash}
+            manifest.pop(file + PARTIAL_EXTENSION, None)
+            self._save_manifest(manifest)
+            self.number_of_files_copied += 1
+            print(f'Synced {file} ({self.number_of_files_copied}/{self.number_of_files} files, '\
+                    f'{self.number_of_bytes_copied / max(self.number_of_bytes, 1):.0%}).')
+        print('Recordings synced to the thumbdrive.')
+
+    def _copy(self, file: str, status: os.stat_result, manifest: dict) -> str:
+        """
+        Copies a file to the thumbdrive in chunks, resuming an earlier partial copy of the same
+        version of the file, if there is one. Returns the hash of the file.
+        """
+        source_path = f'{self.source_folder}/{file}'
+        destination_path = f'{self.destination_folder}/{file}'
+        partial_path = destination_path + PARTIAL_EXTENSION
+
+        # Resume the partial copy if it was of the same version of the file. The partial copy is
+        # hashed again, so that the hash of the whole file can be checked by the manifest later.
+        partial_entry = manifest.get(file + PARTIAL_EXTENSION)
+        position = 0
+        if partial_entry is not None and os.path.exists(partial_path) and \
+                partial_entry['size'] == status.st_size and partial_entry['mtime'] == status.st_mtime:
+            position = min(os.path.getsize(partial_path), status.st_size)
+        else:
+            manifest[file + PARTIAL_EXTENSION] = {'size': status.st_size, 'mtime': status.st_mtime}
+            self._save_manifest(manifest)
+        file_hash = _hash_file(partial_path, position) if position else hashlib.sha256()
+        self.number_of_bytes_copied += position
+
+        with open(source_path, 'rb') as source_file, open(partial_path, 'r+b' if position else 'wb') as partial_file:
+            source_file.seek(position)
+            partial_file.seek(position)
+            partial_file.truncate()
+            while True:
+                # stop between chunks while paused
+                self._wait_while_paused()
+                chunk = source_file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                partial_file.write(chunk)
+                file_hash.update(chunk)
+                self.number_of_bytes_copied += len(chunk)
+            partial_file.flush()
+            os.fsync(partial_file.fileno())
+        os.replace(partial_path, destination_path)
+        return file_hash.hexdigest()
@@ -1,26 +1,114 @@
 # standard libraries
 import cv2
 import os
-from queue import Queue
-from threading import Thread
+import struct
+import numpy as np
+from queue import Queue, Empty, Full
+from threading import Thread, Condition
 from time import sleep
 from timeit import default_timer as timer
-import global_variables as gv
 import platform
 
+# number of the most recent frames from the camera that are kept in the ring
+FRAME_RING_SIZE = 4
+# seconds that read_frame waits for a new frame by default
+FRAME_TIMEOUT = .5
+# memory (in bytes) that frames decoded ahead from a video file may take up
+DECODE_AHEAD_BUDGET = 64 * 1024 ** 2
+# frame rate to play back video files at, if the file does not tell
+DEFAULT_VIDEO_FILE_FPS = 30
+# formats that frames can be captured from the webcam in, see CustomVideoCapture
+CAPTURE_FORMATS = ('MJPG', 'JPEG', 'YUYV', 'NV12')
+# conversions from the pixel formats that frames can be captured in to BGR
+TO_BGR = {'YUYV': cv2.COLOR_YUV2BGR_YUYV, 'NV12': cv2.COLOR_YUV2BGR_NV12}
+# flags for decoding JPEG frames at a reduced scale, by reduction
+JPEG_REDUCTIONS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 
+                    4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+# what CustomVideoWriter does with a frame when its queue is full
+DROP_POLICIES = ('block', 'drop_oldest', 'decimate')
+# Recordings of JPEG frames stop growing at this size (in bytes), since AVI files 
+# without the OpenDML extensions cannot be larger than 4 GB, and some players stop at 2 GB.
+MAX_AVI_SIZE = 2 ** 31
+
+def get_luma(frame, pixel_format: str):
+    """
+    Returns the Y plane of a YUYV or NV12 frame as a greyscale view, without copying it.
+    """
+    if pixel_format == 'YUYV':
+        return frame[:,:,0]
+    return frame[:frame.shape[0] * 2 // 3]
+
+def get_chroma(frame, pixel_format: str) -> tuple:
+    """
+    Returns the U and V planes of a YUYV or NV12 frame as views, without copying them.
+    The planes have half the columns of the frame, and for NV12 also half the rows.
+    """
+    if pixel_format == 'YUYV':
+        return frame[:,0::2,1], frame[:,1::2,1]
+    height = frame.shape[0] * 2 // 3
+    chroma = frame[height:].reshape(height // 2, frame.shape[1] // 2, 2)
+    return chroma[:,:,0], chroma[:,:,1]
+
+def decode_jpeg(frame, reduction: int = 1):
+    """
+    Decodes a JPEG frame to BGR, scaled down by reduction (1, 2, 4 or 8). The JPEG decoder scales the frame
+    down before it reconstructs the pixels, which is much cheaper than decoding it at full scale.
+    Returns None if the frame is corrupt or truncated.
+    """
+    return cv2.imdecode(frame, JPEG_REDUCTIONS[reduction])
+
+def to_bgr(frame, pixel_format: str, dst=None):
+    """
+    Converts a frame of pixel_format to a BGR frame, written to dst if it has the right shape
+    (except for JPEG frames, which are decoded to a new frame).
+    """
+    if pixel_format == 'JPEG':
+        return decode_jpeg(frame)
+    if pixel_format == 'BGR':
+        if dst is None or dst.shape != frame.shape:
+            return frame.copy()
+        np.copyto(dst, frame)
+        return dst
+    return cv2.cvtColor(frame, TO_BGR[pixel_format], dst=dst)
+
 class CustomVideoCapture:
-    def __init__(self, resolution=None, source=0):
+    def __init__(self, resolution=None, source=0, paced: bool = True, capture_format: str = 'MJPG'):
+        """
+        resolution: resolution of the webcam. Video files keep their own resolution.
+        source: index of the webcam, or path of the video file
+        paced: if True, frames from a video file are handed out at the frame rate of the
+        recording, like from a webcam. If False, they are handed out as fast as they are decoded.
+        capture_format: format to ask the webcam for. 'MJPG' frames are decoded to BGR.
+        'YUYV' and 'NV12' frames are handed out as they are, without decoding or color conversion, 
+        see get_luma, get_chroma and to_bgr. 'JPEG' asks for MJPG, but hands out the compressed
+        JPEG bytes of each frame, see decode_jpeg. pixel_format tells the format of the frames handed out.
+        """
+        if capture_format not in CAPTURE_FORMATS:
+            raise ValueError(f'Unknown capture format {capture_format}. Choose from {CAPTURE_FORMATS}.')
         self.run = False
+        self.paced = paced
+        self.pixel_format = 'BGR'
         self.source = source
         self.fps_list = []
 
+        # The camera thread puts each frame into a ring, together with its sequence number and the time
+        # it was captured, and then publishes its sequence number. Readers only ever look at published frames,
+        # so the ring needs no lock. new_frame only wakes up the readers that are waiting for a frame.
+        self.frame_ring = [None] * FRAME_RING_SIZE
+        self.latest_sequence_number = 0 # sequence number of the most recent frame in the ring
+        self.new_frame = Condition()
+        # the frame last returned by read_frame
+        self.sequence_number = 0
+        self.timestamp = None # time the frame was captured, in seconds (see timeit.default_timer)
+        self.dropped_frames = 0 # number of frames that were never read, between this frame and the one before
+        self.number_of_dropped_frames = 0
+
         # determine if we are streaming from a webcam or a video file
         if source.isnumeric():
             self.source = int(source)
             self.using_camera = True
         else:
             self.using_camera = False
-            self.queue = Queue(maxsize=100)
 
         # define the VideoCapture object
         os = platform.system()
@@ -35,55 +123,124 @@ class CustomVideoCapture:
         else:
             ret, self.frame = self.cap.read() # read the first frame to get the resolution
             self.resolution = self.frame.shape[:2][::-1]
-            # redefine the VideoCapture object so that we start over at frame 0
-            self.cap = cv2.VideoCapture(self.source) 
+            self.fps = self.cap.get(cv2.CAP_PROP_FPS) or DEFAULT_VIDEO_FILE_FPS
+            # decode as many frames ahead as fit into the memory budget
+            self.queue = Queue(maxsize=max(DECODE_AHEAD_BUDGET // self.frame.nbytes, 1))
         
         self.cap.set(3,self.resolution[0])
         self.cap.set(4,self.resolution[1])
 
-        fourcc = cv2.VideoWriter_fourcc(*'MJPG')
-        self.cap.set(cv2.CAP_PROP_FOURCC, fourcc)
+        if self.using_camera and (capture_format in TO_BGR or capture_format == 'JPEG'):
+            fourcc = cv2.VideoWriter_fourcc(*('MJPG' if capture_format == 'JPEG' else capture_format))
+            self.cap.set(cv2.CAP_PROP_FOURCC, fourcc)
+            # hand out the raw frames, instead of converting them to BGR
+            self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+            self.pixel_format = capture_format
+            # the resolution that the webcam actually delivers
+            self.resolution = (int(self.cap.get(3)), int(self.cap.get(4)))
+        else:
+            fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+            self.cap.set(cv2.CAP_PROP_FOURCC, fourcc)
 
     def get_frames_from_camera(self):
         self.t1 = timer()
         self.number_of_frames = 0
         while self.run:
-            ret, self.frame = self.cap.read()
+            ret, frame = self.cap.read()
             if ret:
+                timestamp = timer()
+                if self.pixel_format != 'BGR':
+                    frame = self._reshape_raw_frame(frame)
                 self.number_of_frames += 1
+                sequence_number = self.latest_sequence_number + 1
+                self.frame_ring[sequence_number % FRAME_RING_SIZE] = (sequence_number, timestamp, frame)
+                # publish the frame only once it is in the ring
+                self.latest_sequence_number = sequence_number
+                with self.new_frame:
+                    self.new_frame.notify_all()
             else:
                 print('Cannot get frames. Ending program.')
                 self.run = False
                 self.release()
 
     def get_frames_from_video_file(self):
+        # Decode ahead until the queue is full, and then wait for the main loop to take a frame.
+        # The frame that was read to get the resolution is the first one.
+        frame = self.frame
         while self.run:
-            if self.queue.full():
-                sleep(1) # wait a bit for the main loop to catch up
-                continue # terminate the current iteration of the loop early
-            else:
-                sleep(.01)
-                ret, frame = self.cap.read()
-            
+            try:
+                # wait for a free spot, but check every now and then if the stream was stopped
+                self.queue.put(frame, timeout=FRAME_TIMEOUT)
+            except Full:
+                continue
+            if frame is None:
+                break # end of the video file
+            ret, frame = self.cap.read()
             if ret == False:
-                print('Cannot get frames. Ending program.')
-                self.release()
-                break
-            else:
-                self.queue.put(frame)
+                frame = None # let the main loop know that there are no more frames
+        self.cap.release()
 
-    def read_frame(self):
+    def _reshape_raw_frame(self, frame):
+        """
+        Gives a raw frame the layout that get_luma and get_chroma expect, since depending on 
+        the backend, raw frames may come as a flat buffer. Reshaping does not copy the frame.
+        """
+        width, height = self.resolution
+        if self.pixel_format == 'JPEG':
+            return frame.reshape(-1)
+        if self.pixel_format == 'YUYV':
+            return frame.reshape(height, width, 2)
+        return frame.reshape(height * 3 // 2, width)
+
+    def read_frame(self, timeout: float = FRAME_TIMEOUT):
+        """
+        Returns the next frame, or None if there is none.
+        From a webcam, this is the most recent frame. Waits up to timeout seconds for a frame 
+        that has not been read yet, so that the same frame is never returned twice.
+        sequence_number, timestamp and dropped_frames tell which frame was returned.
+        """
         # if using webcam
         if self.using_camera:
-            return self.frame
+            return self._read_frame_from_camera(timeout)
 
         # if streaming from a video file
-        if self.queue.empty():
-            print('No more frames left in the CustomVideoCapture queue.')
+        try:
+            frame = self.queue.get(timeout=timeout)
+        except Empty:
+            return None # the decoder has fallen behind
+        if frame is None:
+            print('No more frames left in the video file. Ending program.')
+            self.run = False
             return None
+
+        # When paced, hand out each frame at the time it would have been captured, counting from the first frame.
+        # Frames are never dropped, so when the main loop falls behind, the playback falls behind.
+        if self.sequence_number == 0:
+            self.start_time = timer()
+        self.sequence_number += 1
+        if self.paced:
+            self.timestamp = self.start_time + (self.sequence_number - 1) / self.fps
+            time_to_wait = self.timestamp - timer()
+            if time_to_wait > 0:
+                sleep(time_to_wait)
         else:
-            frame = self.queue.get()
-            return frame         
+            self.timestamp = timer()
+        return frame
+
+    def _read_frame_from_camera(self, timeout: float):
+        with self.new_frame:
+            is_new_frame = self.new_frame.wait_for(lambda: self.latest_sequence_number > self.sequence_number or not self.run,
+                                                    timeout)
+        if not is_new_frame or self.latest_sequence_number == self.sequence_number:
+            return None
+
+        # In the meantime, the slot may have been refilled with a frame that is 
+        # FRAME_RING_SIZE frames newer, which is just as good.
+        sequence_number, self.timestamp, frame = self.frame_ring[self.latest_sequence_number % FRAME_RING_SIZE]
+        self.dropped_frames = sequence_number - self.sequence_number - 1
+        self.number_of_dropped_frames += self.dropped_frames
+        self.sequence_number = sequence_number
+        return frame
 
     def start_stream(self):
         self.run = True
@@ -102,50 +259,216 @@ class CustomVideoCapture:
             time_elapsed = self.t2 - self.t1
             average_fps = self.number_of_frames / time_elapsed
             print(f'CustomVideoCapture average FPS: {average_fps}')
+            print(f'CustomVideoCapture dropped frames: {self.number_of_dropped_frames}')
         self.run = False
-        self.cap.release()
+        # wake up any reader that is waiting for a frame
+        with self.new_frame:
+            self.new_frame.notify_all()
+        # the thread that decodes a video file releases it when it stops
+        if self.using_camera:
+            self.cap.release()
 
 class CustomVideoWriter:
-    def __init__(self, filename, file_path, resolution=(1280, 720), fps=30):
+    def __init__(self, filename, file_path, resolution=(1280, 720), fps=30, pixel_format='BGR',
+                    max_queued_frames: int = 60, drop_policy: str = 'drop_oldest', decimation: int = 2,
+                    on_frame_written=None):
+        """
+        Writes frames to a video file in a separate thread. Frames wait in a queue of up to
+        max_queued_frames, so that the memory they take up is bounded when writing falls behind.
+        drop_policy: what to do with a frame when the queue is full. 'block' waits for a free spot,
+        which holds up the caller. 'drop_oldest' drops the oldest frame in the queue to make room.
+        'decimate' only queues every decimation-th frame while the queue is more than half full,
+        and drops the frame if the queue is still full.
+        on_frame_written: optional function that is called from the writer thread with the tag of each frame
+        passed to write and its index in the video file, once the frame has been written. Frames that are
+        dropped are never passed to it, so it can be used to line up other data with the frames of the video.
+        """
         self.filename = filename
         self.file_path = file_path
         self.resolution = resolution
         self.fps = fps
+        self.pixel_format = pixel_format # of the frames put into the queue
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f'Unknown drop policy {drop_policy}. Choose from {DROP_POLICIES}.')
+        self.drop_policy = drop_policy
+        self.decimation = decimation
+        self.on_frame_written = on_frame_written
+
+        if pixel_format == 'JPEG':
+            # the JPEG frames from the webcam are written as they are, without decoding and encoding them again
+            self.writer = MjpegAviWriter(f'{self.file_path}/{self.filename}', self.resolution, fps)
+        else:
+            fourcc = cv2.VideoWriter_fourcc('X','V','I','D')
+            self.writer = cv2.VideoWriter(f'{self.file_path}/{self.filename}', fourcc, fps, self.resolution)
+        self.queue = Queue(maxsize=max_queued_frames)
 
-        fourcc = cv2.VideoWriter_fourcc('X','V','I','D')
-        self.writer = cv2.VideoWriter(f'{self.file_path}/{self.filename}', fourcc, fps, self.resolution)
-        self.queue = Queue()
+        # counters
+        self.frames_received = 0 # frames passed to write
+        self.frames_queued = 0
+        self.frames_dropped = 0
+        self.frames_written = 0
+        self.time_spent_writing = 0 # in seconds, including the encoding
+        self.max_queue_length = 0
+
+    @property
+    def counters(self) -> dict:
+        return {'frames_received': self.frames_received, 'frames_queued': self.frames_queued,
+                'frames_dropped': self.frames_dropped, 'frames_written': self.frames_written,
+                'time_spent_writing': self.time_spent_writing, 'max_queue_length': self.max_queue_length}
+
+    def write(self, frame, tag=None) -> bool:
+        """
+        Queues the frame to be written, according to the drop policy.
+        tag: passed to on_frame_written along with the index of the frame in the video file
+        Returns False if the frame was dropped. A frame that was queued can still be dropped later
+        by the 'drop_oldest' policy, which only on_frame_written can tell.
+        """
+        self.frames_received += 1
+        item = (tag, frame)
+        if self.drop_policy == 'block':
+            self.queue.put(item)
+        elif self.drop_policy == 'drop_oldest':
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except Full:
+                    pass
+                try:
+                    self.queue.get_nowait()
+                    self.frames_dropped += 1
+                except Empty:
+                    pass # the writer thread got to it first
+        else:
+            is_decimated = self.queue.qsize() > self.queue.maxsize // 2 and self.frames_received % self.decimation
+            try:
+                if is_decimated:
+                    raise Full
+                self.queue.put_nowait(item)
+            except Full:
+                self.frames_dropped += 1
+                return False
+        self.frames_queued += 1
+        self.max_queue_length = max(self.max_queue_length, self.queue.qsize())
+        return True
 
     def start_writing(self):
         def thread():
-            self.run = True
             print(f'Recording in {self.resolution} at {self.fps} FPS.')
-            self.time_spent_writing = 0
-            self.frames_written = 0
-            while gv.recording or not self.queue.empty():
-                if self.queue.empty():
-                    sleep(.1)
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break # finish was called
+                tag, frame = item
+                t1 = timer()
+                if self.pixel_format not in ('BGR', 'JPEG'):
+                    # raw frames from the webcam are converted here, instead of in the main loop
+                    frame = to_bgr(frame, self.pixel_format)
+                # MjpegAviWriter returns False when the file is full
+                is_written = self.writer.write(frame) is not False
+                t2 = timer()
+                elapsed_time = t2 - t1
+                self.time_spent_writing += elapsed_time
+                if not is_written:
                     continue
-                else:
-                    t1 = timer()
-                    frame = self.queue.get()
-                    self.writer.write(frame)
-                    t2 = timer()
-                    elapsed_time = t2 - t1
-                    self.time_spent_writing += elapsed_time
-                    self.frames_written += 1
+                if self.on_frame_written is not None:
+                    self.on_frame_written(tag, self.frames_written)
+                self.frames_written += 1
             self.stop()
             print(f"Recording stopped.")
+        self.run = True
         Thread(target=thread).start()
 
+    def finish(self):
+        """
+        Lets the writer thread know that there are no more frames. 
+        It writes the frames that are left in the queue, and then stops.
+        """
+        self.queue.put(None)
+
     def stop(self):
         self.writer.release()
         self.run = False
-        fps = self.frames_written / self.time_spent_writing
-        print(f'CustomVideoWriter fps: {fps}')
+        if self.frames_written:
+            fps = self.frames_written / self.time_spent_writing
+            print(f'CustomVideoWriter fps: {fps}')
+        if self.frames_dropped:
+            print(f'CustomVideoWriter dropped {self.frames_dropped} of {self.frames_received} frames.')
 
 
 
     
 
+class MjpegAviWriter:
+    def __init__(self, path: str, resolution: tuple, fps: float):
+        """
+        Writes JPEG frames, e.g. the ones captured by a webcam in MJPG, into an MJPEG AVI file as they are.
+        The file can be played back like the ones written by cv2.VideoWriter.
+        Has the same write and release methods as cv2.VideoWriter, except that write takes the JPEG bytes,
+        and returns False if the frame could not be written because the file is full.
+        """
+        self.file = open(path, 'wb')
+        self.resolution = resolution
+        self.fps = fps
+        self.index = [] # offset and size of each frame within the movi list
+        self.max_frame_size = 0
+        self.is_full = False
+
+        # write the headers, with zeros for the sizes and counts that are only known at the end
+        self.file.write(b'RIFF\0\0\0\0AVI LIST' + struct.pack('<I', 4 + 8 + 56 + 12 + 8 + 56 + 8 + 40) + b'hdrl')
+        self.file.write(b'avih' + struct.pack('<I', 56))
+        self.avih_position = self.file.tell()
+        self.file.write(self._main_header())
+        self.file.write(b'LIST' + struct.pack('<I', 4 + 8 + 56 + 8 + 40) + b'strl')
+        self.file.write(b'strh' + struct.pack('<I', 56))
+        self.strh_position = self.file.tell()
+        self.file.write(self._stream_header())
+        width, height = resolution
+        self.file.write(b'strf' + struct.pack('<IIiiHH4sIiiII', 40, 40, width, height, 1, 24, b'MJPG', width * height * 3, 0, 0, 0, 0))
+        self.file.write(b'LIST\0\0\0\0movi')
+        self.movi_position = self.file.tell() - 4 # frame offsets in the index count from here
 
+    def _main_header(self) -> bytes:
+        microseconds_per_frame = int(round(1e6 / self.fps))
+        width, height = self.resolution
+        has_index = 0x10
+        return struct.pack('<14I', microseconds_per_frame, 0, 0, has_index, len(self.index), 0, 1, 
+                            self.max_frame_size, width, height, 0, 0, 0, 0)
+
+    def _stream_header(self) -> bytes:
+        width, height = self.resolution
+        return struct.pack('<4s4sIHHIIIIIIIIhhhh', b'vids', b'MJPG', 0, 0, 0, 0, 1000, int(round(self.fps * 1000)), 0,
+                            len(self.index), self.max_frame_size, 0xFFFFFFFF, 0, 0, 0, width, height)
+
+    def write(self, frame) -> bool:
+        frame = memoryview(frame).cast('B')
+        size = frame.nbytes
+        if self.file.tell() + size + 8 + 16 * (len(self.index) + 1) > MAX_AVI_SIZE:
+            if not self.is_full:
+                print('The recording has reached the maximum size of an AVI file. Frames are no longer recorded.')
+                self.is_full = True
+            return False
+        self.index.append((self.file.tell() - self.movi_position, size))
+        self.max_frame_size = max(self.max_frame_size, size)
+        self.file.write(b'00dc' + struct.pack('<I', size))
+        self.file.write(frame)
+        if size % 2:
+            self.file.write(b'\0') # chunks are padded to an even size
+        return True
+
+    def release(self):
+        # write the index, and fill in the sizes and counts
+        end_of_movi = self.file.tell()
+        keyframe = 0x10
+        self.file.write(b'idx1' + struct.pack('<I', 16 * len(self.index)))
+        self.file.write(b''.join(struct.pack('<4sIII', b'00dc', keyframe, offset, size) for offset, size in self.index))
+        file_size = self.file.tell()
+        self.file.seek(4)
+        self.file.write(struct.pack('<I', file_size - 8))
+        self.file.seek(self.avih_position)
+        self.file.write(self._main_header())
+        self.file.seek(self.strh_position)
+        self.file.write(self._stream_header())
+        self.file.seek(self.movi_position - 4)
+        self.file.write(struct.pack('<I', end_of_movi - self.movi_position))
+        self.file.close()
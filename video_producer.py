@@ -2,13 +2,13 @@
 import cv2
 import numpy as np
 import os
-import json
 from timeit import default_timer as timer
 
 # my libraries
 from draw_display import draw_horizon, draw_surfaces, draw_hud, draw_roi, draw_stick
 from crop_and_scale import get_cropping_and_scaling_parameters, crop_and_scale
 from find_horizon import HorizonDetector
+from telemetry_log import load_recording, get_video_frame_records
 
 # constants
 BLUE = (255,0,0)
@@ -35,9 +35,9 @@ def main(output_res=(1280,720)):
         if file_extension not in acceptable_file_extentions:
             continue
         
-        # check if this video has a corresponding txt file
+        # check if this video has a corresponding telemetry or json file
         filename = item.replace(f'.{file_extension}', '')
-        if filename + '.json' not in items:
+        if filename + '.telemetry' not in items and filename + '.json' not in items:
             continue
         
         # check if the video has already been produced
@@ -62,17 +62,28 @@ def main(output_res=(1280,720)):
         video_extension = video.split('.')[-1]
         video_name = video.replace(f'.{video_extension}', '')
 
-        # Open JSON file
-        with open(f'{recordings_path}/{video_name}.json') as json_file:
-            datadict = json.load(json_file)
+        # open the telemetry file (or the json file of older recordings)
+        metadata, records = load_recording(f'{recordings_path}/{video_name}')
+        # the records of the frames that were dropped from the video are left out
+        records = get_video_frame_records(records)
 
         # extract some values from the metadata
-        fps = datadict['metadata']['fps']
-        resolution = datadict['metadata']['resolution']
-        inf_resolution = datadict['metadata']['inference_resolution']
-        exclusion_thresh = datadict['metadata']['exclusion_thresh']
-        acceptable_variance = datadict['metadata']['acceptable_variance']
-        fov = datadict['metadata']['fov']
+        fps = metadata['fps']
+        resolution = metadata['resolution']
+        inf_resolution = metadata['inference_resolution']
+        exclusion_thresh = metadata['exclusion_thresh']
+        acceptable_variance = metadata['acceptable_variance']
+        fov = metadata['fov']
+        # older recordings were made before these detection options existed
+        band_detection = metadata.get('band_detection', 0)
+        pyramid_resolution = metadata.get('pyramid_resolution')
+        sky_lut_bits = metadata.get('sky_lut_bits')
+        fitter = metadata.get('fitter', 'polyfit')
+        predictor = metadata.get('predictor', 'linear')
+        backend = metadata.get('backend', 'contour')
+        motion_thresh = metadata.get('motion_thresh')
+        tracking_interval = metadata.get('tracking_interval')
+        preprocessing_threads = metadata.get('preprocessing_threads', 1)
 
         # define video_capture
         source = f'{recordings_path}/{video_name}.{video_extension}'
@@ -88,34 +99,48 @@ def main(output_res=(1280,720)):
         crop_and_scale_parameters = get_cropping_and_scaling_parameters(resolution, inf_resolution)
 
         # define the HorizonDetector
-        horizon_detector = HorizonDetector(exclusion_thresh, fov, acceptable_variance, inf_resolution)
-
-        frame_num = 0
-        while True:
-            ret, frame = cap.read()
-            if ret == False:
-                break
+        horizon_detector = HorizonDetector(exclusion_thresh, fov, acceptable_variance, inf_resolution,
+                                            band_detection=band_detection, pyramid_resolution=pyramid_resolution,
+                                            sky_lut_bits=sky_lut_bits, fitter=fitter, predictor=predictor,
+                                            backend=backend, motion_thresh=motion_thresh,
+                                            tracking_interval=tracking_interval, preprocessing_threads=preprocessing_threads)
+
+        # the current frame of the video, at full resolution for drawing
+        frame = None
+        # set when q is pressed, to stop reading the video
+        quit_requested = False
+
+        def read_frames():
+            """
+            Reads the frames of the video, and yields them cropped and scaled for the horizon detector.
+            """
+            nonlocal frame
+            while not quit_requested:
+                ret, frame = cap.read()
+                if ret == False:
+                    break
+                yield crop_and_scale(frame, **crop_and_scale_parameters)
+
+        def draw_frame(frame_num, roll, pitch, variance, is_good_horizon, diagnostic_mask):
+            """
+            Draws the horizon found in the current frame, together with its telemetry,
+            and writes the result to the output video.
+            """
+            nonlocal quit_requested
 
             # extract the values
-            dict_key = str(frame_num)
-            roll = datadict['frames'][dict_key]['roll']
-            pitch = datadict['frames'][dict_key]['pitch']
-            is_good_horizon = datadict['frames'][dict_key]['is_good_horizon']
-            actual_fps = datadict['frames'][dict_key]['actual_fps']
-            ail_val = datadict['frames'][dict_key]['ail_val']
-            elev_val = datadict['frames'][dict_key]['elev_val']
-            flt_mode = datadict['frames'][dict_key]['flt_mode']
-            pitch_trim = datadict['frames'][dict_key]['pitch_trim']
-            ail_stick_val = datadict['frames'][dict_key]['ail_stick_val']
-            elev_stick_val = datadict['frames'][dict_key]['elev_stick_val']
+            frame_data = dict(zip(records.dtype.names, records[frame_num].item()))
+            actual_fps = frame_data['actual_fps']
+            ail_val = frame_data['ail_val']
+            elev_val = frame_data['elev_val']
+            flt_mode = frame_data['flt_mode']
+            pitch_trim = frame_data['pitch_trim']
+            ail_stick_val = frame_data['ail_stick_val']
+            elev_stick_val = frame_data['elev_stick_val']
 
             # Reverse some values if necessary
             ail_stick_val = -1 * ail_stick_val
 
-            scaled_and_cropped_frame = crop_and_scale(frame, **crop_and_scale_parameters)
-            output = horizon_detector.find_horizon(scaled_and_cropped_frame, diagnostic_mode=True)
-            roll, pitch, variance, is_good_horizon, diagnostic_mask = output
-
             # determine flight mode color
             if flt_mode != 0:
                 flt_mode_color = (0,255,0)
@@ -195,21 +220,23 @@ def main(output_res=(1280,720)):
 
             # stack the frames
             stacked = cv2.vconcat([stats_canvas, resized_diagnostic_mask, surface_canvas])
-            frame = cv2.hconcat([resized_frame, stacked])
+            output_frame = cv2.hconcat([resized_frame, stacked])
 
             # send the frame to the queue to be recorded
-            writer.write(frame)
+            writer.write(output_frame)
             
             # show results
-            cv2.imshow(f'Producing {output_video_name}...', frame)
+            cv2.imshow(f'Producing {output_video_name}...', output_frame)
 
             # check pressed keys 
             key = cv2.waitKey(1)
             if key == ord('q'):
-                break
+                quit_requested = True
 
-            # increase frame number
-            frame_num += 1
+        # The horizon is found in all frames in one batch, which carries the predicted horizon 
+        # over from frame to frame. Each frame is drawn as soon as its horizon is found.
+        rolls, _, _, _ = horizon_detector.find_horizons(read_frames(), diagnostic_mode=True, on_frame=draw_frame)
+        frame_num = len(rolls)
 
         # finishing message
         t2 = timer()